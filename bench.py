@@ -0,0 +1,482 @@
+import argparse
+import asyncio
+import heapq
+import io
+import json
+import os
+import random
+import resource
+import shutil
+import threading
+import time
+import types
+from datetime import datetime
+
+import numpy as np
+import discord.opus as opus
+from discord.sinks import RawData
+
+import metrics_util as metrics
+from capture_util import iter_capture
+from codec_util import PROFILES, get_profile
+from ffmpeg_util import (combine_mp3_files_async, overlay_mp3_files_async,
+                         write_wav_btyes_to_mp3_file)
+from mix_util import LiveMixer, mix_sources_async
+from opus_util import SILENCE_FRAME, build_ogg_track, first_receive_time
+from spool_util import SpoolScheduler
+from vc_util import (MemoryConciousDecodeManager, MemoryConciousVoiceClient,
+                     MemoryConsiousMP3Sink, MultiprocessDecodeManager,
+                     OpusPacketSink, PassthroughDecodeManager, PendingSSRCs)
+
+"""
+Offline benchmark of the capture path, no Discord connection needed.
+
+Generated opus frames go through the same decode manager, recv_decoded_audio and sink as a live recording,
+with a fake ssrc_map standing in for the voice websocket. Speakers talk and go quiet at random (seeded),
+packets can arrive with jitter or get lost.
+Reports packets/s, the real-time factor (processing time / audio time, lower is better), peak RSS
+and how long flushing and finalizing took. Every run is appended to bench_output.txt as a json line.
+
+With --replay, a packet capture of a real session (PACKET_CAPTURE_PATH, see capture_util) is fed instead,
+ssrc mappings are applied at the moment they were seen, so late joins and reconnects replay as they happened.
+
+With --codecs, the codec profiles (codec_util) are benchmarked instead: each encodes the same generated
+speech-like audio, reporting the real-time factor, the cpu time of ffmpeg and bytes per minute of audio.
+
+e.g. python bench.py --speakers 8 --duration 600 --buffer mmap --decode-workers 2
+     python bench.py --replay captures/capture-20240101120000.dvcap --realtime
+     python bench.py --codecs opus32 mp3 flac --duration 60
+"""
+
+SAMPLING_RATE = 48000
+FRAME_SAMPLES = 960
+FRAME_SECONDS = FRAME_SAMPLES / SAMPLING_RATE
+
+
+def make_frames(speakers: int, frames_per_speaker=50) -> list[list[bytes]]:
+    """
+    A short loop of opus frames per speaker (a tone with some noise), encoded once up front.
+    """
+    encoder = opus.Encoder()
+    rng = np.random.default_rng(0)
+    t = np.arange(FRAME_SAMPLES * frames_per_speaker) / SAMPLING_RATE
+    loops = []
+    for i in range(speakers):
+        tone = np.sin(2 * np.pi * (140 + 35 * i) * t) * 8000 + rng.normal(0, 800, len(t))
+        mono = np.clip(tone, -32768, 32767).astype(np.int16)
+        stereo = np.repeat(mono, 2)
+        frame_bytes = FRAME_SAMPLES * 4
+        pcm = stereo.tobytes()
+        loops.append(
+            [
+                encoder.encode(pcm[j : j + frame_bytes], FRAME_SAMPLES)
+                for j in range(0, len(pcm), frame_bytes)
+            ]
+        )
+    return loops
+
+
+def speech_like_pcm(seconds: float, seed=1) -> bytes:
+    """
+    Stereo pcm that encodes roughly like a voice: a gliding pitch with harmonics, syllables and pauses, some noise.
+    """
+    rng = np.random.default_rng(seed)
+    n = int(seconds * SAMPLING_RATE)
+    t = np.arange(n) / SAMPLING_RATE
+    # Pitch wanders between 90 and 250 Hz, picked every 200ms and interpolated.
+    knots = np.arange(0, seconds + 0.2, 0.2)
+    f0 = np.interp(t, knots, rng.uniform(90, 250, len(knots)))
+    phase = 2 * np.pi * np.cumsum(f0) / SAMPLING_RATE
+    voice = sum(np.sin(k * phase) / k for k in range(1, 9))
+    # ~4 syllables a second, and a pause after every few seconds of talking.
+    syllables = np.clip(np.sin(2 * np.pi * 4 * t + rng.uniform(0, 6)), 0, None)
+    talking = np.interp(t, knots, (rng.random(len(knots)) < 0.7).astype(float))
+    signal = voice * syllables * talking * 6000 + rng.normal(0, 300, n) * talking
+    mono = np.clip(signal, -32768, 32767).astype(np.int16)
+    return np.repeat(mono, 2).tobytes()
+
+
+def bench_codecs(args) -> list[dict]:
+    """
+    Encodes the same audio with each profile, the same way segments are encoded while recording.
+    """
+    os.makedirs(args.output_folder, exist_ok=True)
+    names = args.codecs or list(PROFILES)
+    pcm = speech_like_pcm(args.duration, args.seed)
+    results = []
+    for name in names:
+        profile = get_profile(name)
+        fn = f"{args.output_folder}/codec-bench.{profile.extension}"
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        start = time.perf_counter()
+        write_wav_btyes_to_mp3_file(io.BytesIO(pcm), fn, None, profile.name)
+        seconds = time.perf_counter() - start
+        after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu_seconds = (after.ru_utime - children.ru_utime) + (after.ru_stime - children.ru_stime)
+        size = os.path.getsize(fn) if os.path.exists(fn) else 0
+        results.append(
+            {
+                "date": datetime.now().isoformat(timespec="seconds"),
+                "profile": profile.name,
+                "audio_seconds": args.duration,
+                "real_time_factor": seconds / args.duration,
+                "cpu_real_time_factor": cpu_seconds / args.duration,
+                "bytes_per_minute": size / args.duration * 60,
+                "kbps": size * 8 / args.duration / 1000,
+            }
+        )
+        if not args.keep and os.path.exists(fn):
+            os.remove(fn)
+    if not args.keep:
+        shutil.rmtree(args.output_folder, ignore_errors=True)
+    return results
+
+
+def speaker_packets(ssrc: int, frames: list[bytes], args, rng: random.Random):
+    """
+    Yields (send_time, receive_time, ssrc, sequence, timestamp, payload) of one speaker in send order.
+    The rtp timestamp keeps running while they're quiet, like a real client.
+    """
+    t = rng.uniform(0, args.join_spread)
+    sequence = rng.randrange(1 << 16)
+    timestamp = rng.randrange(1 << 32)
+    n = 0
+    while t < args.duration:
+        end = min(args.duration, t + rng.expovariate(1 / args.talk))
+        while t < end:
+            if rng.random() >= args.loss:
+                receive_time = t + rng.uniform(0, args.jitter / 1000)
+                yield t, receive_time, ssrc, sequence, timestamp, frames[n % len(frames)]
+            n += 1
+            sequence = (sequence + 1) & 0xFFFF
+            timestamp = (timestamp + FRAME_SAMPLES) & 0xFFFFFFFF
+            t += FRAME_SECONDS
+        silence = rng.expovariate(1 / args.silence)
+        timestamp = (timestamp + int(silence * SAMPLING_RATE)) & 0xFFFFFFFF
+        t += silence
+
+
+def merged_packets(generators):
+    """
+    Merges the speakers' packets into receive order, as ("packet", ssrc, sequence, timestamp, time, payload).
+    Jitter can reorder packets, but never by more than the jitter, so a small heap is enough.
+    """
+    pending = []
+    n = 0
+    for packet in heapq.merge(*generators, key=lambda p: p[0]):
+        send_time = packet[0]
+        while pending and pending[0][0] <= send_time:
+            yield heapq.heappop(pending)[2]
+        _, receive_time, ssrc, sequence, timestamp, payload = packet
+        event = ("packet", ssrc, sequence, timestamp, receive_time, payload)
+        heapq.heappush(pending, (receive_time, n, event))
+        n += 1
+    while pending:
+        yield heapq.heappop(pending)[2]
+
+
+def synthetic_events(args):
+    """
+    The map events of all speakers up front, then their packets.
+    """
+    rng = random.Random(args.seed)
+    frames = make_frames(args.speakers)
+    generators = []
+    for i in range(args.speakers):
+        ssrc = 1000 + i
+        yield "map", ssrc, 0.0, 100_000 + i
+        generators.append(speaker_packets(ssrc, frames[i], args, random.Random(rng.random())))
+    yield from merged_packets(generators)
+
+
+def make_raw_data(ssrc, sequence, timestamp, receive_time, payload) -> RawData:
+    """
+    RawData without the rtp header parsing and decryption, the decoder only needs these fields.
+    """
+    data = RawData.__new__(RawData)
+    data.ssrc = ssrc
+    data.sequence = sequence
+    data.timestamp = timestamp
+    data.receive_time = receive_time
+    data.decrypted_data = payload
+    data.decoded_data = None
+    data.user_id = None
+    return data
+
+
+class FakeVoiceClient(MemoryConciousVoiceClient):
+    """
+    Just enough of a voice client for recv_decoded_audio/recv_opus_audio, nothing is connected.
+    """
+
+    def __init__(self, sink, ssrc_map: dict):
+        self.ws = types.SimpleNamespace(ssrc_map=ssrc_map)
+        self.sink = sink
+        self.sync_start = True
+        self.recording = True
+        self.user_timestamps = {}
+        self.starting_time = time.perf_counter()
+        self.pending = PendingSSRCs()
+        self.delivered = 0
+        self.latency_total = 0.0
+
+
+class RSSSampler(threading.Thread):
+    """
+    Samples the RSS while the capture runs, ru_maxrss also counts the startup.
+    """
+
+    def __init__(self, interval=0.1):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, metrics.rss_bytes())
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.peak = max(self.peak, metrics.rss_bytes())
+
+
+def make_sink(args, output_folder):
+    if args.capture == "opus":
+        return OpusPacketSink(output_folder=output_folder)
+    sink = MemoryConsiousMP3Sink(
+        max_before_flush=args.max_before_flush,
+        max_size_mb=args.max_in_mem,
+        output_folder=output_folder,
+        streaming=args.streaming,
+        buffer_backend=args.buffer,
+        encoder_workers=args.encoder_workers or None,
+        segment_format=args.segment_format,
+    )
+    if args.deferred_encoding:
+        sink.spooler = SpoolScheduler(
+            sink.encoder_pool,
+            lambda: len(decoder.decode_queue) if (decoder := getattr(sink.vc, "decoder", None)) else 0,
+        )
+    if args.live_mix:
+        sink.mixer = LiveMixer(f"{output_folder}/mix.mp3", {})
+    return sink
+
+
+def make_decoder(args, vc):
+    if args.capture == "opus":
+        return PassthroughDecodeManager(vc)
+    if args.decode_workers > 0:
+        return MultiprocessDecodeManager(vc, workers=args.decode_workers)
+    return MemoryConciousDecodeManager(vc)
+
+
+def feed(args, vc, decoder, events):
+    """
+    Feeds map events and packets to the voice client/decoder, in real time or as fast as the decoder keeps up.
+    Returns (packets fed, time of the last event).
+    """
+    ssrc_map = vc.ws.ssrc_map
+    base = time.perf_counter()
+    n = 0
+    t = 0.0
+    for event in events:
+        t = event[2] if event[0] == "map" else event[4]
+        if args.realtime:
+            delay = base + t - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+        if event[0] == "map":
+            _, ssrc, _, user_id = event
+            if user_id is None:
+                ssrc_map.pop(ssrc, None)
+            else:
+                ssrc_map[ssrc] = {"user_id": user_id, "speaking": True}
+            continue
+
+        _, ssrc, sequence, timestamp, _, payload = event
+        if payload == SILENCE_FRAME:
+            # Dropped by unpack_audio too.
+            continue
+        if not args.realtime:
+            # Don't let the queue grow without bounds, it'd only measure how much memory a list takes.
+            while len(decoder.decode_queue) > args.max_queue:
+                time.sleep(0.001)
+        decoder.decode(make_raw_data(ssrc, sequence, timestamp, base + t, payload))
+        n += 1
+    return n, t
+
+
+async def finalize(args, sink, output_folder) -> int:
+    """
+    Same steps as the bot without zipping/uploading: combine per user, then overlay.
+    Returns the number of tracks overlaid.
+    """
+    if sink.mixer is not None:
+        return 1
+    # The combined track uses the segment profile too, the bench has no separate output profile.
+    profile = get_profile(args.segment_format)
+    combined_fn = f"{output_folder}/combined-bench.{profile.extension}"
+    tracks = {}
+    if isinstance(sink, OpusPacketSink):
+        packet_files = {
+            user_id: fn
+            for user_id, audio in sink.audio_data.items()
+            for fn in audio.get_actual_files()
+        }
+        starts = [first_receive_time(fn) for fn in packet_files.values()]
+        session_start = min([t for t in starts if t is not None], default=None)
+        for user_id, fn in packet_files.items():
+            track_fn = f"{output_folder}/{user_id}-bench.ogg"
+            if await asyncio.to_thread(build_ogg_track, fn, track_fn, session_start):
+                tracks[track_fn] = 100
+    elif args.finalize_engine == "pcm":
+        sources = {
+            user_id: (files, 100)
+            for user_id, audio in sink.audio_data.items()
+            if (files := list(audio.get_actual_files()))
+        }
+        if sources and await mix_sources_async(
+            sources, combined_fn, output_folder, output_format=profile.name
+        ):
+            return len(sources)
+        return 0
+    else:
+        for user_id, audio in sink.audio_data.items():
+            track_fn = f"{output_folder}/{user_id}-bench.{profile.extension}"
+            if await combine_mp3_files_async(
+                list(audio.get_actual_files()),
+                track_fn,
+                f"{output_folder}/temp_combine_{user_id}.txt",
+                output_folder,
+            ):
+                tracks[track_fn] = 100
+    if tracks:
+        await overlay_mp3_files_async(tracks, combined_fn, output_format=profile.name)
+    return len(tracks)
+
+
+def run(args):
+    output_folder = args.output_folder
+    shutil.rmtree(output_folder, ignore_errors=True)
+    os.makedirs(output_folder)
+
+    events = iter_capture(args.replay) if args.replay else synthetic_events(args)
+
+    sink = make_sink(args, output_folder)
+    vc = FakeVoiceClient(sink, {})
+    sink.init(vc)
+    decoder = make_decoder(args, vc)
+    vc.decoder = decoder
+
+    sampler = RSSSampler()
+    sampler.start()
+    start = time.perf_counter()
+    decoder.start()
+    packets, duration = feed(args, vc, decoder, events)
+    decoder.stop()
+    decoder.wait_stopped()
+    vc.finish_pending()
+    capture_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    sink.cleanup()
+    flush_seconds = time.perf_counter() - start
+    sampler.stop()
+
+    start = time.perf_counter()
+    tracks = asyncio.run(finalize(args, sink, output_folder))
+    finalize_seconds = time.perf_counter() - start
+    sink.cleanup_no_flush()
+
+    result = {
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "settings": {k: v for k, v in vars(args).items() if k not in ("results", "keep")},
+        "packets": packets,
+        "packets_per_second": packets / capture_seconds,
+        "capture_seconds": capture_seconds,
+        "audio_seconds": duration,
+        "real_time_factor": (capture_seconds + flush_seconds) / max(duration, 1e-9),
+        "flush_seconds": flush_seconds,
+        "finalize_seconds": finalize_seconds,
+        "tracks": tracks,
+        "peak_rss_mb": sampler.peak / 1024 / 1024,
+        "peak_rss_children_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+        "decode_queue_high_water": decoder.decode_queue.high_water,
+        "pending_dropped": vc.pending.dropped,
+        "encoder_wait_seconds": sink._encoder_pool.wait_seconds if sink._encoder_pool else 0,
+        "segments_spooled": metrics.SEGMENTS_SPOOLED.get(),
+    }
+    if args.realtime:
+        result["decode_latency_ms"] = metrics.DECODE_LATENCY.average() * 1000
+    if not args.keep:
+        shutil.rmtree(output_folder, ignore_errors=True)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the capture path.")
+    load = parser.add_argument_group("load")
+    load.add_argument("--speakers", type=int, default=4)
+    load.add_argument("--duration", type=float, default=120, help="seconds of audio")
+    load.add_argument("--talk", type=float, default=4, help="mean talk burst in seconds")
+    load.add_argument("--silence", type=float, default=6, help="mean silence in seconds")
+    load.add_argument("--join-spread", type=float, default=10, help="speakers join within this many seconds")
+    load.add_argument("--jitter", type=float, default=20, help="max network jitter in ms")
+    load.add_argument("--loss", type=float, default=0.01, help="packet loss (0-1)")
+    load.add_argument("--seed", type=int, default=1)
+    load.add_argument("--realtime", action="store_true", help="send packets at their real pace")
+    load.add_argument("--max-queue", type=int, default=5000, help="max decode queue when not realtime")
+    load.add_argument("--replay", help="replay a packet capture instead of generating load")
+
+    pipeline = parser.add_argument_group("pipeline (same as .env)")
+    pipeline.add_argument("--capture", choices=("pcm", "opus"), default="pcm")
+    pipeline.add_argument("--max-before-flush", type=int, default=100)
+    pipeline.add_argument("--max-in-mem", type=int, default=200)
+    pipeline.add_argument("--buffer", choices=("memory", "mmap"), default="memory")
+    pipeline.add_argument("--streaming", action="store_true")
+    pipeline.add_argument("--live-mix", action="store_true")
+    pipeline.add_argument("--decode-workers", type=int, default=0)
+    pipeline.add_argument("--encoder-workers", type=int, default=0)
+    pipeline.add_argument("--segment-format", choices=list(PROFILES), default="mp3")
+    pipeline.add_argument("--finalize-engine", choices=("ffmpeg", "pcm"), default="ffmpeg")
+    pipeline.add_argument("--deferred-encoding", action="store_true")
+
+    parser.add_argument(
+        "--codecs",
+        nargs="*",
+        metavar="PROFILE",
+        help="benchmark encoding with these codec profiles (all by default) instead of the capture path",
+    )
+    parser.add_argument("--output-folder", default="bench_tmp")
+    parser.add_argument("--keep", action="store_true", help="keep the output folder")
+    parser.add_argument("--results", default="bench_output.txt", help="append results here")
+    args = parser.parse_args()
+
+    if args.codecs is not None:
+        results = bench_codecs(args)
+        print(f"{'profile':>12} {'rtf':>8} {'cpu rtf':>8} {'kbps':>7} {'MB/min':>7}")
+        for r in results:
+            print(
+                f"{r['profile']:>12} {r['real_time_factor']:>8.4f} {r['cpu_real_time_factor']:>8.4f} "
+                f"{r['kbps']:>7.1f} {r['bytes_per_minute'] / 1024 / 1024:>7.2f}"
+            )
+        if args.results:
+            with open(args.results, "a") as f:
+                f.writelines(json.dumps(r) + "\n" for r in results)
+        return
+
+    result = run(args)
+    for key, value in result.items():
+        if key == "settings":
+            continue
+        print(f"{key:>26}: {value:.3f}" if isinstance(value, float) else f"{key:>26}: {value}")
+    if args.results:
+        with open(args.results, "a") as f:
+            f.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,28 @@
 import asyncio
 import os
-import subprocess
 import time
 from datetime import datetime
 
 import discord
+import numpy as np
 from discord.ext import commands
 from discord.sinks import RecordingException
 from dotenv import dotenv_values
 
-from ffmpeg_util import combine_mp3_files, overlay_mp3_files
+import metrics_util as metrics
+from codec_util import PROFILES, get_profile
+from ffmpeg_util import (combine_mp3_files_async, encode_pcm_file,
+                         overlay_args, overlay_mp3_files_async,
+                         run_pipeline_async, run_process, run_process_async)
 from gdrive import GoogleDriveUploader
-from vc_util import MemoryConciousVoiceClient, MemoryConsiousMP3Sink
+from journal_util import (JournalSession, SegmentJournal, find_journals,
+                          journaled_archives)
+from mix_util import LiveMixer, mix_sources_async
+from opus_util import build_ogg_track, first_receive_time
+from session_util import RecordingSession, SessionManager
+from tap_util import PCMTap
+from vc_util import (MemoryConciousVoiceClient, MemoryConsiousMP3Sink,
+                     OpusPacketSink, RecordingPart)
 
 # globals
 config = dotenv_values(".env")
@@ -19,13 +30,70 @@ config = dotenv_values(".env")
 TOKEN = config["TOKEN"]
 CHANNEL_IDS = config["CHANNEL_IDS"].split(",")
 VERSION = config["VERSION"]
+# Memory budget of each recording.
 MAX_MB_IN_MEM = int(config["MAX_MB_IN_MEM"])
 MAX_MB_BEFORE_FLUSH = int(config["MAX_MB_BEFORE_FLUSH"])
+# Recordings that can run at the same time (one per server).
+MAX_SESSIONS = int(config.get("MAX_SESSIONS", "1"))
+# Max MB of files a recording can have on disk before it's stopped, 0 for no limit.
+SESSION_MAX_DISK_MB = int(config.get("SESSION_MAX_DISK_MB", "0"))
 OUTPUT_PATH = config["OUTPUT_PATH"]
 BOT_NAME = config["BOT_NAME"]
 OUTPUT_G_FOLDER_ID = config["OUTPUT_G_FOLDER_ID"]
 GDRIVE_SECRETS_DIR = config["GDRIVE_SECRETS_DIR"]
 ZIP_PASSWORD = config["ZIP_PASSWORD"]
+# One long-lived encoder per user instead of flushing segments.
+STREAMING_ENCODER = config.get("STREAMING_ENCODER", "0") == "1"
+# Number of processes to decode opus with, 0 decodes on a single thread.
+DECODE_WORKERS = int(config.get("DECODE_WORKERS", "0"))
+# Mix all users into the combined track while recording, no per-user tracks are kept.
+LIVE_MIX = config.get("LIVE_MIX", "0") == "1"
+# "memory" keeps users' pcm in BytesIO, "mmap" in memory-mapped spill files (flat RSS on long sessions).
+PCM_BUFFER = config.get("PCM_BUFFER", "memory")
+# Number of encoder threads for flushed audio, shared by all recordings (defaults to cpu count - 1, at least 1).
+ENCODER_WORKERS = int(config.get("ENCODER_WORKERS", "0")) or None
+# "pcm" decodes while recording, "opus" stores the raw opus packets and builds tracks afterwards.
+CAPTURE_FORMAT = config.get("CAPTURE_FORMAT", "pcm")
+# Pipe the overlay straight into 7z, the combined mp3 never hits the disk.
+PIPELINED_FINALIZE = config.get("PIPELINED_FINALIZE", "0") == "1"
+# "ffmpeg" combines each user's segments and overlays the tracks with amix,
+# "pcm" decodes the segments and mixes them block by block in numpy, encoding only once.
+FINALIZE_ENGINE = config.get("FINALIZE_ENGINE", "ffmpeg")
+# Codec profile of the combined track (see codec_util or !profiles), can be picked per recording with !start.
+OUTPUT_PROFILE = get_profile(config.get("OUTPUT_PROFILE", "mp3")).name
+# Codec profile of the segments while recording, e.g. "flac" (lossless, bigger on disk) or "opus32" (cheapest),
+# empty to use the recording's output profile.
+SEGMENT_FORMAT = config.get("SEGMENT_FORMAT", "")
+if SEGMENT_FORMAT:
+    SEGMENT_FORMAT = get_profile(SEGMENT_FORMAT).name
+# Spool flushed segments to disk as raw pcm while the host is busy, and encode them once load drops.
+DEFERRED_ENCODING = config.get("DEFERRED_ENCODING", "0") == "1"
+# Busy from DEFER_LOAD_HIGH (busy fraction of all cpus) or DEFER_QUEUE_HIGH packets waiting to be decoded,
+# until both are below the LOW marks again.
+DEFER_LOAD_HIGH = float(config.get("DEFER_LOAD_HIGH", "0.85"))
+DEFER_LOAD_LOW = float(config.get("DEFER_LOAD_LOW", "0.5"))
+DEFER_QUEUE_HIGH = int(config.get("DEFER_QUEUE_HIGH", "500"))
+DEFER_QUEUE_LOW = int(config.get("DEFER_QUEUE_LOW", "50"))
+# Max MB of spooled pcm over all recordings, past that segments are encoded right away again.
+DEFER_MAX_MB = int(config.get("DEFER_MAX_MB", "2048"))
+# Max number of ffmpeg/7z processes finalizing at the same time, over all recordings.
+FINALIZE_WORKERS = int(config.get("FINALIZE_WORKERS", str(os.cpu_count() or 1)))
+# Niceness for finalization processes (also lowers io priority), 0 to run at normal priority.
+FINALIZE_NICE = int(config.get("FINALIZE_NICE", "10"))
+# Drive uploads: chunk size (rounded to 256KB), retries per chunk and parallel uploads.
+UPLOAD_CHUNK_MB = float(config.get("UPLOAD_CHUNK_MB", "8"))
+UPLOAD_RETRIES = int(config.get("UPLOAD_RETRIES", "8"))
+UPLOAD_CONCURRENCY = int(config.get("UPLOAD_CONCURRENCY", "2"))
+# Cut recordings into parts every ROTATE_MINUTES and/or ROTATE_MB of decoded audio, 0 to disable.
+# Closed parts are finalized and uploaded in the background while recording goes on.
+ROTATE_MINUTES = float(config.get("ROTATE_MINUTES", "0"))
+ROTATE_MB = int(config.get("ROTATE_MB", "0"))
+# Seconds to wait for late audio before a part is closed.
+ROTATE_GRACE = float(config.get("ROTATE_GRACE", "10"))
+# Serve Prometheus metrics on http://127.0.0.1:METRICS_PORT/metrics, 0 to disable.
+METRICS_PORT = int(config.get("METRICS_PORT", "0"))
+# Folder to write a packet capture of every recording to (for bench.py --replay), empty to disable.
+PACKET_CAPTURE_PATH = config.get("PACKET_CAPTURE_PATH", "")
 
 # Setup
 intents = discord.Intents.default()
@@ -35,16 +103,42 @@ bot = commands.Bot(command_prefix="!", intents=intents)
 
 # vars
 connections = {}
-# Keep recording True to block until the bot is ready to record.
-processing = False
-recording = True
-ready = False
+# Running recordings, nothing can be recorded until on_ready is done.
+sessions = SessionManager(
+    max_sessions=MAX_SESSIONS,
+    max_mb_in_mem=MAX_MB_IN_MEM,
+    max_mb_before_flush=MAX_MB_BEFORE_FLUSH,
+    max_disk_mb=SESSION_MAX_DISK_MB,
+    encoder_workers=ENCODER_WORKERS,
+    finalize_workers=FINALIZE_WORKERS,
+    spooler_options=dict(
+        cpu_high=DEFER_LOAD_HIGH,
+        cpu_low=DEFER_LOAD_LOW,
+        queue_high=DEFER_QUEUE_HIGH,
+        queue_low=DEFER_QUEUE_LOW,
+        max_bytes=DEFER_MAX_MB * 1024 * 1024,
+    )
+    if DEFERRED_ENCODING
+    else None,
+)
 user_volumes = {}
+# Closed parts of rotating recordings, (session, part), see finalize_parts.
+part_queue = asyncio.Queue()
+finalize_task = None
+# Startup work that runs next to recordings, kept so the tasks aren't garbage collected.
+upload_task = None
+recovery_task = None
 
 gdrive = GoogleDriveUploader(
     token_file=f"{GDRIVE_SECRETS_DIR}/token.json",
+    sessions_file=f"{GDRIVE_SECRETS_DIR}/upload_sessions.json",
+    chunk_mb=UPLOAD_CHUNK_MB,
+    retries=UPLOAD_RETRIES,
 )
 
+if METRICS_PORT:
+    metrics.serve_metrics(METRICS_PORT)
+
 # load user volumes
 try:
     if os.path.exists("user_volumes.txt"):
@@ -68,31 +162,48 @@ def remove_files(files):
             pass
 
 
-def zip_protect(fn: str):
+def zip_args(fn: str, extra_files=(), from_stdin=False):
     """
-    Zips a file with a password. (7z)
+    7z args to zip fn with a password.
+    With from_stdin, the content of fn is read from stdin instead (fn doesn't need to exist).
     """
     z_name = os.path.splitext(fn)[0]
-    args = ["7z", "a", f"-p{ZIP_PASSWORD}", f"{z_name}.7z", fn]
-    try:
-        process = subprocess.Popen(
-            args,
-            stdout=subprocess.PIPE,
-            stdin=subprocess.PIPE,
-        )
-    except FileNotFoundError:
-        raise ValueError("zip was not found.") from None
-    except subprocess.SubprocessError as exc:
-        raise ValueError(
-            "Popen failed: {0.__class__.__name__}: {0}".format(exc)
-        ) from exc
-
-    while process.poll() is None:
-        time.sleep(0.1)
-        pass
-
-    if process.returncode == 0:
-        return f"{z_name}.7z"
+    if from_stdin:
+        return f"{z_name}.7z", [
+            "7z",
+            "a",
+            f"-p{ZIP_PASSWORD}",
+            f"-si{os.path.basename(fn)}",
+            f"{z_name}.7z",
+        ]
+    return f"{z_name}.7z", [
+        "7z",
+        "a",
+        f"-p{ZIP_PASSWORD}",
+        f"{z_name}.7z",
+        fn,
+        *extra_files,
+    ]
+
+
+def zip_protect(fn: str, extra_files=()):
+    """
+    Zips a file with a password. (7z)
+    extra_files are added to the same archive.
+    """
+    z_fn, args = zip_args(fn, extra_files)
+    if run_process(args, name="7z", log_args=False):
+        return z_fn
+    return None
+
+
+async def zip_protect_async(fn: str, extra_files=()):
+    """
+    Async version of zip_protect, doesn't block the event loop.
+    """
+    z_fn, args = zip_args(fn, extra_files)
+    if await run_process_async(args, name="7z", log_args=False):
+        return z_fn
     return None
 
 
@@ -105,85 +216,669 @@ async def is_correct_channel(ctx):
     return str(ctx.channel.id) in CHANNEL_IDS
 
 
-async def finished_callback(sink: MemoryConsiousMP3Sink, channel: discord.TextChannel):
-    global processing, recording
-    processing = True
-    await channel.send(
-        "Starting processing... (this may take a while/bot may be unresponsive)"
+def get_combined_fn(sink: MemoryConsiousMP3Sink, current_date: str):
+    if sink.rotating:
+        ext = get_profile(sink.output_profile).extension
+        return f"{sink.output_folder}/{part_label(sink, sink.open_part)}.{ext}"
+    return combined_fn(
+        sink.output_folder, getattr(sink, "output_fn", None), sink.output_profile, current_date
     )
 
-    # FIXME: make ffmpeg calls properly async
-    while sink.any_threads_alive():
-        # wait for threads to finish
-        await asyncio.sleep(1)
-    current_date = datetime.now().strftime("%Y-%m-%d_%H.%M.%S")
-    combind_fn = None
-    if hasattr(sink, "output_fn") and sink.output_fn:
-        combind_fn = f"{OUTPUT_PATH}/{sink.output_fn}.mp3"
-    else:
-        combind_fn = f"{OUTPUT_PATH}/combined-{current_date}.mp3"
 
+def combined_fn(folder: str, name: str, profile: str, current_date: str):
+    ext = get_profile(profile).extension
+    if name:
+        return f"{folder}/{name}.{ext}"
+    return f"{folder}/combined-{current_date}.{ext}"
+
+
+def has_files(folder: str):
+    """
+    Whether there's any file in folder or its subfolders (sessions leave their empty folders behind).
+    """
+    return any(files for _, _, files in os.walk(folder))
+
+
+def part_label(sink: MemoryConsiousMP3Sink, index: int):
+    """
+    Name of a part of a rotating recording, e.g. combined-2024-01-01_12.00.00-part001.
+    """
+    name = getattr(sink, "output_fn", None) or "combined"
+    return f"{name}-{sink.started.strftime('%Y-%m-%d_%H.%M.%S')}-part{index + 1:03d}"
+
+
+def user_track_fn(folder: str, user_id, label: str, files_on_disk: list):
+    """
+    Combined track of a user, same format as their segments.
+    """
+    ext = os.path.splitext(files_on_disk[0])[1] if files_on_disk else ".mp3"
+    return f"{folder}/{user_id}-{label}{ext}"
+
+
+async def combine_user_files(user_id, files_on_disk: list, label: str, folder: str) -> bool:
+    """
+    Combines the segments of one user into a single track in folder, when a finalize slot is free.
+    """
+    async with sessions.finalize_slots:
+        tmp_fn = f"{folder}/temp_combine_{user_id}-{label}.txt"
+        try:
+            success = await combine_mp3_files_async(
+                # for this specifically we need to strip off the prepended output folder
+                files_on_disk,
+                user_track_fn(folder, user_id, label, files_on_disk),
+                tmp_fn,
+                folder,
+                niceness=FINALIZE_NICE,
+            )
+        except (ValueError, OSError) as e:
+            print(f"Combining files of {user_id} failed: {e}")
+            success = False
+        remove_files([tmp_fn])
+    if success:
+        remove_files(files_on_disk)
+    return success
+
+
+async def combine_users(
+    user_files: dict,
+    channel: discord.TextChannel,
+    label: str,
+    folder: str,
+):
+    """
+    Combines the segments of each user (user_id -> [fn]) into a track in folder.
+    Returns the tracks to overlay (path -> volume), None if we should stop processing.
+    """
     await channel.send("Combining audio files of individual users...")
-    tmp_files = []
-    for user_id, audio in sink.audio_data.items():
-        files_on_disk = list(audio.get_actual_files())
-        tmp_files.append(f"{OUTPUT_PATH}/temp_combine_{user_id}.txt")
-        success = combine_mp3_files(
-            # for this specifically we need to strip off the prepended output folder
-            files_on_disk,
-            f"{OUTPUT_PATH}/{user_id}-{current_date}.mp3",
-            f"{OUTPUT_PATH}/temp_combine_{user_id}.txt",
-            OUTPUT_PATH,
+    user_ids = list(user_files.keys())
+    with metrics.FINALIZE_SECONDS.time("combine"):
+        results = await asyncio.gather(
+            *[
+                combine_user_files(user_id, user_files[user_id], label, folder)
+                for user_id in user_ids
+            ]
         )
-        if not success:
+    failed = [user_id for user_id, success in zip(user_ids, results) if not success]
+    if failed:
+        mentions = []
+        for user_id in failed:
             user = await bot.fetch_user(user_id)
-            await channel.send(
-                f"Failed to combine audio files for {user.mention}! Stopping the process..."
-            )
-            remove_files(tmp_files)
-            return
-        else:
-            remove_files(files_on_disk)
-    remove_files(tmp_files)
-
-    await channel.send("Overlaying audio files...")
+            mentions.append(user.mention)
+        await channel.send(
+            f"Failed to combine audio files for {', '.join(mentions)}! Their files are kept on the bot server."
+        )
+        if len(failed) == len(user_ids):
+            await channel.send("Nothing left to overlay. Stopping the process...")
+            return None
 
     inp = {}
 
-    for user_id in sink.audio_data.keys():
-        file_path = f"{OUTPUT_PATH}/{user_id}-{current_date}.mp3"
-        if user_volumes.get(user_id, None):
-            inp[file_path] = user_volumes[user_id]
-        else:
-            inp[file_path] = 100
+    for user_id in user_ids:
+        if user_id in failed:
+            continue
+        file_path = user_track_fn(folder, user_id, label, user_files[user_id])
+        # 0 mutes them, same as in the live mix.
+        inp[file_path] = user_volumes.get(user_id, 100)
+    return inp
+
+
+async def overlay_and_zip(
+    inp: dict[str, int],
+    channel: discord.TextChannel,
+    combind_fn: str,
+    extra_files=(),
+    profile: str = OUTPUT_PROFILE,
+):
+    """
+    Overlays the tracks into combind_fn (encoded with the codec profile) and zips it with password,
+    extra_files go into the archive too.
+    With PIPELINED_FINALIZE the overlay is piped straight into 7z, so the combined mp3 never hits the disk
+    and encoding/compressing run at the same time (not with the pcm engine).
+    Returns the archive, None if it failed.
+    """
+    if PIPELINED_FINALIZE and FINALIZE_ENGINE != "pcm" and len(inp) > 1 and not extra_files:
+        await channel.send("Overlaying audio files and zipping with password...")
+        z_fn, z_args = zip_args(combind_fn, from_stdin=True)
+        try:
+            async with sessions.finalize_slots:
+                with metrics.FINALIZE_SECONDS.time("overlay_zip"):
+                    success = await run_pipeline_async(
+                        overlay_args(inp, "pipe:1", output_format=profile),
+                        z_args,
+                        names=("ffmpeg", "7z"),
+                        log_args=(True, False),
+                        niceness=FINALIZE_NICE,
+                    )
+        except ValueError as e:
+            print(e)
+            success = False
+        if not success:
+            await channel.send("Failed to overlay/zip audio files! Stopping the process...")
+            remove_files([z_fn])
+            return None
+        remove_files(inp.keys())
+        return z_fn
 
-    success = overlay_mp3_files(
-        inp,
-        combind_fn,
-    )
+    await channel.send("Overlaying audio files...")
+    async with sessions.finalize_slots:
+        with metrics.FINALIZE_SECONDS.time("overlay"):
+            if FINALIZE_ENGINE == "pcm":
+                success = await mix_sources_async(
+                    {fn: ([fn], volume) for fn, volume in inp.items()},
+                    combind_fn,
+                    os.path.dirname(combind_fn),
+                    niceness=FINALIZE_NICE,
+                    output_format=profile,
+                )
+            else:
+                success = await overlay_mp3_files_async(
+                    inp,
+                    combind_fn,
+                    output_format=profile,
+                )
     if not success:
         await channel.send("Failed to overlay audio files! Stopping the process...")
     else:
-        remove_files(inp.keys())
+        # extra files are still needed for the archive
+        remove_files([fn for fn in inp.keys() if fn not in extra_files])
 
     await channel.send("Done overlay! Zipping with password...")
+    async with sessions.finalize_slots:
+        with metrics.FINALIZE_SECONDS.time("zip"):
+            combined_zip_fn = await zip_protect_async(combind_fn, extra_files)
+    if combined_zip_fn is None:
+        # Keep the files, they're all there is of the recording.
+        await channel.send("Failed to zip audio files! The files are left in the output folder.")
+        return None
+    remove_files([combind_fn, *extra_files])
+    return combined_zip_fn
+
+
+async def build_opus_tracks(
+    packet_files: dict, channel: discord.TextChannel, current_date: str, folder: str
+) -> dict:
+    """
+    Builds a time-aligned Ogg/Opus track per user in folder from their packet files (user_id -> fn, no re-encoding).
+    Returns user_id -> track file.
+    """
+    await channel.send("Building audio tracks of individual users...")
+    # Everyone's track starts at the first packet of anyone (sync_start).
+    start_times = [first_receive_time(fn) for fn in packet_files.values()]
+    session_start = min([t for t in start_times if t is not None], default=None)
+
+    tracks = {}
+    for user_id, packet_fn in packet_files.items():
+        track_fn = f"{folder}/{user_id}-{current_date}.ogg"
+        try:
+            async with sessions.finalize_slots:
+                with metrics.FINALIZE_SECONDS.time("build_tracks"):
+                    n = await asyncio.to_thread(
+                        build_ogg_track, packet_fn, track_fn, session_start
+                    )
+        except (ValueError, OSError) as e:
+            print(f"Building the track of {user_id} failed: {e}")
+            continue
+        if n:
+            tracks[user_id] = track_fn
+        remove_files([packet_fn])
+    return tracks
+
+
+def upload_progress(message: discord.Message, interval=10):
+    """
+    Progress callback for uploads, edits message at most every interval seconds.
+    Uploads run in an executor, so the edit is handed back to the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    last = {}
+
+    def progress(file_path, done, total):
+        now = time.monotonic()
+        if done < total and now - last.get(file_path, 0) < interval:
+            return
+        last[file_path] = now
+        asyncio.run_coroutine_threadsafe(
+            message.edit(
+                content=f"Uploading {os.path.basename(file_path)}... {done * 100 // max(1, total)}%"
+            ),
+            loop,
+        )
 
-    combined_zip_fn = zip_protect(combind_fn)
-    remove_files([combind_fn])
+    return progress
 
-    file_id = gdrive.upload_resumable(combined_zip_fn, OUTPUT_G_FOLDER_ID)
 
-    if file_id:
-        remove_files([combined_zip_fn])
-        await channel.send(f"Uploaded to Google Drive!")
+async def upload_files(files: dict[str, str], channel: discord.TextChannel):
+    """
+    Uploads files (file path -> folder id) to Google Drive, uploaded files are removed.
+    Returns True if all of them made it.
+    """
+    message = await channel.send(f"Uploading {len(files)} file(s) to Google Drive...")
+    with metrics.FINALIZE_SECONDS.time("upload"):
+        ids = await gdrive.upload_many_async(
+            files, concurrency=UPLOAD_CONCURRENCY, progress=upload_progress(message)
+        )
+    uploaded = [fn for fn, file_id in ids.items() if file_id]
+    remove_files(uploaded)
+    return len(uploaded) == len(files)
+
+
+def finish_journal(journal: SegmentJournal, require_stopped=True):
+    """
+    Removes the journal once every part of its session is uploaded.
+    """
+    if journal is None or not os.path.exists(journal.path):
+        return
+    session = JournalSession(journal.path)
+    if not session.unfinished_parts() and (session.stopped or not require_stopped):
+        journal.remove()
+
+
+async def finalize_segments(
+    user_files: dict,
+    channel: discord.TextChannel,
+    label: str,
+    combind_fn: str,
+    journal: SegmentJournal = None,
+    part: int = 0,
+    profile: str = OUTPUT_PROFILE,
+):
+    """
+    Combines the segments of each user, overlays and zips them, logging each step in the journal.
+    The users' tracks go next to combind_fn.
+    Returns the archive, None if it failed.
+    """
+    if FINALIZE_ENGINE == "pcm":
+        return await mix_segments_and_zip(
+            user_files, channel, combind_fn, journal, part, profile
+        )
+    inp = await combine_users(user_files, channel, label, os.path.dirname(combind_fn))
+    if inp is None:
+        return None
+    if journal is not None:
+        journal.append("combined", part=part, tracks=inp, extra_files=[])
+    zip_fn = await overlay_and_zip(inp, channel, combind_fn, profile=profile)
+    if zip_fn is not None and journal is not None:
+        journal.append("finalized", part=part, archive=zip_fn)
+    return zip_fn
+
+
+async def mix_segments_and_zip(
+    user_files: dict,
+    channel: discord.TextChannel,
+    combind_fn: str,
+    journal: SegmentJournal = None,
+    part: int = 0,
+    profile: str = OUTPUT_PROFILE,
+):
+    """
+    The pcm engine: mixes the segments of all users straight into combind_fn, no per-user tracks in between.
+    Segments are only removed once the mix is done, so a failed/crashed mix can be redone from them.
+    The finished mix is journaled first, so if zipping fails/crashes recovery zips it.
+    Returns the archive, None if it failed.
+    """
+    await channel.send("Mixing audio files of individual users...")
+    sources = {
+        user_id: (files, user_volumes.get(user_id, 100))
+        for user_id, files in user_files.items()
+    }
+    async with sessions.finalize_slots:
+        with metrics.FINALIZE_SECONDS.time("mix"):
+            success = await mix_sources_async(
+                sources,
+                combind_fn,
+                os.path.dirname(combind_fn),
+                niceness=FINALIZE_NICE,
+                output_format=profile,
+            )
+    if not success:
+        await channel.send("Failed to mix audio files! Their files are kept on the bot server.")
+        remove_files([combind_fn])
+        return None
+    if journal is not None:
+        # The mix is the part's only track now, recovery zips it if we don't get to that.
+        journal.append(
+            "combined", part=part, tracks={combind_fn: 100}, extra_files=[], mixed=True
+        )
+    remove_files([fn for files in user_files.values() for fn in files])
+
+    await channel.send("Done mixing! Zipping with password...")
+    async with sessions.finalize_slots:
+        with metrics.FINALIZE_SECONDS.time("zip"):
+            zip_fn = await zip_protect_async(combind_fn)
+    if zip_fn is not None:
+        # The segments are gone, so keep the mix if zipping failed.
+        remove_files([combind_fn])
+    if zip_fn is not None and journal is not None:
+        journal.append("finalized", part=part, archive=zip_fn)
+    return zip_fn
+
+
+async def upload_archive(
+    zip_fn: str,
+    channel: discord.TextChannel,
+    journal: SegmentJournal = None,
+    part: int = 0,
+    require_stopped=True,
+) -> bool:
+    """
+    Uploads an archive to the output folder on Google Drive, and marks the part as uploaded in the journal.
+    """
+    if not await upload_files({zip_fn: OUTPUT_G_FOLDER_ID}, channel):
+        return False
+    if journal is not None:
+        journal.append("uploaded", part=part)
+        finish_journal(journal, require_stopped)
+    return True
+
+
+async def finalize_part(
+    channel: discord.TextChannel, sink: MemoryConsiousMP3Sink, part: RecordingPart
+):
+    """
+    Combines, overlays, zips and uploads a closed part of a rotating recording.
+    """
+    await asyncio.to_thread(part.wait_encoded)
+    user_files = part.get_actual_files()
+    if not user_files:
+        return
+    label = part_label(sink, part.index)
+    await channel.send(f"Finalizing part {part.index + 1} of the recording...")
+    zip_fn = await finalize_segments(
+        user_files,
+        channel,
+        label,
+        f"{sink.output_folder}/{label}.{get_profile(sink.output_profile).extension}",
+        sink.journal,
+        part.index,
+        sink.output_profile,
+    )
+    if zip_fn is None:
+        await channel.send(
+            f"Zipping part {part.index + 1} failed! Nothing to upload, files are on bot server."
+        )
+    elif await upload_archive(zip_fn, channel, sink.journal, part.index):
+        await channel.send(f"Part {part.index + 1} uploaded to Google Drive!")
+    else:
+        await channel.send(
+            f"Failed to upload part {part.index + 1} to Google Drive! File is on bot server."
+        )
+
+
+async def finalize_parts():
+    """
+    Background worker, finalizes the closed parts of rotating recordings one at a time.
+    """
+    while True:
+        session, part = await part_queue.get()
+        try:
+            await finalize_part(session.channel, session.sink, part)
+        except Exception as e:
+            print(f"Finalizing part {part.index + 1} failed: {e}")
+        finally:
+            session.parts_pending -= 1
+            part_queue.task_done()
+
+
+def queue_part(session: RecordingSession, part: RecordingPart):
+    """
+    Hands a closed part to finalize_parts, call it on the event loop.
+    """
+    session.parts_pending += 1
+    part_queue.put_nowait((session, part))
+
+
+async def encode_spooled_segments(part, journal: SegmentJournal):
+    """
+    Encodes the segments of a crashed part that were still spooled (deferred encoding), then removes their pcm.
+    """
+    for record in part.unencoded_spools():
+        print(f"Encoding spooled segment {record['fn']}...")
+        try:
+            async with sessions.finalize_slots:
+                success = await asyncio.to_thread(
+                    encode_pcm_file,
+                    record["spool"],
+                    record["bytes"],
+                    record["fn"],
+                    record.get("gaps"),
+                    record.get("format", "mp3"),
+                )
+        except Exception as e:
+            print(f"Could not encode spooled segment {record['fn']}: {e}")
+            continue
+        if success and os.path.exists(record["fn"]):
+            part.done.add(record["fn"])
+            journal.append(
+                "segment",
+                user=record["user"],
+                fn=record["fn"],
+                part=part.index,
+                bytes=os.path.getsize(record["fn"]),
+            )
+            remove_files([record["spool"]])
+
+
+async def recover_part(
+    session: JournalSession, part, journal: SegmentJournal, channel: discord.TextChannel
+):
+    """
+    Picks up a part of a crashed session where it stopped: upload, overlay/zip, or combine from the segments.
+    Returns the archive, None if it couldn't be finalized.
+    """
+    name = session.info.get("name") or "combined"
+    started = session.info.get("started", "unknown")
+    if session.info.get("rotating"):
+        label = f"{name}-{started}-part{part.index + 1:03d}"
+    else:
+        label = f"{name}-{started}-recovered"
+    # Recordings from before sessions had their own folder were in OUTPUT_PATH.
+    folder = session.info.get("folder", OUTPUT_PATH)
+    os.makedirs(folder, exist_ok=True)
+    profile = session.info.get("profile", "mp3")
+    combind_fn = f"{folder}/{label}.{get_profile(profile).extension}"
+
+    if part.archive and os.path.exists(part.archive):
+        return part.archive
+    if part.mixed and part.has_tracks():
+        # A finished mix of the pcm engine, only zipping was left.
+        mix_fn = next(iter(part.tracks))
+        zip_fn = await zip_protect_async(mix_fn)
+        if zip_fn is not None:
+            remove_files([mix_fn])
+    elif part.has_tracks():
+        zip_fn = await overlay_and_zip(
+            part.tracks, channel, combind_fn, extra_files=part.extra_files, profile=profile
+        )
+    elif part.index == 0 and session.mix and os.path.exists(session.mix):
+        zip_fn = await zip_protect_async(session.mix)
+        if zip_fn is not None:
+            remove_files([session.mix])
+    elif session.info.get("capture") == "opus":
+        packet_files = {
+            user_id: fns[0] for user_id, fns in part.get_actual_files().items()
+        }
+        tracks = await build_opus_tracks(packet_files, channel, label, folder)
+        if not tracks:
+            return None
+        inp = {fn: user_volumes.get(user_id, 100) for user_id, fn in tracks.items()}
+        journal.append("combined", part=part.index, tracks=inp, extra_files=list(tracks.values()))
+        zip_fn = await overlay_and_zip(
+            inp, channel, combind_fn, extra_files=list(tracks.values()), profile=profile
+        )
     else:
-        await channel.send("Failed to upload to Google Drive! File is on bot server.")
+        await encode_spooled_segments(part, journal)
+        return await finalize_segments(
+            part.get_actual_files(), channel, label, combind_fn, journal, part.index, profile
+        )
+    if zip_fn is not None:
+        journal.append("finalized", part=part.index, archive=zip_fn)
+    return zip_fn
+
+
+async def resume_uploads(files: dict[str, str], channels: list[discord.TextChannel]):
+    """
+    Continues the uploads that were interrupted by a restart.
+    """
+    for channel in channels:
+        await channel.send(f"Continuing {len(files)} unfinished upload(s)...")
+    if await upload_files(files, channels[0]):
+        await channels[0].send("Unfinished uploads are done!")
+
+
+async def recover_sessions(channel: discord.TextChannel):
+    """
+    Finalizes and uploads the sessions that have a journal left in the output folder (crashed recordings).
+    Their archives are left out of the resumed uploads (see on_ready), recovery owns them:
+    an archive without an uploaded record is uploaded here, upload_resumable continues its stored session.
+    """
+    for path in find_journals(OUTPUT_PATH):
+        session = JournalSession(path)
+        parts = session.unfinished_parts()
+        journal = SegmentJournal(path)
+        if not parts:
+            finish_journal(journal, require_stopped=False)
+            continue
+        await channel.send(
+            f"Recovering an unfinished recording from {session.info.get('started', 'unknown')} ({len(parts)} part(s))..."
+        )
+        for part in parts:
+            try:
+                zip_fn = await recover_part(session, part, journal, channel)
+            except Exception as e:
+                print(f"Recovering part {part.index + 1} of {path} failed: {e}")
+                zip_fn = None
+            if zip_fn is None:
+                await channel.send(
+                    f"Could not recover part {part.index + 1}, files are kept on the bot server."
+                )
+            elif await upload_archive(
+                zip_fn, channel, journal, part.index, require_stopped=False
+            ):
+                await channel.send(f"Recovered part {part.index + 1} and uploaded it to Google Drive!")
+            else:
+                await channel.send(
+                    f"Failed to upload recovered part {part.index + 1}! File is on bot server."
+                )
+        journal.close()
+
+
+async def session_ticker(session: RecordingSession, interval=5):
+    """
+    Closes due parts while nobody is talking (the sink only checks on writes otherwise),
+    and stops the recording when it goes over its disk budget.
+    """
+    sink = session.sink
+    while not sink.finished:
+        await asyncio.sleep(interval)
+        if sink.rotating:
+            await asyncio.to_thread(sink.rotate_if_due)
+        if sessions.max_disk_mb and session.vc.recording:
+            if await asyncio.to_thread(sessions.over_disk_budget, session):
+                session.stop_reason = f"it went over its disk budget of {sessions.max_disk_mb}MB"
+                try:
+                    session.vc.stop_recording()
+                except RecordingException:
+                    pass
+
+
+async def finished_callback(sink: MemoryConsiousMP3Sink, session: RecordingSession):
+    sessions.stopped(session)
+    try:
+        await finalize_session(sink, session)
+    finally:
+        sessions.done(session)
 
-    # For sanity
-    sink.cleanup_no_flush()
 
-    recording = False
-    processing = False
+async def finalize_session(sink: MemoryConsiousMP3Sink, session: RecordingSession):
+    channel = session.channel
+    if session.stop_reason:
+        await channel.send(f"Stopped recording, {session.stop_reason}.")
+    await channel.send("Starting processing... (this may take a while)")
+
+    while sink.any_threads_alive():
+        # wait for threads to finish
+        await asyncio.sleep(1)
+    journal = sink.journal
+    try:
+        if journal is not None:
+            journal.append("stopped")
+        part = sink.open_part if sink.rotating else 0
+        current_date = datetime.now().strftime("%Y-%m-%d_%H.%M.%S")
+        if sink.mixer is not None:
+            # The live mix already is the combined file.
+            combind_fn = sink.mixer.fn
+            await channel.send("Live mix is done! Zipping with password...")
+            async with sessions.finalize_slots:
+                with metrics.FINALIZE_SECONDS.time("zip"):
+                    combined_zip_fn = await zip_protect_async(combind_fn)
+            if combined_zip_fn is not None:
+                remove_files([combind_fn])
+                if journal is not None:
+                    journal.append("finalized", part=part, archive=combined_zip_fn)
+        elif isinstance(sink, OpusPacketSink):
+            combind_fn = get_combined_fn(sink, current_date)
+            packet_files = {
+                user_id: fn
+                for user_id, audio in sink.audio_data.items()
+                for fn in audio.get_actual_files()
+            }
+            tracks = await build_opus_tracks(
+                packet_files, channel, current_date, sink.output_folder
+            )
+            if not tracks:
+                await channel.send("No audio tracks could be built! Stopping the process...")
+                return
+            inp = {fn: user_volumes.get(user_id, 100) for user_id, fn in tracks.items()}
+            if journal is not None:
+                journal.append(
+                    "combined", part=part, tracks=inp, extra_files=list(tracks.values())
+                )
+            # Lossless per-user tracks go into the archive too.
+            combined_zip_fn = await overlay_and_zip(
+                inp,
+                channel,
+                combind_fn,
+                extra_files=list(tracks.values()),
+                profile=sink.output_profile,
+            )
+            if combined_zip_fn is not None and journal is not None:
+                journal.append("finalized", part=part, archive=combined_zip_fn)
+        else:
+            combind_fn = get_combined_fn(sink, current_date)
+            # With rotation, only the last part is left here.
+            user_files = {
+                user_id: files
+                for user_id, audio in sink.audio_data.items()
+                if (files := list(audio.get_actual_files()))
+            }
+            if not user_files:
+                await channel.send("Nothing left to finalize in the last part.")
+                finish_journal(journal)
+                sink.cleanup_no_flush()
+                return
+            label = part_label(sink, sink.open_part) if sink.rotating else current_date
+            combined_zip_fn = await finalize_segments(
+                user_files, channel, label, combind_fn, journal, part, sink.output_profile
+            )
+
+        if combined_zip_fn is None:
+            await channel.send("Zipping failed! Nothing to upload, files are on bot server.")
+        elif await upload_archive(combined_zip_fn, channel, journal, part):
+            await channel.send(f"Uploaded to Google Drive!")
+        else:
+            await channel.send(
+                "Failed to upload to Google Drive! File is on bot server, the upload continues after a restart."
+            )
+
+        # For sanity
+        sink.cleanup_no_flush()
+    finally:
+        if journal is not None:
+            # Earlier parts might still be finalizing, they log to the journal too.
+            while session.parts_pending:
+                await asyncio.sleep(1)
+            # Also after the early returns, finish_journal might have removed it already.
+            journal.close()
 
 
 # events
@@ -197,21 +892,36 @@ async def on_ready():
     global gdrive
     succes = await gdrive.init_auth(channels)
     if not succes:
-        # Dont update the recording flag, we can't record without GDrive.
+        # Don't mark the sessions ready, we can't record without GDrive.
         return
 
+    # on_ready also fires on reconnects, only recover once (a journal might belong to the running recording).
+    global finalize_task
+    if finalize_task is not None:
+        return
+    finalize_task = asyncio.create_task(finalize_parts())
+
+    # Continue uploads that were interrupted by a restart, in the background so recording doesn't wait for them.
+    global upload_task, recovery_task
+    # Archives of crashed recordings are uploaded by their recovery, which also marks them uploaded in the journal.
+    pending = gdrive.pending_uploads(skip=journaled_archives(OUTPUT_PATH))
+    if pending:
+        upload_task = asyncio.create_task(resume_uploads(pending, channels))
+
     # Check if the output folder exists and is empty
     if not os.path.exists(OUTPUT_PATH):
         os.makedirs(OUTPUT_PATH)
+    elif find_journals(OUTPUT_PATH):
+        # Crashed recordings, put them back together in the background.
+        recovery_task = asyncio.create_task(recover_sessions(channels[0]))
     else:
         # if files are present, alert the channel
-        if os.listdir(OUTPUT_PATH):
+        if has_files(OUTPUT_PATH):
             for channel in channels:
                 await channel.send(
                     "The output folder is not empty, perhaps a previous recording was not finished correctly?"
                 )
-    global recording
-    recording = False
+    sessions.ready = True
 
 
 @bot.event
@@ -251,20 +961,16 @@ async def join(ctx: discord.ApplicationContext):
 
     await voice.channel.connect(cls=MemoryConciousVoiceClient)
 
-    global ready
-    ready = True
-
     await ctx.send("Joined!")
 
 
 @bot.command()
-async def start(ctx: discord.ApplicationContext, name: str = None):
-    """Record the voice channel! Optional argument: <name>."""
-    global recording, ready
-
-    if not ready:
-        return await ctx.send("I'm not in a vc yet, maybe you were too fast?")
-
+async def start(ctx: discord.ApplicationContext, name: str = None, profile: str = None):
+    """Record the voice channel! Optional arguments: <name> <profile>, see !profiles."""
+    try:
+        profile = get_profile(profile).name if profile else OUTPUT_PROFILE
+    except ValueError as e:
+        return await ctx.send(str(e))
     voice = ctx.author.voice
 
     if not voice:
@@ -275,33 +981,147 @@ async def start(ctx: discord.ApplicationContext, name: str = None):
     if not vc:
         return await ctx.send("I'm not in a vc right now. Use `!join` to make me join!")
 
-    if recording and vc.recording and not processing:
-        return await ctx.send(
-            "I'm already recording in another channel! Can't record in multiple channels at once."
+    reason = sessions.cannot_start(ctx.guild.id, OUTPUT_PATH)
+    if reason is None and vc.recording:
+        reason = "I'm already recording in this server!"
+    if reason is not None:
+        return await ctx.send(reason)
+
+    # Every server records into its own folder, so names can't clash.
+    folder = f"{OUTPUT_PATH}/{ctx.guild.id}"
+    sink_cls = OpusPacketSink if CAPTURE_FORMAT == "opus" else MemoryConsiousMP3Sink
+    # Parts are cut from flushed segments, streaming/live mix/opus capture don't have those.
+    can_rotate = (
+        sink_cls is MemoryConsiousMP3Sink and not STREAMING_ENCODER and not LIVE_MIX
+    )
+    tap = PCMTap()
+    mixer = None
+    # Mixing needs decoded audio, so not for opus capture.
+    if LIVE_MIX and sink_cls is MemoryConsiousMP3Sink:
+        current_date = datetime.now().strftime("%Y-%m-%d_%H.%M.%S")
+        os.makedirs(folder, exist_ok=True)
+        mixer = LiveMixer(
+            combined_fn(folder, name, profile, current_date),
+            user_volumes,
+            output_format=profile,
+            tap=tap,
         )
+    sink = sink_cls(
+        max_before_flush=sessions.max_mb_before_flush,
+        max_size_mb=sessions.max_mb_in_mem,
+        output_folder=folder,
+        output_fn=name,
+        streaming=STREAMING_ENCODER,
+        buffer_backend=PCM_BUFFER,
+        segment_format=SEGMENT_FORMAT or profile,
+        output_profile=profile,
+        encoder_pool=sessions.encoder_pool,
+        spooler=sessions.spooler,
+        mixer=mixer,
+        tap=tap,
+        rotate_seconds=ROTATE_MINUTES * 60 if can_rotate else 0,
+        rotate_mb=ROTATE_MB if can_rotate else 0,
+        rotate_grace=ROTATE_GRACE,
+        on_part_closed=lambda part: bot.loop.call_soon_threadsafe(queue_part, session, part),
+        journal=SegmentJournal(
+            f"{OUTPUT_PATH}/journal-{datetime.now().strftime('%Y%m%d%H%M%S%f')}.jsonl"
+        ),
+    )
+    sink.journal.append(
+        "session",
+        name=name,
+        started=sink.started.strftime("%Y-%m-%d_%H.%M.%S"),
+        channel=ctx.channel.id,
+        guild=ctx.guild.id,
+        folder=folder,
+        rotating=sink.rotating,
+        capture=CAPTURE_FORMAT,
+        profile=profile,
+    )
+    if mixer is not None:
+        sink.journal.append("mix", fn=mixer.fn)
 
-    recording = True
+    capture_fn = None
+    if PACKET_CAPTURE_PATH:
+        os.makedirs(PACKET_CAPTURE_PATH, exist_ok=True)
+        capture_fn = f"{PACKET_CAPTURE_PATH}/capture-{ctx.guild.id}-{datetime.now().strftime('%Y%m%d%H%M%S')}.dvcap"
 
+    session = RecordingSession(ctx.guild.id, ctx.channel, vc, sink, folder)
+    sessions.add(session)
     try:
         vc.start_recording(
-            MemoryConsiousMP3Sink(
-                max_before_flush=MAX_MB_BEFORE_FLUSH,
-                max_size_mb=MAX_MB_IN_MEM,
-                output_folder=OUTPUT_PATH,
-                output_fn=name,
-            ),
+            sink,
             ctx.channel,
             finished_callback,
-            ctx.channel,
+            session,
             sync_start=True,
+            decode_workers=DECODE_WORKERS,
+            capture_fn=capture_fn,
         )
-    except RecordingException:
-        recording = False
+    except Exception as e:
+        # Not just RecordingException (e.g. the capture file can't be opened), the session has to go either way.
+        if not isinstance(e, RecordingException):
+            print(f"Starting the recording failed: {e}")
+        sessions.remove(session)
+        sink.journal.remove()
+        if mixer is not None:
+            # Ends its ffmpeg, the file has nothing in it.
+            mixer.close()
+            remove_files([mixer.fn])
         return await ctx.send(
             "Couldn't start recording. Maybe the bot is already recording/not ready?"
         )
 
-    await ctx.send("The recording has started!")
+    session.ticker = asyncio.create_task(session_ticker(session))
+    if not sink.rotating and (ROTATE_MINUTES or ROTATE_MB):
+        await ctx.send("Rotation only works with segment recording, recording as one part.")
+
+    await ctx.send(f"The recording has started! ({profile})")
+
+
+@bot.command()
+async def levels(ctx: discord.ApplicationContext, seconds: float = 3):
+    """!levels <seconds>. Listens along with the recording and shows how loud everyone is."""
+    session = sessions.get(ctx.guild.id)
+    if session is None:
+        return await ctx.send("I'm not recording in this server right now.")
+    if isinstance(session.sink, OpusPacketSink):
+        return await ctx.send("This recording captures opus packets, there's no audio to listen along with.")
+    seconds = min(max(seconds, 1), 30)
+    peaks = {}
+    squares = {}
+    counts = {}
+    subscription = session.sink.tap.subscribe(maxsize=500)
+    bot.loop.call_later(seconds, subscription.close)
+    async for frame in subscription:
+        # Read straight from the shared frame, no copy (abs of -32768 only fits in a wider int).
+        samples = np.frombuffer(frame.pcm, dtype=np.int16)
+        if not len(samples):
+            continue
+        peaks[frame.user] = max(peaks.get(frame.user, 0), int(np.abs(samples.astype(np.int32)).max()))
+        squares[frame.user] = squares.get(frame.user, 0) + float(np.square(samples, dtype=np.float64).sum())
+        counts[frame.user] = counts.get(frame.user, 0) + len(samples)
+    if not counts:
+        return await ctx.send(f"Nobody talked in the last {seconds:g}s.")
+    lines = []
+    for user_id, n in counts.items():
+        rms = (squares[user_id] / n) ** 0.5
+        rms_db = 20 * np.log10(max(rms, 1) / 32768)
+        peak_db = 20 * np.log10(max(peaks[user_id], 1) / 32768)
+        lines.append(f"<@{user_id}>: {rms_db:.1f} dBFS average, {peak_db:.1f} dBFS peak")
+    if subscription.dropped:
+        lines.append(f"({subscription.dropped} frames skipped, the bot was busy)")
+    await ctx.send("\n".join(lines))
+
+
+@bot.command()
+async def profiles(ctx: discord.ApplicationContext):
+    """List the codec profiles, pick one with !start <name> <profile>."""
+    lines = [
+        f"`{name}`: {p.description}" + (" (default)" if name == OUTPUT_PROFILE else "")
+        for name, p in PROFILES.items()
+    ]
+    await ctx.send("\n".join(lines))
 
 
 @bot.command()
@@ -364,8 +1184,8 @@ async def getvols(ctx: discord.ApplicationContext):
 @bot.command()
 async def resetvols(ctx: discord.ApplicationContext):
     """Reset the edited volumes of the users."""
-    global user_volumes
-    user_volumes = {}
+    # clear in place, a running live mix holds on to this dict.
+    user_volumes.clear()
     # delete the file
     remove_files(["user_volumes.txt"])
     await ctx.send("Volumes reset.")
@@ -374,14 +1194,38 @@ async def resetvols(ctx: discord.ApplicationContext):
 @bot.command()
 async def status(ctx: discord.ApplicationContext):
     """Get the status of the bot."""
-    global recording, processing
-    if processing:
+    session = sessions.get(ctx.guild.id)
+    processing = [s for s in sessions.processing if s.guild_id == ctx.guild.id]
+    others = len(sessions.sessions) - (session is not None)
+    if not sessions.ready:
+        await ctx.send("The bot is still starting up.")
+    elif session is not None:
+        sink = session.sink
+        elapsed = max(1.0, (datetime.now() - sink.started).total_seconds())
+        hours, rest = divmod(int(elapsed), 3600)
+        buffered = sum(sink.buffered_per_user().values())
+        decoder = getattr(session.vc, "decoder", None)
+        received = getattr(decoder, "received", 0)
+        delivered = getattr(session.vc, "delivered", 0)
+        latency = getattr(session.vc, "latency_total", 0.0) / max(1, delivered)
+        await ctx.send(
+            f"The bot is currently recording ({hours}h{rest // 60:02d}m{rest % 60:02d}s, {len(sink.audio_data)} user(s)).\n"
+            f"Buffered: {buffered / 1024 / 1024:.1f}MB, on disk: {await asyncio.to_thread(session.disk_usage) / 1024 / 1024:.0f}MB.\n"
+            f"Packets {received / elapsed:.0f}/s on average, decode latency {latency * 1000:.1f}ms on average.\n"
+            f"All {len(sessions.sessions)} recording(s): decode queue {metrics.DECODE_QUEUE_DEPTH.get()}, "
+            f"encodes pending: {metrics.ENCODES_PENDING.get()}, "
+            f"spooled: {metrics.SPOOLED_BYTES.get() / 1024 / 1024:.0f}MB, "
+            f"waited on encoders for {metrics.ENCODER_WAIT_SECONDS.get():.1f}s.\n"
+            f"Memory: {metrics.RSS_BYTES.get() / 1024 / 1024:.0f}MB."
+        )
+    elif processing:
         await ctx.send("The bot is currently processing a previous recording.")
-    elif recording:
-        await ctx.send("The bot is currently recording.")
-        # TODO: add more info, like the current recording size/length
     else:
-        await ctx.send("The bot is currently not recording.")
+        await ctx.send(
+            f"The bot is currently not recording here ({others} recording(s) in other servers)."
+        )
+    if session is not None and processing:
+        await ctx.send("A previous recording is still being processed too.")
 
 
 # Uncomment to enable quit command, used for debugging/force quitting the bot.
@@ -0,0 +1,86 @@
+import struct
+
+"""
+Packet capture of a voice session, for replaying it offline (see bench.py --replay).
+Every decrypted packet is stored with its receive time (seconds since the capture started),
+together with the ssrc -> user mapping as it was known at that moment.
+"""
+
+CAPTURE_MAGIC = b"DVCP\x01"
+RECORD_PACKET = 0
+RECORD_MAP = 1
+# kind, ssrc, sequence, rtp timestamp, receive time, payload length
+PACKET_HEADER = struct.Struct("<BIHIdH")
+# kind, ssrc, time, user id (0 when the ssrc got unmapped)
+MAP_RECORD = struct.Struct("<BIdQ")
+
+
+class PacketCaptureWriter:
+    """
+    Append-only capture file, written from the receive thread.
+    """
+
+    def __init__(self, fn: str, start_time: float):
+        self.fn = fn
+        self.start_time = start_time
+        # ssrc -> user id as last written.
+        self.mapped = {}
+        self.packets = 0
+        self.file = open(fn, "wb", buffering=256 * 1024)
+        self.file.write(CAPTURE_MAGIC)
+
+    def write_map(self, ssrc: int, user_id, t: float):
+        self.file.write(MAP_RECORD.pack(RECORD_MAP, ssrc, t, user_id or 0))
+        self.mapped[ssrc] = user_id
+
+    def write_packet(self, data, ssrc_map: dict):
+        """
+        Writes a RawData, preceded by a map record when its ssrc's user changed since the last one.
+        """
+        t = data.receive_time - self.start_time
+        user = ssrc_map.get(data.ssrc)
+        user_id = user["user_id"] if user else None
+        if self.mapped.get(data.ssrc) != user_id:
+            self.write_map(data.ssrc, user_id, t)
+        payload = data.decrypted_data or b""
+        self.file.write(
+            PACKET_HEADER.pack(
+                RECORD_PACKET, data.ssrc, data.sequence, data.timestamp, t, len(payload)
+            )
+        )
+        self.file.write(payload)
+        self.packets += 1
+
+    def close(self):
+        self.file.close()
+
+
+def iter_capture(fn: str):
+    """
+    Yields ("map", ssrc, time, user_id or None) and ("packet", ssrc, sequence, timestamp, time, payload).
+    A truncated last record (e.g. after a crash) is skipped.
+    """
+    with open(fn, "rb") as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(f"{fn} is not a packet capture.")
+        while True:
+            kind = f.read(1)
+            if not kind:
+                return
+            if kind[0] == RECORD_MAP:
+                rest = f.read(MAP_RECORD.size - 1)
+                if len(rest) < MAP_RECORD.size - 1:
+                    return
+                _, ssrc, t, user_id = MAP_RECORD.unpack(kind + rest)
+                yield "map", ssrc, t, user_id or None
+            elif kind[0] == RECORD_PACKET:
+                rest = f.read(PACKET_HEADER.size - 1)
+                if len(rest) < PACKET_HEADER.size - 1:
+                    return
+                _, ssrc, sequence, timestamp, t, length = PACKET_HEADER.unpack(kind + rest)
+                payload = f.read(length)
+                if len(payload) < length:
+                    return
+                yield "packet", ssrc, sequence, timestamp, t, payload
+            else:
+                raise ValueError(f"{fn} has an unknown record type {kind[0]}.")
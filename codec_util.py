@@ -0,0 +1,76 @@
+"""
+Codec profiles for everything we encode: segments while recording and the combined track.
+A profile is a name for a container + codec + settings, e.g. SEGMENT_FORMAT="opus32" or `!start name opus32`.
+"mp3" and "flac" are plain ffmpeg defaults, same as before there were profiles.
+"""
+
+
+class CodecProfile:
+    def __init__(self, name: str, extension: str, muxer: str, codec_args=(), description=""):
+        self.name = name
+        # File extension without the dot.
+        self.extension = extension
+        # ffmpeg -f, so it also works when writing to a pipe.
+        self.muxer = muxer
+        self.codec_args = list(codec_args)
+        self.description = description
+
+    def output_args(self) -> list[str]:
+        """
+        ffmpeg output args, go right before the output file.
+        """
+        return [*self.codec_args, "-f", self.muxer]
+
+
+PROFILES = {
+    profile.name: profile
+    for profile in [
+        CodecProfile("mp3", "mp3", "mp3", description="MP3 with ffmpeg's defaults (128 kbps CBR stereo)"),
+        CodecProfile(
+            "mp3-v2", "mp3", "mp3", ["-c:a", "libmp3lame", "-q:a", "2"], "MP3 VBR ~190 kbps stereo"
+        ),
+        CodecProfile(
+            "mp3-v6", "mp3", "mp3", ["-c:a", "libmp3lame", "-q:a", "6"], "MP3 VBR ~115 kbps stereo"
+        ),
+        CodecProfile(
+            "mp3-192", "mp3", "mp3", ["-c:a", "libmp3lame", "-b:a", "192k"], "MP3 CBR 192 kbps stereo"
+        ),
+        CodecProfile(
+            "mp3-64-mono",
+            "mp3",
+            "mp3",
+            ["-c:a", "libmp3lame", "-b:a", "64k", "-ac", "1"],
+            "MP3 CBR 64 kbps mono",
+        ),
+        CodecProfile(
+            "opus32",
+            "opus",
+            "ogg",
+            ["-c:a", "libopus", "-b:a", "32k", "-ac", "1", "-application", "voip"],
+            "Opus 32 kbps mono, cheapest on cpu and disk",
+        ),
+        CodecProfile(
+            "opus64",
+            "opus",
+            "ogg",
+            ["-c:a", "libopus", "-b:a", "64k", "-application", "audio"],
+            "Opus 64 kbps stereo",
+        ),
+        CodecProfile(
+            "aac128", "aac", "adts", ["-c:a", "aac", "-b:a", "128k"], "AAC-LC 128 kbps stereo"
+        ),
+        CodecProfile("flac", "flac", "flac", description="FLAC, lossless (~5x the size of mp3)"),
+    ]
+}
+
+
+def get_profile(name: str) -> CodecProfile:
+    """
+    Looks up a profile by name, raises ValueError with the known names for a typo.
+    """
+    try:
+        return PROFILES[name.lower()]
+    except (KeyError, AttributeError):
+        raise ValueError(
+            f"Unknown codec profile {name!r}, choose from: {', '.join(PROFILES)}."
+        ) from None
@@ -1,64 +1,91 @@
+import asyncio
+import collections
 import io
+import mmap
 import os
+import shutil
 import subprocess
+import sys
+import threading
 import time
 
+from codec_util import get_profile
 
-def combine_mp3_files(files: list[str], fn: str, tmp_fn: str, output_path: str):
+# Raw PCM as we get it from the opus decoder.
+PCM_INPUT_ARGS = ["-f", "s16le", "-ar", "48000", "-ac", "2"]
+# Shared zero buffer, silence gaps are fed to ffmpeg in slices of this instead of being built up.
+SILENCE_CHUNK = bytes(1024 * 1024)
+
+
+def iter_silence(n: int):
     """
-    Combines mp3 files into a single mp3 file.
-    using ffmpeg directly. pydub, again, saves stuff in memory as wav. (yay!)
+    Yields n bytes of silence, in slices of the shared zero buffer.
     """
-    if not files:
-        return False
-    if len(files) == 1:
-        os.rename(files[0], fn)
-        return True
-    files = [x.replace(f"{output_path}/", "") for x in files]
+    zeros = memoryview(SILENCE_CHUNK)
+    while n > 0:
+        chunk = min(n, len(zeros))
+        yield zeros[:chunk]
+        n -= chunk
 
-    with open(tmp_fn, "w") as f:
-        f.write("\n".join([f"file '{f}'" for f in files]))
 
-    args = ["ffmpeg", "-f", "concat", "-safe", "0", "-i", tmp_fn, "-c", "copy", fn]
+def iter_pcm_with_gaps(pcm: memoryview, gaps: list[tuple[int, int]]):
+    """
+    Yields the pcm data with the silence gaps filled in.
+    gaps is a list of (byte offset in pcm, byte length) markers, sorted by offset.
+    """
+    pos = 0
+    for offset, length in gaps:
+        if offset > pos:
+            yield pcm[pos:offset]
+            pos = offset
+        yield from iter_silence(length)
+    if pos < len(pcm):
+        yield pcm[pos:]
 
-    print("RUNNING FFMPEG WITH ARGS:")
-    print(args)
-    print(" ".join(args))
 
-    try:
-        process = subprocess.Popen(
-            args,
-            stdout=subprocess.PIPE,
-            stdin=subprocess.PIPE,
-        )
-    except FileNotFoundError:
-        raise ValueError("ffmpeg was not found.") from None
-    except subprocess.SubprocessError as exc:
-        raise ValueError(
-            "Popen failed: {0.__class__.__name__}: {0}".format(exc)
-        ) from exc
+def same_format(a: str, b: str):
+    """
+    Whether two files have the same extension, so one can be renamed to the other.
+    """
+    return os.path.splitext(a)[1].lower() == os.path.splitext(b)[1].lower()
 
-    while process.poll() is None:
-        time.sleep(0.1)
-        pass
 
-    return process.returncode == 0
+def write_concat_list(files: list[str], tmp_fn: str, output_path: str):
+    """
+    Writes the list for ffmpeg's concat demuxer, paths are relative to tmp_fn's folder (output_path).
+    """
+    files = [x.replace(f"{output_path}/", "") for x in files]
+
+    with open(tmp_fn, "w") as f:
+        f.write("\n".join([f"file '{f}'" for f in files]))
 
 
-def overlay_mp3_files(files: dict[str, int], fn: str):
+def combine_args(files: list[str], fn: str, tmp_fn: str, output_path: str):
     """
-    Overlay mp3 files into a single mp3 file with ffmpeg.
+    Writes the concat list to tmp_fn and returns the ffmpeg args to combine files into fn.
+    """
+    write_concat_list(files, tmp_fn, output_path)
+    return ["ffmpeg", "-f", "concat", "-safe", "0", "-i", tmp_fn, "-c", "copy", fn]
 
-    files is a dict of file paths and each of their weights (int 0-100), which is the volume level.
 
-    https://ffmpeg.org/ffmpeg-filters.html#amix
+def decode_args(files: list[str], tmp_fn: str, output_path: str):
+    """
+    Returns the ffmpeg args to decode files, one after the other, to raw pcm on stdout.
+    A single file is read directly, otherwise the concat list is written to tmp_fn.
     """
-    if not files:
-        return False
     if len(files) == 1:
-        os.rename(list(files.keys())[0], fn)
-        return True
+        inputs = ["-i", files[0]]
+    else:
+        write_concat_list(files, tmp_fn, output_path)
+        inputs = ["-f", "concat", "-safe", "0", "-i", tmp_fn]
+    return ["ffmpeg", "-loglevel", "error", *inputs, *PCM_INPUT_ARGS, "pipe:1"]
+
 
+def overlay_args(files: dict[str, int], fn: str, output_format: str = None):
+    """
+    Returns the ffmpeg args to overlay files (path -> volume 0-100) into fn.
+    output_format is a codec profile (see codec_util), needed when fn is a pipe (e.g. "pipe:1").
+    """
     args = ["ffmpeg"]
 
     for f in files:
@@ -71,13 +98,46 @@ def overlay_mp3_files(files: dict[str, int], fn: str):
         [
             "-filter_complex",
             f"amix=inputs={inputs_n}:normalize=0:dropout_transition=0:duration=longest:weights={weight_str}",
-            fn,
         ]
     )
-    print("RUNNING FFMPEG WITH ARGS:")
+    if output_format:
+        args.extend(get_profile(output_format).output_args())
+    args.append(fn)
+    return args
+
+
+def _print_args(args: list[str], name: str, log_args: bool):
+    if not log_args:
+        # e.g. passwords in the args
+        print(f"RUNNING {name.upper()}")
+        return
+    print(f"RUNNING {name.upper()} WITH ARGS:")
     print(args)
     print(" ".join(args))
 
+
+def low_priority(args: list[str], niceness: int):
+    """
+    Prefixes args with nice/ionice, so background work doesn't starve recording.
+    Tools that aren't available are skipped.
+    """
+    if niceness <= 0:
+        return args
+    prefix = []
+    if shutil.which("nice"):
+        prefix += ["nice", "-n", str(niceness)]
+    if shutil.which("ionice"):
+        # best-effort class, lowest priority
+        prefix += ["ionice", "-c", "2", "-n", "7"]
+    return prefix + args
+
+
+def run_process(args: list[str], name: str = "ffmpeg", log_args: bool = True):
+    """
+    Runs a process and waits for it to finish, returns True if it succeeded.
+    """
+    _print_args(args, name, log_args)
+
     try:
         process = subprocess.Popen(
             args,
@@ -85,7 +145,7 @@ def overlay_mp3_files(files: dict[str, int], fn: str):
             stdin=subprocess.PIPE,
         )
     except FileNotFoundError:
-        raise ValueError("ffmpeg was not found.") from None
+        raise ValueError(f"{name} was not found.") from None
     except subprocess.SubprocessError as exc:
         raise ValueError(
             "Popen failed: {0.__class__.__name__}: {0}".format(exc)
@@ -98,25 +158,202 @@ def overlay_mp3_files(files: dict[str, int], fn: str):
     return process.returncode == 0
 
 
-def write_wav_btyes_to_mp3_file(audio_dat: io.BytesIO, fn: str):
+async def _forward_stream(stream: asyncio.StreamReader, out):
+    # ffmpeg progress uses \r without newlines, so forward chunks instead of lines.
+    while chunk := await stream.read(4096):
+        out.write(chunk.decode(errors="replace"))
+        out.flush()
+
+
+async def run_process_async(
+    args: list[str], name: str = "ffmpeg", log_args: bool = True, niceness: int = 0
+):
+    """
+    Async version of run_process, doesn't block the event loop.
+    stdout/stderr of the process are streamed to ours while it runs.
+    niceness > 0 runs it with lower cpu/io priority (see low_priority).
+    """
+    _print_args(args, name, log_args)
+    args = low_priority(args, niceness)
+
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *args,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+    except FileNotFoundError:
+        raise ValueError(f"{name} was not found.") from None
+    except OSError as exc:
+        raise ValueError(
+            "create_subprocess_exec failed: {0.__class__.__name__}: {0}".format(exc)
+        ) from exc
+
+    await asyncio.gather(
+        _forward_stream(process.stdout, sys.stdout),
+        _forward_stream(process.stderr, sys.stderr),
+    )
+    return await process.wait() == 0
+
+
+async def run_pipeline_async(
+    producer_args: list[str],
+    consumer_args: list[str],
+    names=("ffmpeg", "7z"),
+    log_args=(True, True),
+    niceness: int = 0,
+):
+    """
+    Runs producer | consumer without blocking the event loop, returns True if both succeeded.
+    Data goes through an os pipe between the two, so at most a pipe buffer is in flight and nothing hits the disk.
+    """
+    _print_args(producer_args, names[0], log_args[0])
+    _print_args(consumer_args, names[1], log_args[1])
+
+    read_fd, write_fd = os.pipe()
+    processes = []
+    try:
+        for args, name, stdin, stdout in (
+            (producer_args, names[0], subprocess.DEVNULL, write_fd),
+            (consumer_args, names[1], read_fd, subprocess.PIPE),
+        ):
+            try:
+                processes.append(
+                    await asyncio.create_subprocess_exec(
+                        *low_priority(args, niceness),
+                        stdin=stdin,
+                        stdout=stdout,
+                        stderr=subprocess.PIPE,
+                    )
+                )
+            except FileNotFoundError:
+                raise ValueError(f"{name} was not found.") from None
+            except OSError as exc:
+                raise ValueError(
+                    "create_subprocess_exec failed: {0.__class__.__name__}: {0}".format(
+                        exc
+                    )
+                ) from exc
+    except ValueError:
+        for process in processes:
+            process.kill()
+            await process.wait()
+        raise
+    finally:
+        # Only the processes hold the pipe now, so the consumer sees EOF when the producer exits.
+        os.close(read_fd)
+        os.close(write_fd)
+
+    producer, consumer = processes
+    await asyncio.gather(
+        _forward_stream(producer.stderr, sys.stderr),
+        _forward_stream(consumer.stdout, sys.stdout),
+        _forward_stream(consumer.stderr, sys.stderr),
+    )
+    producer_code, consumer_code = await asyncio.gather(
+        producer.wait(), consumer.wait()
+    )
+    return producer_code == 0 and consumer_code == 0
+
+
+def combine_mp3_files(files: list[str], fn: str, tmp_fn: str, output_path: str):
+    """
+    Combines mp3 files into a single mp3 file.
+    using ffmpeg directly. pydub, again, saves stuff in memory as wav. (yay!)
+    """
+    if not files:
+        return False
+    if len(files) == 1:
+        os.rename(files[0], fn)
+        return True
+    return run_process(combine_args(files, fn, tmp_fn, output_path))
+
+
+async def combine_mp3_files_async(
+    files: list[str], fn: str, tmp_fn: str, output_path: str, niceness: int = 0
+):
+    """
+    Async version of combine_mp3_files.
+    """
+    if not files:
+        return False
+    if len(files) == 1:
+        os.rename(files[0], fn)
+        return True
+    return await run_process_async(
+        combine_args(files, fn, tmp_fn, output_path), niceness=niceness
+    )
+
+
+def overlay_mp3_files(files: dict[str, int], fn: str, output_format: str = None):
+    """
+    Overlay mp3 files into a single mp3 file with ffmpeg (or the output_format codec profile).
+
+    files is a dict of file paths and each of their weights (int 0-100), which is the volume level.
+
+    https://ffmpeg.org/ffmpeg-filters.html#amix
+    """
+    if not files:
+        return False
+    if len(files) == 1 and same_format(list(files.keys())[0], fn):
+        os.rename(list(files.keys())[0], fn)
+        return True
+    return run_process(overlay_args(files, fn, output_format))
+
+
+async def overlay_mp3_files_async(files: dict[str, int], fn: str, output_format: str = None):
+    """
+    Async version of overlay_mp3_files.
+    """
+    if not files:
+        return False
+    if len(files) == 1 and same_format(list(files.keys())[0], fn):
+        os.rename(list(files.keys())[0], fn)
+        return True
+    return await run_process_async(overlay_args(files, fn, output_format))
+
+
+def write_wav_btyes_to_mp3_file(
+    audio_dat: io.BytesIO, fn: str, gaps=None, output_format: str = "mp3"
+):
     """
-    Writes wav audio data to an mp3 file.
+    Writes wav audio data to an mp3 file (or the output_format codec profile, e.g. flac, opus32).
+    ffmpeg writes the file itself, so the mp3 output never sits in memory.
+    gaps are silence markers (see iter_pcm_with_gaps), generated while feeding ffmpeg.
+    Returns True if ffmpeg got all of it and exited cleanly.
     """
+    return _encode_pcm(audio_dat.getbuffer(), fn, gaps, output_format)
+
+
+def encode_pcm_file(pcm_fn: str, nbytes: int, fn: str, gaps=None, output_format: str = "mp3"):
+    """
+    Same as write_wav_btyes_to_mp3_file, for the first nbytes of a raw pcm file (e.g. a spooled segment).
+    """
+    if nbytes <= 0:
+        return _encode_pcm(memoryview(b""), fn, gaps, output_format)
+    with open(pcm_fn, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        view = memoryview(mm)
+        pcm = view[:nbytes]
+        try:
+            return _encode_pcm(pcm, fn, gaps, output_format)
+        finally:
+            # The mmap can't be closed while views of it are alive.
+            pcm.release()
+            view.release()
+
+
+def _encode_pcm(pcm: memoryview, fn: str, gaps=None, output_format: str = "mp3"):
     args = [
         "ffmpeg",
-        "-f",
-        "s16le",
-        "-ar",
-        "48000",
+        "-y",
+        *PCM_INPUT_ARGS,
         "-loglevel",
         "error",
-        "-ac",
-        "2",
         "-i",
         "-",
-        "-f",
-        "mp3",
-        "pipe:1",
+        *get_profile(output_format).output_args(),
+        fn,
     ]
 
     print("RUNNING FFMPEG WITH ARGS:")
@@ -125,7 +362,7 @@ def write_wav_btyes_to_mp3_file(audio_dat: io.BytesIO, fn: str):
     try:
         process = subprocess.Popen(
             args,
-            stdout=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
             stdin=subprocess.PIPE,
         )
     except FileNotFoundError:
@@ -135,7 +372,147 @@ def write_wav_btyes_to_mp3_file(audio_dat: io.BytesIO, fn: str):
             "Popen failed: {0.__class__.__name__}: {0}".format(exc)
         ) from exc
 
-    out = process.communicate(audio_dat.read())[0]
+    success = True
+    try:
+        for chunk in iter_pcm_with_gaps(pcm, gaps or []):
+            process.stdin.write(chunk)
+    except OSError as e:
+        print(f"Encoder for {fn} failed: {e}")
+        success = False
+    finally:
+        try:
+            process.stdin.close()
+        except OSError:
+            pass
+    returncode = process.wait()
+    if returncode != 0:
+        print(f"ffmpeg exited with {returncode} while encoding {fn}.")
+        return False
+    return success
+
+
+class FFmpegStreamEncoder:
+    """
+    A long-lived ffmpeg process that encodes raw PCM straight into a file, output_format is a codec profile.
+
+    write() only appends to a small bounded buffer, a feeder thread pushes it into ffmpeg's stdin.
+    The caller only blocks when ffmpeg can't keep up and the buffer is full.
+    write_silence() only queues a length, the zeros are generated by the feeder.
+    """
+
+    def __init__(
+        self, fn: str, max_buffered_bytes: int = 4 * 1024 * 1024, output_format: str = "mp3"
+    ):
+        self.fn = fn
+        self.max_buffered_bytes = max_buffered_bytes
+        self.buffered_bytes = 0
+        self.failed = False
+        self.closed = False
+        self.chunks = collections.deque()
+        self.cond = threading.Condition()
+
+        args = [
+            "ffmpeg",
+            "-y",
+            *PCM_INPUT_ARGS,
+            "-loglevel",
+            "error",
+            "-i",
+            "-",
+            *get_profile(output_format).output_args(),
+            fn,
+        ]
+        print("RUNNING FFMPEG WITH ARGS:")
+        print(" ".join(args))
+        try:
+            self.process = subprocess.Popen(
+                args,
+                stdout=subprocess.DEVNULL,
+                stdin=subprocess.PIPE,
+            )
+        except FileNotFoundError:
+            raise ValueError("ffmpeg was not found.") from None
+        except subprocess.SubprocessError as exc:
+            raise ValueError(
+                "Popen failed: {0.__class__.__name__}: {0}".format(exc)
+            ) from exc
+
+        self.thread = threading.Thread(target=self._feed, daemon=True)
+        self.thread.start()
+
+    def write(self, data: bytes):
+        """
+        Queues PCM for the encoder, blocks while the buffer is full.
+        """
+        if not data:
+            return
+        with self.cond:
+            if self.closed:
+                raise ValueError(f"Encoder for {self.fn} is already closed.")
+            # Always let at least one chunk through, even if it's bigger than the buffer.
+            while (
+                self.buffered_bytes
+                and self.buffered_bytes + len(data) > self.max_buffered_bytes
+            ):
+                self.cond.wait()
+            self.chunks.append(data)
+            self.buffered_bytes += len(data)
+            self.cond.notify_all()
+
+    def write_silence(self, n: int):
+        """
+        Queues n bytes of silence, costs nothing until the feeder gets to it.
+        """
+        if n <= 0:
+            return
+        with self.cond:
+            if self.closed:
+                raise ValueError(f"Encoder for {self.fn} is already closed.")
+            if self.chunks and isinstance(self.chunks[-1], int):
+                # Merge with the previous gap.
+                self.chunks[-1] += n
+            else:
+                self.chunks.append(n)
+            self.cond.notify_all()
+
+    def _feed(self):
+        while True:
+            with self.cond:
+                while not self.chunks and not self.closed:
+                    self.cond.wait()
+                if not self.chunks:
+                    break
+                chunk = self.chunks.popleft()
+
+            if not self.failed:
+                try:
+                    if isinstance(chunk, int):
+                        for zeros in iter_silence(chunk):
+                            self.process.stdin.write(zeros)
+                    else:
+                        self.process.stdin.write(chunk)
+                except OSError as e:
+                    # ffmpeg died, keep draining so writers don't block forever.
+                    print(f"Encoder for {self.fn} failed: {e}")
+                    self.failed = True
+
+            if isinstance(chunk, int):
+                continue
+            with self.cond:
+                self.buffered_bytes -= len(chunk)
+                self.cond.notify_all()
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
 
-    with open(fn, "wb") as f:
-        f.write(out)
+    def close(self) -> bool:
+        """
+        Flushes what's left, waits for ffmpeg to finish the file.
+        Returns True if the file was written successfully.
+        """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+        return self.process.wait() == 0 and not self.failed
@@ -1,7 +1,15 @@
+import asyncio
+import hashlib
+import json
 import os.path
+import random
+import threading
+import time
 
+import httplib2
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import Resource, build
 from googleapiclient.errors import HttpError
@@ -11,13 +19,70 @@ from discord import ApplicationContext
 
 # app-only file access
 SCOPES = ["https://www.googleapis.com/auth/drive.file"]
+# Resumable upload chunks have to be a multiple of 256KB.
+CHUNK_ALIGN = 256 * 1024
+# Statuses worth retrying, the rest won't get better by waiting.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+RETRY_ERRORS = (httplib2.HttpLib2Error, OSError)
+
+
+class HashingMediaFileUpload(MediaFileUpload):
+    """
+    MediaFileUpload that computes the md5 of the file while its chunks are read for upload.
+    Chunks that are read again after a failed request are only hashed once.
+    """
+
+    def __init__(self, filename, **kwargs):
+        super().__init__(filename, **kwargs)
+        self.md5 = hashlib.md5()
+        self.hashed = 0
+
+    def has_stream(self):
+        # Makes the client read chunks through getbytes() instead of slicing the stream.
+        return False
+
+    def hash_until(self, offset):
+        """
+        Hashes the file up to offset, for a resumed upload where the start was sent by an earlier run.
+        """
+        while self.hashed < offset:
+            data = super().getbytes(self.hashed, min(CHUNK_ALIGN * 16, offset - self.hashed))
+            if not data:
+                break
+            self.md5.update(data)
+            self.hashed += len(data)
+
+    def getbytes(self, begin, length):
+        if begin > self.hashed:
+            self.hash_until(begin)
+        data = super().getbytes(begin, length)
+        if begin <= self.hashed < begin + len(data):
+            self.md5.update(data[self.hashed - begin :])
+            self.hashed = begin + len(data)
+        return data
+
+    def close(self):
+        self.stream().close()
 
 
 class GoogleDriveUploader:
-    def __init__(self, token_file):
+    def __init__(
+        self,
+        token_file,
+        sessions_file=None,
+        chunk_mb=8,
+        retries=8,
+        max_backoff=64,
+    ):
         self.token_file = token_file
         self.service = None
         self.creds = None
+        # Resumable session uris by file path, so an interrupted upload can continue after a restart.
+        self.sessions_file = sessions_file
+        self.sessions_lock = threading.Lock()
+        self.chunk_size = max(CHUNK_ALIGN, int(chunk_mb * 1024 * 1024) // CHUNK_ALIGN * CHUNK_ALIGN)
+        self.retries = retries
+        self.max_backoff = max_backoff
         # self.service, self.creds = GoogleDriveUploader.build_service(ctx, token_file)
 
     async def init_auth(self, ctx) -> bool:
@@ -56,24 +121,198 @@ class GoogleDriveUploader:
         files = response.get("files", [])
         return len(files) > 0
 
-    def upload_resumable(self, file_path, g_folder_id):
+    def _load_sessions(self) -> dict:
+        if not self.sessions_file or not os.path.exists(self.sessions_file):
+            return {}
+        try:
+            with open(self.sessions_file, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"GDRIVE Could not read upload sessions: {e}")
+            return {}
+
+    def _update_session(self, file_path, session=None):
+        """
+        Stores (or with None, removes) the resumable session of a file.
+        """
+        if not self.sessions_file:
+            return
+        with self.sessions_lock:
+            sessions = self._load_sessions()
+            if session is None:
+                if sessions.pop(file_path, None) is None:
+                    return
+            else:
+                sessions[file_path] = session
+            tmp_fn = f"{self.sessions_file}.tmp"
+            with open(tmp_fn, "w") as f:
+                json.dump(sessions, f, indent=2)
+            os.replace(tmp_fn, self.sessions_file)
+
+    def pending_uploads(self, skip=()) -> dict[str, str]:
+        """
+        Files with an unfinished upload from an earlier run, file path -> folder id.
+        Sessions of files that are gone are dropped. Files in skip (absolute paths) are left out,
+        their sessions are kept for whoever does upload them.
+        """
+        pending = {}
+        for file_path, session in self._load_sessions().items():
+            if file_path in skip:
+                continue
+            if os.path.exists(file_path):
+                pending[file_path] = session["folder"]
+            else:
+                self._update_session(file_path)
+        return pending
+
+    def _backoff(self, attempt, reason):
+        delay = min(self.max_backoff, 2**attempt) + random.random()
+        print(f"GDRIVE {reason}, retrying in {delay:.1f}s (attempt {attempt + 1}/{self.retries})")
+        time.sleep(delay)
+
+    def _resume_status(self, http, uri, size):
+        """
+        Asks the server how far a resumable session got.
+        Returns (bytes received, finished file or None), or None if the session expired.
+        """
+        resp, content = http.request(
+            uri,
+            "PUT",
+            headers={"Content-Range": f"bytes */{size}", "content-length": "0"},
+        )
+        if resp.status in (200, 201):
+            return size, json.loads(content)
+        if resp.status == 308:
+            if "range" in resp:
+                return int(resp["range"].split("-")[1]) + 1, None
+            return 0, None
+        if resp.status in (404, 410):
+            return None
+        raise HttpError(resp, content, uri=uri)
+
+    def upload_resumable(self, file_path, g_folder_id, progress=None):
+        """
+        Uploads a file in chunks, returns the file id or None if it failed.
+
+        Failed chunks are retried with exponential backoff, and the session uri is stored so a restart continues where it left off.
+        The md5 is computed while uploading and checked against the one Drive reports.
+        progress(file_path, bytes_done, total_bytes) is called after every chunk (from the uploading thread).
+        """
         if not self.service or not self.creds:
             raise ValueError("Google Drive API not authenticated.")
+        file_path = os.path.abspath(file_path)
         file_name = os.path.basename(file_path)
+        size = os.path.getsize(file_path)
+        mtime = os.path.getmtime(file_path)
 
         metadata = {
             "name": file_name,
             "parents": [g_folder_id],
         }
+        # The service's http isn't thread-safe, every upload gets its own.
+        http = AuthorizedHttp(self.creds, http=httplib2.Http())
 
+        media_body = HashingMediaFileUpload(
+            file_path, chunksize=self.chunk_size, resumable=True
+        )
         try:
-            media_body = MediaFileUpload(file_path, resumable=True)
-            file = (
-                self.service.files()
-                .create(body=metadata, media_body=media_body)
-                .execute()
+            request = self.service.files().create(
+                body=metadata, media_body=media_body, fields="id,md5Checksum"
             )
-            return file.get("id")
-        except HttpError as error:
+            file = None
+            session = self._load_sessions().get(file_path)
+            if session and (session["size"], session["mtime"]) != (size, mtime):
+                # The file changed since, the uploaded part is useless.
+                session = None
+            if session:
+                status = self._resume_status(http, session["uri"], size)
+                if status is None:
+                    print(f"GDRIVE Upload session of {file_name} expired, starting over.")
+                    session = None
+                else:
+                    print(f"GDRIVE Resuming upload of {file_name} at {status[0]}/{size} bytes.")
+                    request.resumable_uri = session["uri"]
+                    request.resumable_progress = status[0]
+                    media_body.hash_until(status[0])
+                    file = status[1]
+
+            attempt = 0
+            while file is None:
+                try:
+                    status, file = request.next_chunk(http=http)
+                except HttpError as error:
+                    if error.resp.status in (404, 410) and request.resumable_uri:
+                        print(f"GDRIVE Upload session of {file_name} expired, starting over.")
+                        self._update_session(file_path)
+                        return self.upload_resumable(file_path, g_folder_id, progress)
+                    if error.resp.status not in RETRY_STATUSES or attempt >= self.retries:
+                        raise
+                    self._backoff(attempt, f"Server error {error.resp.status}")
+                    attempt += 1
+                    continue
+                except RETRY_ERRORS as error:
+                    if attempt >= self.retries:
+                        raise
+                    self._backoff(attempt, f"Connection error ({error})")
+                    if request.resumable_uri:
+                        # googleapiclient only does this itself for error responses, the chunk might
+                        # have arrived anyway, so the next chunk asks the server where it left off first.
+                        request._in_error_state = True
+                    attempt += 1
+                    continue
+                attempt = 0
+                if not session and request.resumable_uri:
+                    session = {
+                        "uri": request.resumable_uri,
+                        "folder": g_folder_id,
+                        "size": size,
+                        "mtime": mtime,
+                    }
+                    self._update_session(file_path, session)
+                if progress is not None:
+                    progress(file_path, status.resumable_progress if status else size, size)
+        except (HttpError, *RETRY_ERRORS) as error:
             print(f"GDRIVE An error occurred: {error}")
             return None
+        finally:
+            media_body.close()
+
+        self._update_session(file_path)
+        if media_body.hashed == size and file.get("md5Checksum") != media_body.md5.hexdigest():
+            print(
+                f"GDRIVE Checksum mismatch for {file_name} "
+                f"(local {media_body.md5.hexdigest()}, drive {file.get('md5Checksum')}), removing the upload."
+            )
+            try:
+                self.service.files().delete(fileId=file["id"]).execute(http=http)
+            except HttpError as error:
+                print(f"GDRIVE Could not remove the bad upload: {error}")
+            return None
+        return file.get("id")
+
+    async def upload_async(self, file_path, g_folder_id, progress=None):
+        """
+        upload_resumable in an executor, so the event loop keeps running.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, self.upload_resumable, file_path, g_folder_id, progress
+        )
+
+    async def upload_many_async(
+        self, files: dict[str, str], concurrency=2, progress=None
+    ) -> dict[str, str]:
+        """
+        Uploads files (file path -> folder id) with at most concurrency uploads at a time.
+        Returns file path -> file id (None if it failed).
+        """
+        sem = asyncio.Semaphore(max(1, concurrency))
+
+        async def upload(file_path, g_folder_id):
+            async with sem:
+                return await self.upload_async(file_path, g_folder_id, progress)
+
+        ids = await asyncio.gather(
+            *(upload(fp, folder) for fp, folder in files.items())
+        )
+        return dict(zip(files, ids))
@@ -0,0 +1,203 @@
+import json
+import os
+import threading
+import time
+
+"""
+Crash-safe journal of a recording session.
+Every segment the sink starts/finishes is appended as a json line and fsync'd, so after a crash
+the segments on disk can be put back together without guessing from file names.
+
+Events:
+    session         first line, name/started/channel/rotating/capture
+    segment_started a segment file was started (user, fn, part, start/end in seconds into the user's track)
+    segment_spooled a segment's pcm was spooled for deferred encoding (user, fn, part, spool, bytes, gaps, format)
+    segment         a segment file is done (user, fn, part, bytes)
+    mix             the live mix file (fn)
+    part_closed     a part of a rotating recording is complete (part)
+    stopped         the recording stopped normally
+    combined        the users' tracks of a part are ready to overlay (part, tracks: path -> volume, extra_files),
+                    with mixed the only track is the finished mix of the pcm engine
+    finalized       a part was combined/zipped (part, archive)
+    uploaded        the archive of a part is on Google Drive (part)
+"""
+
+
+class SegmentJournal:
+    """
+    Append-only, fsync'd JSONL journal, safe to append to from multiple threads.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, "a")
+
+    def append(self, event: str, **fields):
+        line = json.dumps({"event": event, "time": time.time(), **fields}) + "\n"
+        with self.lock:
+            if self.file.closed:
+                return
+            self.file.write(line)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+    def remove(self):
+        self.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def read_journal(path: str) -> list[dict]:
+    """
+    Reads the records of a journal, a torn last line (crash mid-write) is skipped.
+    """
+    records = []
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    return records
+
+
+class JournalPart:
+    def __init__(self, index):
+        self.index = index
+        # user_id -> [fn], in the order they were started.
+        self.files = {}
+        self.done = set()
+        # fn -> its segment_spooled record, for segments that were spooled before they were encoded.
+        self.spooled = {}
+        self.closed = False
+        # Combined per-user tracks, path -> volume.
+        self.tracks = {}
+        self.extra_files = []
+        # tracks is the finished mix, it only needs zipping.
+        self.mixed = False
+        self.archive = None
+        self.uploaded = False
+
+    def has_tracks(self):
+        return bool(self.tracks) and all(os.path.exists(fn) for fn in self.tracks)
+
+    def unencoded_spools(self) -> list[dict]:
+        """
+        segment_spooled records of segments that never got encoded, whose pcm is still on disk.
+        """
+        return [
+            record
+            for fn, record in self.spooled.items()
+            if fn not in self.done and os.path.exists(record["spool"])
+        ]
+
+    def get_actual_files(self):
+        """
+        user_id -> segments that are on disk, unfinished ones included (a cut off mp3 still plays).
+        """
+        files = {}
+        for user_id, fns in self.files.items():
+            fns = [fn for fn in fns if os.path.exists(fn) and os.path.getsize(fn) > 0]
+            if fns:
+                files[user_id] = fns
+        return files
+
+
+class JournalSession:
+    """
+    The state of a session, rebuilt from its journal.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.info = {}
+        self.parts = {}
+        self.mix = None
+        self.stopped = False
+        for record in read_journal(path):
+            event = record.get("event")
+            if event == "session":
+                self.info = record
+            elif event in ("segment_started", "segment"):
+                part = self.get_part(record.get("part", 0))
+                user_id = record["user"]
+                fns = part.files.setdefault(user_id, [])
+                if record["fn"] not in fns:
+                    fns.append(record["fn"])
+                if event == "segment":
+                    part.done.add(record["fn"])
+            elif event == "segment_spooled":
+                self.get_part(record.get("part", 0)).spooled[record["fn"]] = record
+            elif event == "mix":
+                self.mix = record["fn"]
+            elif event == "part_closed":
+                self.get_part(record["part"]).closed = True
+            elif event == "stopped":
+                self.stopped = True
+            elif event == "combined":
+                part = self.get_part(record["part"])
+                part.tracks = record["tracks"]
+                part.extra_files = record.get("extra_files", [])
+                part.mixed = record.get("mixed", False)
+            elif event == "finalized":
+                self.get_part(record["part"]).archive = record["archive"]
+            elif event == "uploaded":
+                self.get_part(record["part"]).uploaded = True
+        if self.mix:
+            # The live mix is the combined file of part 0.
+            self.get_part(0)
+
+    def get_part(self, index) -> JournalPart:
+        if index not in self.parts:
+            self.parts[index] = JournalPart(index)
+        return self.parts[index]
+
+    def unfinished_parts(self) -> list[JournalPart]:
+        """
+        Parts that still have to be finalized or uploaded.
+        """
+        return [
+            part
+            for _, part in sorted(self.parts.items())
+            if not part.uploaded
+            and (
+                (part.archive and os.path.exists(part.archive))
+                or part.has_tracks()
+                or part.get_actual_files()
+                or part.unencoded_spools()
+                or (part.index == 0 and self.mix and os.path.exists(self.mix))
+            )
+        ]
+
+    def is_done(self):
+        return self.stopped and not self.unfinished_parts()
+
+
+def find_journals(folder: str) -> list[str]:
+    if not os.path.isdir(folder):
+        return []
+    return sorted(
+        os.path.join(folder, fn)
+        for fn in os.listdir(folder)
+        if fn.startswith("journal-") and fn.endswith(".jsonl")
+    )
+
+
+def journaled_archives(folder: str) -> set[str]:
+    """
+    Absolute paths of the archives the journals in folder still have to upload.
+    Recovery uploads these (resuming their stored upload session), nothing else should touch them.
+    """
+    return {
+        os.path.abspath(part.archive)
+        for path in find_journals(folder)
+        for part in JournalSession(path).parts.values()
+        if part.archive and not part.uploaded
+    }
@@ -0,0 +1,272 @@
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+"""
+Tiny metrics registry for the capture pipeline, served in the Prometheus text format.
+Hot paths only bump numbers, anything that can be read off a live object (queue depths, buffers)
+is a gauge with a function, which only runs when the metrics are scraped.
+"""
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, n=1, *labels):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + n
+
+    def get(self, *labels):
+        return self.values.get(labels, 0)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in list(self.values.items()):
+            yield f"{self.name}{_labels(self.label_names, labels)} {value}"
+
+
+class Gauge:
+    """
+    A gauge that's either set, or read from fn when scraped.
+    With labels, fn returns a dict of label values (tuple) -> value.
+    """
+
+    def __init__(self, name, help, labels=(), fn=None):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self.values = {}
+        self.fn = fn
+
+    def set(self, value, *labels):
+        self.values[labels] = value
+
+    def set_function(self, fn):
+        self.fn = fn
+
+    def collect(self) -> dict:
+        if self.fn is None:
+            return dict(self.values)
+        try:
+            value = self.fn()
+        except Exception as e:
+            # Whatever it reads might be torn down right now, skip it this time.
+            print(f"Metric {self.name} failed: {e}")
+            return {}
+        if value is None:
+            return {}
+        return value if self.label_names else {(): value}
+
+    def get(self, *labels):
+        return self.collect().get(labels, 0)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} gauge"
+        for labels, value in self.collect().items():
+            yield f"{self.name}{_labels(self.label_names, labels)} {value}"
+
+
+class _Timer:
+    def __init__(self, summary, labels):
+        self.summary = summary
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.summary.observe(time.perf_counter() - self.start, *self.labels)
+
+
+class Summary:
+    """
+    Count, sum and max of observations (max is exported as a separate gauge).
+    """
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        # labels -> [count, sum, max]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self.lock:
+            stats = self.values.get(labels)
+            if stats is None:
+                self.values[labels] = [1, value, value]
+            else:
+                stats[0] += 1
+                stats[1] += value
+                if value > stats[2]:
+                    stats[2] = value
+
+    def time(self, *labels):
+        """
+        Context manager that observes how long its body took.
+        """
+        return _Timer(self, labels)
+
+    def average(self, *labels):
+        stats = self.values.get(labels)
+        return stats[1] / stats[0] if stats else 0.0
+
+    def render(self):
+        items = list(self.values.items())
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} summary"
+        for labels, (count, total, _) in items:
+            label_str = _labels(self.label_names, labels)
+            yield f"{self.name}_count{label_str} {count}"
+            yield f"{self.name}_sum{label_str} {total}"
+        yield f"# TYPE {self.name}_max gauge"
+        for labels, (_, _, maximum) in items:
+            yield f"{self.name}_max{_labels(self.label_names, labels)} {maximum}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def rss_bytes():
+    """
+    Resident memory of this process (Linux), falls back to the peak RSS elsewhere.
+    """
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        import resource
+
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+REGISTRY = Registry()
+
+PACKETS_RECEIVED = REGISTRY.register(
+    Counter("deavesdrop_packets_received_total", "Voice packets queued for decoding.")
+)
+PACKETS_DECODED = REGISTRY.register(
+    Counter("deavesdrop_packets_decoded_total", "Voice packets that reached the sink.")
+)
+RECV_WAKEUPS = REGISTRY.register(
+    Counter(
+        "deavesdrop_recv_wakeups_total",
+        "Times the receive thread woke up to read the voice socket (packets per wakeup = received / wakeups).",
+    )
+)
+DECODE_QUEUE_DEPTH = REGISTRY.register(
+    Gauge("deavesdrop_decode_queue_depth", "Packets waiting for the decoder.")
+)
+PENDING_PACKETS = REGISTRY.register(
+    Gauge("deavesdrop_pending_packets", "Packets held for ssrcs that aren't mapped to a user yet.")
+)
+PENDING_DROPPED = REGISTRY.register(
+    Counter(
+        "deavesdrop_pending_dropped_total",
+        "Held packets of unmapped ssrcs dropped for age/size or because no user ever showed up.",
+    )
+)
+DECODE_LATENCY = REGISTRY.register(
+    Summary(
+        "deavesdrop_decode_latency_seconds",
+        "Time from receiving a packet until its audio is handed to the sink.",
+    )
+)
+BUFFERED_BYTES = REGISTRY.register(
+    Gauge("deavesdrop_buffered_bytes", "Pcm bytes buffered in memory per user.", labels=("user",))
+)
+ENCODES_PENDING = REGISTRY.register(
+    Gauge("deavesdrop_encodes_pending", "Flushed segments queued or running in the encoder pool.")
+)
+ENCODER_WAIT_SECONDS = REGISTRY.register(
+    Gauge(
+        "deavesdrop_encoder_wait_seconds",
+        "Time capture was blocked waiting for the encoder pool to free memory.",
+    )
+)
+ENCODED_BYTES = REGISTRY.register(
+    Counter("deavesdrop_encoded_pcm_bytes_total", "Pcm bytes encoded into segments.")
+)
+ENCODE_SECONDS = REGISTRY.register(
+    Counter("deavesdrop_encode_seconds_total", "Time spent encoding segments.")
+)
+TAP_DROPPED = REGISTRY.register(
+    Counter("deavesdrop_tap_dropped_frames_total", "Frames dropped from live tap subscribers that fell behind.")
+)
+SPOOLED_BYTES = REGISTRY.register(
+    Gauge("deavesdrop_spooled_bytes", "Pcm bytes of flushed segments spooled to disk, waiting to be encoded.")
+)
+SEGMENTS_SPOOLED = REGISTRY.register(
+    Counter("deavesdrop_segments_spooled_total", "Flushed segments that were spooled instead of encoded right away.")
+)
+RSS_BYTES = REGISTRY.register(
+    Gauge("deavesdrop_process_resident_bytes", "Resident memory of the bot.", fn=rss_bytes)
+)
+FINALIZE_SECONDS = REGISTRY.register(
+    Summary(
+        "deavesdrop_finalize_stage_seconds",
+        "Duration of finalization stages.",
+        labels=("stage",),
+    )
+)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes every few seconds would flood the console.
+        return
+
+
+def serve_metrics(port: int, host="127.0.0.1"):
+    """
+    Serves the registry on http://host:port/metrics from a daemon thread.
+    """
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True, name="Metrics").start()
+    print(f"Metrics on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,253 @@
+import asyncio
+import os
+import subprocess
+import uuid
+
+import numpy as np
+
+from ffmpeg_util import (SILENCE_CHUNK, FFmpegStreamEncoder, decode_args,
+                         low_priority)
+from tap_util import MIX
+
+# 1 second of interleaved stereo int16 samples at 48kHz.
+BLOCK_SAMPLES = 48000 * 2
+
+
+class LiveMixer:
+    """
+    Mixes all users into one track while recording, instead of overlaying the per-user tracks afterwards.
+
+    Every user has a position on the shared timeline (in int16 samples), which moves forward with their audio and silence.
+    Audio is added into 1 second float32 blocks with the user's volume applied.
+    Blocks that are latency_blocks behind the newest audio are clipped to int16 and streamed into a single encoder.
+    Audio that arrives for an already encoded block is moved forward to the first open block.
+    With a tap (tap_util.PCMTap), every encoded block is published to it as the MIX stream too.
+    """
+
+    def __init__(
+        self,
+        fn: str,
+        volumes: dict[int, int],
+        latency_blocks: int = 2,
+        output_format: str = "mp3",
+        tap=None,
+    ):
+        self.fn = fn
+        # user_id -> volume (0-100), looked up per frame so !setvol applies live.
+        self.volumes = volumes
+        self.latency_blocks = latency_blocks
+        self.positions = {}
+        self.blocks = {}
+        # Index of the next block to encode.
+        self.emitted = 0
+        self.head = 0
+        self.late_samples = 0
+        self.tap = tap
+        self.encoder = FFmpegStreamEncoder(fn, output_format=output_format)
+
+    def add_silence(self, user, n: int):
+        """
+        Moves the user forward by n bytes of silence.
+        """
+        self.positions[user] = self.positions.get(user, 0) + n // 2
+
+    def add(self, user, data: bytes):
+        """
+        Adds a frame of pcm for a user at their position on the timeline.
+        """
+        samples = np.frombuffer(data, dtype=np.int16)
+        pos = self.positions.get(user, 0)
+        first_open = self.emitted * BLOCK_SAMPLES
+        if pos < first_open:
+            self.late_samples += first_open - pos
+            pos = first_open
+
+        gain = self.volumes.get(user, 100) / 100
+        i = 0
+        while i < len(samples):
+            block_i, offset = divmod(pos, BLOCK_SAMPLES)
+            block = self.blocks.get(block_i)
+            if block is None:
+                block = np.zeros(BLOCK_SAMPLES, dtype=np.float32)
+                self.blocks[block_i] = block
+            n = min(BLOCK_SAMPLES - offset, len(samples) - i)
+            block[offset : offset + n] += samples[i : i + n] * gain
+            pos += n
+            i += n
+
+        self.positions[user] = pos
+        self.head = max(self.head, pos)
+        self.emit(self.head // BLOCK_SAMPLES - self.latency_blocks)
+
+    def emit(self, upto: int):
+        """
+        Encodes all blocks before block index upto.
+        """
+        while self.emitted < upto:
+            block = self.blocks.pop(self.emitted, None)
+            if block is None:
+                # Nobody talked in this block.
+                self.encoder.write_silence(BLOCK_SAMPLES * 2)
+                pcm = memoryview(SILENCE_CHUNK)[: BLOCK_SAMPLES * 2]
+            else:
+                pcm = np.clip(block, -32768, 32767).astype(np.int16).tobytes()
+                self.encoder.write(pcm)
+            if self.tap is not None:
+                # Same bytes as the encoder got, no copy.
+                self.tap.publish(MIX, pcm)
+            self.emitted += 1
+
+    def close(self) -> bool:
+        """
+        Encodes what's left up to the newest audio, and finishes the file.
+        """
+        full_blocks, rest = divmod(self.head, BLOCK_SAMPLES)
+        self.emit(full_blocks)
+        if rest:
+            block = self.blocks.pop(full_blocks, None)
+            if block is None:
+                self.encoder.write_silence(rest * 2)
+            else:
+                self.encoder.write(
+                    np.clip(block[:rest], -32768, 32767).astype(np.int16).tobytes()
+                )
+        self.blocks = {}
+        if self.late_samples:
+            print(
+                f"Live mix: {self.late_samples / BLOCK_SAMPLES:.2f}s of late audio was moved forward."
+            )
+        return self.encoder.close()
+
+
+class Limiter:
+    """
+    Keeps a float mix under ceiling before it's turned into int16.
+    A block that would clip is turned down (ramping in over attack_samples, so there's no click),
+    the gain recovers by release per block. Whatever still sticks out during the attack ramp is clipped.
+    """
+
+    def __init__(self, ceiling=0.98 * 32767, release=0.25, attack_samples=480):
+        self.ceiling = ceiling
+        self.release = release
+        self.attack_samples = attack_samples
+        self.gain = 1.0
+        # Samples that were turned down, for the log.
+        self.limited = 0
+
+    def process(self, block: np.ndarray) -> np.ndarray:
+        peak = float(np.abs(block).max()) if len(block) else 0.0
+        target = min(1.0, self.ceiling / peak) if peak else 1.0
+        if target < self.gain:
+            gain = target
+        else:
+            gain = min(target, self.gain + self.release)
+        if gain != self.gain or gain < 1.0:
+            ramp = np.full(len(block), gain, dtype=np.float32)
+            n = min(self.attack_samples, len(block))
+            ramp[:n] = np.linspace(self.gain, gain, n, dtype=np.float32)
+            block = block * ramp
+            self.limited += len(block)
+        self.gain = gain
+        return np.clip(block, -32768, 32767).astype(np.int16)
+
+
+class SegmentSource:
+    """
+    One user's segments decoded back to pcm by an ffmpeg process, read in blocks.
+    """
+
+    def __init__(self, files: list[str], tmp_fn: str, output_path: str, niceness=0):
+        self.tmp_fn = tmp_fn
+        args = decode_args(files, tmp_fn, output_path)
+        try:
+            self.process = subprocess.Popen(
+                low_priority(args, niceness),
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+            )
+        except FileNotFoundError:
+            raise ValueError("ffmpeg was not found.") from None
+
+    def read(self, n: int) -> bytes:
+        """
+        Up to n bytes, less only at the end.
+        """
+        data = self.process.stdout.read(n)
+        # Don't split a stereo sample at the very end.
+        return data[: len(data) // 4 * 4]
+
+    def close(self) -> bool:
+        self.process.stdout.close()
+        success = self.process.wait() == 0
+        if os.path.exists(self.tmp_fn):
+            os.remove(self.tmp_fn)
+        return success
+
+
+def mix_sources(
+    sources: dict,
+    fn: str,
+    output_path: str,
+    block_samples=BLOCK_SAMPLES,
+    niceness=0,
+    output_format="mp3",
+) -> bool:
+    """
+    Mixes each source (name -> ([files], volume 0-100)) into fn (output_format codec profile), in the pcm domain.
+    The sources are decoded block by block, added up with their volume as weight, limited and encoded once.
+    Memory is a block per source, however long the recording is. The mix is as long as the longest source.
+    Returns True if every source was read and fn was written.
+    """
+    readers = {}
+    weights = {}
+    success = True
+    encoder = None
+    try:
+        for name, (files, volume) in sources.items():
+            readers[name] = SegmentSource(
+                files, f"{output_path}/temp_mix_{uuid.uuid4().hex}.txt", output_path, niceness
+            )
+            weights[name] = np.float32(volume / 100)
+        encoder = FFmpegStreamEncoder(fn, output_format=output_format)
+        limiter = Limiter()
+        mix = np.zeros(block_samples, dtype=np.float32)
+        block_bytes = block_samples * 2
+        while readers:
+            mix[:] = 0
+            longest = 0
+            for name, reader in list(readers.items()):
+                data = reader.read(block_bytes)
+                if data:
+                    samples = np.frombuffer(data, dtype=np.int16)
+                    mix[: len(samples)] += samples * weights[name]
+                    longest = max(longest, len(samples))
+                if len(data) < block_bytes:
+                    del readers[name]
+                    if not reader.close():
+                        print(f"Decoding {name} for the mix failed.")
+                        success = False
+            if longest:
+                encoder.write(limiter.process(mix[:longest]).tobytes())
+        if limiter.limited:
+            print(f"Mix: limited {limiter.limited / BLOCK_SAMPLES:.1f}s of audio to keep it from clipping.")
+    except ValueError as e:
+        print(f"Mixing failed: {e}")
+        success = False
+    finally:
+        # Whatever's left when something went wrong, so no decoder is left running.
+        for reader in readers.values():
+            reader.close()
+        if encoder is not None:
+            success = encoder.close() and success
+    return success
+
+
+async def mix_sources_async(
+    sources: dict, fn: str, output_path: str, niceness=0, output_format="mp3"
+) -> bool:
+    """
+    mix_sources in a thread, so the event loop keeps going.
+    """
+    return await asyncio.to_thread(
+        mix_sources, sources, fn, output_path, niceness=niceness, output_format=output_format
+    )
@@ -0,0 +1,227 @@
+import os
+import struct
+
+"""
+Raw opus capture: the decrypted packets of a user are stored as-is, nothing is decoded while recording.
+Tracks are built from the packet files afterwards, by remuxing them into Ogg/Opus (no re-encode).
+"""
+
+PACKET_FILE_MAGIC = b"DOPK\x01"
+# rtp timestamp, receive time (perf_counter), payload length
+RECORD_HEADER = struct.Struct("<IdH")
+# 20ms of silence, same frame discord sends when nobody talks.
+SILENCE_FRAME = b"\xf8\xff\xfe"
+SAMPLES_PER_FRAME = 960
+SAMPLING_RATE = 48000
+
+
+def packet_silence(last: tuple[int, float], timestamp: int, receive_time: float):
+    """
+    Samples (per channel) of silence before a packet, same rules as recv_decoded_audio.
+    last is the (timestamp, receive_time) of the user's previous packet.
+    """
+    dRT = (receive_time - last[1]) * SAMPLING_RATE  # delta receive time
+    dT = timestamp - last[0]  # delta timestamp
+    if dRT > 0:
+        diff = abs(100 - dT * 100 / dRT)
+        if (
+            diff > 60 and dT != SAMPLES_PER_FRAME
+        ):  # If the difference in change is more than 60% threshold
+            return dRT - SAMPLES_PER_FRAME
+    return dT - SAMPLES_PER_FRAME
+
+
+def opus_packet_samples(packet: bytes):
+    """
+    Samples (per channel, 48kHz) in an opus packet, from its TOC byte (RFC 6716, 3.1).
+    """
+    toc = packet[0]
+    config = toc >> 3
+    if config < 12:  # SILK: 10, 20, 40, 60ms
+        frame = (480, 960, 1920, 2880)[config % 4]
+    elif config < 16:  # Hybrid: 10, 20ms
+        frame = (480, 960)[config % 2]
+    else:  # CELT: 2.5, 5, 10, 20ms
+        frame = (120, 240, 480, 960)[config % 4]
+    code = toc & 0x03
+    if code == 0:
+        frames = 1
+    elif code in (1, 2):
+        frames = 2
+    else:
+        frames = packet[1] & 0x3F if len(packet) > 1 else 0
+    return frame * frames
+
+
+class OpusPacketWriter:
+    """
+    Append-only packet file for one user.
+    """
+
+    def __init__(self, fn: str):
+        self.fn = fn
+        new = not os.path.exists(fn) or os.path.getsize(fn) == 0
+        self.file = open(fn, "ab", buffering=64 * 1024)
+        if new:
+            self.file.write(PACKET_FILE_MAGIC)
+
+    def write(self, timestamp: int, receive_time: float, payload: bytes):
+        self.file.write(RECORD_HEADER.pack(timestamp, receive_time, len(payload)))
+        self.file.write(payload)
+
+    def tell(self):
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+
+def iter_opus_packets(fn: str):
+    """
+    Yields (timestamp, receive_time, payload) from a packet file.
+    A truncated last record (e.g. after a crash) is skipped.
+    """
+    with open(fn, "rb") as f:
+        if f.read(len(PACKET_FILE_MAGIC)) != PACKET_FILE_MAGIC:
+            raise ValueError(f"{fn} is not an opus packet file.")
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            timestamp, receive_time, length = RECORD_HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                return
+            yield timestamp, receive_time, payload
+
+
+def first_receive_time(fn: str):
+    """
+    Receive time of the first packet in a packet file, None if it's empty.
+    """
+    for _, receive_time, _ in iter_opus_packets(fn):
+        return receive_time
+    return None
+
+
+def _ogg_crc_table():
+    table = []
+    for i in range(256):
+        r = i << 24
+        for _ in range(8):
+            r = ((r << 1) ^ 0x04C11DB7) if r & 0x80000000 else (r << 1)
+        table.append(r & 0xFFFFFFFF)
+    return table
+
+
+OGG_CRC_TABLE = _ogg_crc_table()
+
+
+def ogg_crc(data: bytes):
+    crc = 0
+    for b in data:
+        crc = ((crc << 8) & 0xFFFFFFFF) ^ OGG_CRC_TABLE[(crc >> 24) ^ b]
+    return crc
+
+
+class OggOpusWriter:
+    """
+    Minimal Ogg/Opus muxer (RFC 7845), puts opus packets into an .ogg without re-encoding.
+    """
+
+    # Max packets per page, ~1 second of 20ms frames.
+    PACKETS_PER_PAGE = 50
+
+    def __init__(self, fn: str, channels: int = 2, serial: int = 0x44454156):
+        self.file = open(fn, "wb")
+        self.serial = serial
+        self.sequence = 0
+        self.granule = 0
+        self.pending = []
+        head = (
+            b"OpusHead"
+            + struct.pack("<BBHIhB", 1, channels, 0, SAMPLING_RATE, 0, 0)
+        )
+        vendor = b"Deavesdrop"
+        tags = b"OpusTags" + struct.pack("<I", len(vendor)) + vendor + struct.pack("<I", 0)
+        self._write_page([head], granule=0, header_type=0x02)
+        self._write_page([tags], granule=0)
+
+    def _write_page(self, packets: list[bytes], granule: int, header_type: int = 0):
+        lacing = bytearray()
+        for packet in packets:
+            lacing += b"\xff" * (len(packet) // 255)
+            lacing.append(len(packet) % 255)
+        header = struct.pack(
+            "<4sBBqIIIB",
+            b"OggS",
+            0,
+            header_type,
+            granule,
+            self.serial,
+            self.sequence,
+            0,
+            len(lacing),
+        )
+        page = header + bytes(lacing) + b"".join(packets)
+        crc = ogg_crc(page)
+        page = page[:22] + struct.pack("<I", crc) + page[26:]
+        self.file.write(page)
+        self.sequence += 1
+
+    def _segments(self):
+        return sum(len(p) // 255 + 1 for p in self.pending)
+
+    def write(self, packet: bytes):
+        if self.pending and (
+            len(self.pending) >= self.PACKETS_PER_PAGE
+            or self._segments() + len(packet) // 255 + 1 > 255
+        ):
+            self._write_page(self.pending, self.granule)
+            self.pending = []
+        self.pending.append(packet)
+        self.granule += opus_packet_samples(packet)
+
+    def write_silence(self, samples: int):
+        """
+        Fills samples (per channel) of silence, rounded down to whole 20ms frames.
+        """
+        for _ in range(int(samples) // SAMPLES_PER_FRAME):
+            self.write(SILENCE_FRAME)
+
+    def close(self):
+        # The last page must be flagged as end of stream, even if it's empty.
+        self._write_page(self.pending, self.granule, header_type=0x04)
+        self.pending = []
+        self.file.close()
+
+
+def build_ogg_track(fn: str, out_fn: str, session_start: float = None):
+    """
+    Builds a time-aligned Ogg/Opus track from a packet file.
+    Gaps between packets are filled with silence frames, using the same timing rules as live recording.
+    With session_start (receive time of the first packet of anyone), the track starts with silence until the user's first packet.
+    Returns the number of packets written.
+    """
+    writer = OggOpusWriter(out_fn)
+    last = None
+    n = 0
+    try:
+        for timestamp, receive_time, payload in iter_opus_packets(fn):
+            if last is None:
+                if session_start is not None:
+                    silence = (
+                        receive_time - session_start
+                    ) * SAMPLING_RATE - SAMPLES_PER_FRAME
+                else:
+                    silence = 0
+            else:
+                silence = packet_silence(last, timestamp, receive_time)
+            last = (timestamp, receive_time)
+            if silence > 0:
+                writer.write_silence(silence)
+            writer.write(payload)
+            n += 1
+    finally:
+        writer.close()
+    return n
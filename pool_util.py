@@ -0,0 +1,138 @@
+import collections
+import threading
+import time
+
+
+class EncodeJob:
+    """
+    A job in the EncoderPool, done is set when it's finished (also when it failed).
+    """
+
+    def __init__(self, fn, args, nbytes, owner=None):
+        self.fn = fn
+        self.args = args
+        self.nbytes = nbytes
+        self.owner = owner
+        self.error = None
+        self.done = threading.Event()
+
+
+class EncoderPool:
+    """
+    A fixed set of encoder threads with a byte-bounded job queue.
+
+    submit() blocks on a condition while the bytes of queued + running jobs would go over max_bytes,
+    so producers wait without polling. The time they spent blocked is tracked in wait_seconds.
+    A single job bigger than max_bytes is still let through when nothing else is in flight.
+
+    A pool can be shared by several recordings, each submits with its own owner.
+    With max_owner_bytes, one owner can't hold more than that, so a busy recording doesn't starve the others.
+    """
+
+    def __init__(self, workers=1, max_bytes=200 * 1024 * 1024, max_owner_bytes=0):
+        self.max_bytes = max_bytes
+        self.max_owner_bytes = max_owner_bytes
+        self.jobs = collections.deque()
+        self.cond = threading.Condition()
+        self.bytes_in_flight = 0
+        # queued + running jobs
+        self.pending = 0
+        # Same, per owner.
+        self.owner_bytes = collections.Counter()
+        self.owner_pending = collections.Counter()
+        self.wait_seconds = 0.0
+        self.waits = 0
+        self.closed = False
+        self.threads = [
+            threading.Thread(target=self._worker, daemon=True, name=f"Encoder-{i}")
+            for i in range(max(1, workers))
+        ]
+        for t in self.threads:
+            t.start()
+
+    def full(self, nbytes, owner=None):
+        if self.bytes_in_flight and self.bytes_in_flight + nbytes > self.max_bytes:
+            return True
+        if owner is None or not self.max_owner_bytes:
+            return False
+        owned = self.owner_bytes[owner]
+        return bool(owned) and owned + nbytes > self.max_owner_bytes
+
+    def submit(self, fn, nbytes, *args, owner=None) -> EncodeJob:
+        """
+        Queues fn(*args), nbytes is how much memory the job holds until it's done.
+        Blocks while the pool (or the owner's share of it) is full.
+        """
+        job = EncodeJob(fn, args, nbytes, owner)
+        with self.cond:
+            if self.closed:
+                raise ValueError("EncoderPool is shut down.")
+            if self.full(nbytes, owner):
+                print("Waiting for encoders... too much memory queued for encoding.")
+                start = time.perf_counter()
+                while self.full(nbytes, owner):
+                    self.cond.wait()
+                self.wait_seconds += time.perf_counter() - start
+                self.waits += 1
+                print("Encoders caught up! Resuming...")
+            self.jobs.append(job)
+            self.bytes_in_flight += nbytes
+            self.pending += 1
+            if owner is not None:
+                self.owner_bytes[owner] += nbytes
+                self.owner_pending[owner] += 1
+            self.cond.notify_all()
+        return job
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                while not self.jobs and not self.closed:
+                    self.cond.wait()
+                if not self.jobs:
+                    return
+                job = self.jobs.popleft()
+
+            try:
+                job.fn(*job.args)
+            except Exception as e:
+                print(f"Encoder job failed: {e}")
+                job.error = e
+            job.done.set()
+
+            with self.cond:
+                self.bytes_in_flight -= job.nbytes
+                self.pending -= 1
+                if job.owner is not None:
+                    self.owner_bytes[job.owner] -= job.nbytes
+                    self.owner_pending[job.owner] -= 1
+                    if not self.owner_pending[job.owner]:
+                        del self.owner_bytes[job.owner]
+                        del self.owner_pending[job.owner]
+                self.cond.notify_all()
+
+    def busy(self, owner=None):
+        if owner is not None:
+            return self.owner_pending[owner] > 0
+        return self.pending > 0
+
+    def queued(self):
+        return len(self.jobs)
+
+    def join(self, owner=None):
+        """
+        Waits until all submitted jobs (of owner, if given) are done.
+        """
+        with self.cond:
+            while self.busy(owner):
+                self.cond.wait()
+
+    def shutdown(self):
+        """
+        Finishes the queued jobs and stops the threads.
+        """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        for t in self.threads:
+            t.join()
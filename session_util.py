@@ -0,0 +1,182 @@
+import asyncio
+import os
+import shutil
+
+import metrics_util as metrics
+from pool_util import EncoderPool
+from spool_util import SpoolScheduler
+
+"""
+Bookkeeping of the recordings that run at the same time, one per guild (a bot can only be in one voice channel per guild).
+All sessions share one encoder pool and one set of finalize slots, so running several doesn't oversubscribe the host.
+Each session gets its own budget: memory for buffers/encoding, and optionally disk.
+"""
+
+
+class RecordingSession:
+    """
+    A recording in a guild, from !start until it's finalized and uploaded.
+    """
+
+    def __init__(self, guild_id: int, channel, vc, sink, folder: str):
+        self.guild_id = guild_id
+        # Text channel the recording was started from, progress goes there.
+        self.channel = channel
+        self.vc = vc
+        self.sink = sink
+        self.folder = folder
+        self.processing = False
+        # Why the recording was stopped by us (e.g. disk budget), None when someone used !stop.
+        self.stop_reason = None
+        # session_ticker task, kept so it isn't garbage collected while it runs.
+        self.ticker = None
+        # Closed parts that are queued or being finalized.
+        self.parts_pending = 0
+
+    def disk_usage(self):
+        return self.sink.disk_usage()
+
+
+class SessionManager:
+    """
+    Keeps track of the running sessions and hands out their shared resources.
+
+    max_sessions recordings can run at once, sessions that are only processing don't count.
+    max_mb_in_mem/max_mb_before_flush are per session, the shared encoder pool holds at most
+    max_mb_in_mem per session and max_mb_in_mem * max_sessions in total.
+    max_disk_mb (0 for no limit) is the most a session's files may take up while recording,
+    a session is only started when there's at least that much free.
+    With spooler_options (SpoolScheduler kwargs), encoding of flushed segments is deferred while the host is busy,
+    one scheduler for all sessions, watching their decode queues together.
+    """
+
+    def __init__(
+        self,
+        max_sessions=1,
+        max_mb_in_mem=200,
+        max_mb_before_flush=100,
+        max_disk_mb=0,
+        encoder_workers=None,
+        finalize_workers=1,
+        spooler_options=None,
+    ):
+        self.max_sessions = max(1, max_sessions)
+        self.max_mb_in_mem = max_mb_in_mem
+        self.max_mb_before_flush = max_mb_before_flush
+        self.max_disk_mb = max_disk_mb
+        self.encoder_workers = encoder_workers or max(1, (os.cpu_count() or 2) - 1)
+        # guild_id -> recording session
+        self.sessions = {}
+        self.processing = []
+        # False until the bot is done starting up (auth, recovery).
+        self.ready = False
+        # Every ffmpeg/7z process of a finalize (combine, overlay, zip), of all sessions.
+        self.finalize_slots = asyncio.Semaphore(max(1, finalize_workers))
+        self._encoder_pool = None
+        self.spooler_options = spooler_options
+        self._spooler = None
+        self.install_metrics()
+
+    @property
+    def encoder_pool(self) -> EncoderPool:
+        if self._encoder_pool is None:
+            self._encoder_pool = EncoderPool(
+                workers=self.encoder_workers,
+                max_bytes=self.max_mb_in_mem * self.max_sessions * 1024 * 1024,
+                max_owner_bytes=self.max_mb_in_mem * 1024 * 1024,
+            )
+        return self._encoder_pool
+
+    @property
+    def spooler(self) -> SpoolScheduler:
+        """
+        None unless deferred encoding is on.
+        """
+        if self._spooler is None and self.spooler_options is not None:
+            self._spooler = SpoolScheduler(
+                self.encoder_pool, self.decode_queue_depth, **self.spooler_options
+            )
+        return self._spooler
+
+    def get(self, guild_id) -> RecordingSession:
+        return self.sessions.get(guild_id)
+
+    def cannot_start(self, guild_id, folder: str):
+        """
+        Returns why a recording can't be started in this guild, None if it can.
+        """
+        if not self.ready:
+            return "I'm still starting up, try again in a bit."
+        if guild_id in self.sessions:
+            return "I'm already recording in this server!"
+        if len(self.sessions) >= self.max_sessions:
+            return f"I'm already recording {len(self.sessions)} channel(s), that's as many as I can handle."
+        if self.max_disk_mb:
+            free = shutil.disk_usage(folder).free
+            if free < self.max_disk_mb * 1024 * 1024:
+                return f"Not enough disk space, a recording needs {self.max_disk_mb}MB free."
+        return None
+
+    def add(self, session: RecordingSession):
+        self.sessions[session.guild_id] = session
+
+    def remove(self, session: RecordingSession):
+        """
+        For a session that failed to start.
+        """
+        if self.sessions.get(session.guild_id) is session:
+            del self.sessions[session.guild_id]
+
+    def stopped(self, session: RecordingSession):
+        """
+        The recording stopped and is being processed, the guild can record again.
+        """
+        self.remove(session)
+        session.processing = True
+        self.processing.append(session)
+
+    def done(self, session: RecordingSession):
+        session.processing = False
+        if session in self.processing:
+            self.processing.remove(session)
+
+    def over_disk_budget(self, session: RecordingSession):
+        return bool(self.max_disk_mb) and session.disk_usage() > self.max_disk_mb * 1024 * 1024
+
+    def all_sessions(self):
+        return list(self.sessions.values()) + list(self.processing)
+
+    def buffered_per_user(self):
+        buffered = {}
+        for session in self.all_sessions():
+            for labels, value in session.sink.buffered_per_user().items():
+                buffered[labels] = buffered.get(labels, 0) + value
+        return buffered
+
+    def decode_queue_depth(self):
+        return sum(
+            len(decoder.decode_queue)
+            for session in list(self.sessions.values())
+            if (decoder := getattr(session.vc, "decoder", None)) is not None
+        )
+
+    def pending_packets(self):
+        return sum(
+            pending.count()
+            for session in list(self.sessions.values())
+            if (pending := getattr(session.vc, "pending", None)) is not None
+        )
+
+    def install_metrics(self):
+        """
+        Points the gauges at the sum over all sessions, they only hold on to the manager.
+        """
+        metrics.BUFFERED_BYTES.set_function(self.buffered_per_user)
+        metrics.DECODE_QUEUE_DEPTH.set_function(self.decode_queue_depth)
+        metrics.PENDING_PACKETS.set_function(self.pending_packets)
+        metrics.ENCODES_PENDING.set_function(
+            lambda: self._encoder_pool.pending if self._encoder_pool else 0
+        )
+        metrics.ENCODER_WAIT_SECONDS.set_function(
+            lambda: self._encoder_pool.wait_seconds if self._encoder_pool else 0
+        )
@@ -0,0 +1,211 @@
+import collections
+import os
+import threading
+import time
+
+import metrics_util as metrics
+
+"""
+Deferred encoding: while the host is busy (cpu or decode queue), flushed segments are spooled to disk as raw pcm
+instead of being encoded right away, and encoded once the load drops, or when their part/recording is finalized.
+Spooling is a plain write to the page cache (or nothing at all for mmap buffers), so capture doesn't wait on encoders.
+"""
+
+
+class CPUSampler:
+    """
+    Busy fraction of all cpus since the last sample, from /proc/stat (falls back to the load average).
+    """
+
+    def __init__(self):
+        self.last = self.read()
+
+    @staticmethod
+    def read():
+        try:
+            with open("/proc/stat", "r") as f:
+                values = [int(v) for v in f.readline().split()[1:]]
+        except (OSError, ValueError):
+            return None
+        # idle + iowait
+        idle = values[3] + (values[4] if len(values) > 4 else 0)
+        return sum(values), idle
+
+    def sample(self) -> float:
+        now = self.read()
+        if now is None or self.last is None:
+            try:
+                return os.getloadavg()[0] / (os.cpu_count() or 1)
+            except OSError:
+                return 0.0
+        total, idle = now[0] - self.last[0], now[1] - self.last[1]
+        self.last = now
+        if total <= 0:
+            return 0.0
+        return 1 - idle / total
+
+
+class SpooledSegment:
+    """
+    A flushed segment waiting in a pcm buffer on disk, stands in for its EncodeJob (done is set once it's encoded).
+    """
+
+    def __init__(self, encode, buffer, nbytes, owner):
+        self.encode = encode
+        self.buffer = buffer
+        self.nbytes = nbytes
+        self.owner = owner
+        # Encode as soon as possible, e.g. its part is being finalized.
+        self.urgent = False
+        # Being handed to the pool (which can block), it stays in the spool until it's in.
+        self.submitting = False
+        self.error = None
+        self.done = threading.Event()
+
+    def run(self):
+        try:
+            self.encode()
+        except Exception as e:
+            self.error = e
+            raise
+        finally:
+            self.done.set()
+
+
+class SpoolScheduler(threading.Thread):
+    """
+    Decides for every flushed segment whether it's encoded now or spooled, and feeds the spool to the encoder pool.
+
+    The host counts as busy from cpu_high (busy fraction of all cpus) or queue_high (packets in the decode queues)
+    until both are below cpu_low/queue_low again. Segments are also spooled when the encoder pool is full,
+    instead of blocking capture. The spool holds at most max_bytes, past that segments go to the pool as usual.
+    Spooled segments are encoded oldest first while the host isn't busy, urgent ones right away.
+    """
+
+    def __init__(
+        self,
+        pool,
+        queue_depth=lambda: 0,
+        cpu_high=0.85,
+        cpu_low=0.5,
+        queue_high=500,
+        queue_low=50,
+        max_bytes=2048 * 1024 * 1024,
+        interval=1.0,
+    ):
+        super().__init__(daemon=True, name="SpoolScheduler")
+        self.pool = pool
+        self.queue_depth = queue_depth
+        self.cpu_high = cpu_high
+        self.cpu_low = cpu_low
+        self.queue_high = queue_high
+        self.queue_low = queue_low
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.cpu = CPUSampler()
+        self.busy = False
+        self.spool = collections.deque()
+        self.spooled_bytes = 0
+        self.cond = threading.Condition()
+        metrics.SPOOLED_BYTES.set_function(lambda: self.spooled_bytes)
+        self.start()
+
+    def should_spool(self, nbytes, owner) -> bool:
+        if self.spooled_bytes + nbytes > self.max_bytes:
+            return False
+        return self.busy or self.pool.full(nbytes, owner)
+
+    def add(self, segment: SpooledSegment):
+        with self.cond:
+            self.spool.append(segment)
+            self.spooled_bytes += segment.nbytes
+            self.cond.notify_all()
+        metrics.SEGMENTS_SPOOLED.inc()
+
+    def pending(self, owner=None) -> bool:
+        with self.cond:
+            return any(owner is None or s.owner is owner for s in self.spool)
+
+    def expedite(self, jobs):
+        """
+        Encodes the spooled ones among jobs right away, whatever the load.
+        """
+        with self.cond:
+            for job in jobs:
+                if isinstance(job, SpooledSegment):
+                    job.urgent = True
+            self.cond.notify_all()
+
+    def drain(self, owner):
+        """
+        Hands all of owner's spooled segments to the encoder pool (blocks while it's full), for finalizing.
+        Returns once they're all in the pool, pool.join(owner) then waits for the encodes.
+        """
+        with self.cond:
+            segments = [s for s in self.spool if s.owner is owner and not s.submitting]
+            for segment in segments:
+                segment.submitting = True
+        for segment in segments:
+            self.submit(segment)
+        with self.cond:
+            # The scheduler thread might still be submitting one of ours.
+            while any(s.owner is owner for s in self.spool):
+                self.cond.wait()
+
+    def submit(self, segment: SpooledSegment):
+        try:
+            self.pool.submit(segment.run, segment.nbytes, owner=segment.owner)
+        except ValueError as e:
+            # Pool is shut down, nothing will encode it anymore (the spool file is left for recovery).
+            print(f"Could not encode spooled segment {segment.buffer.path}: {e}")
+            segment.error = e
+            segment.done.set()
+        finally:
+            with self.cond:
+                self.spool.remove(segment)
+                self.spooled_bytes -= segment.nbytes
+                self.cond.notify_all()
+
+    def update_load(self):
+        cpu = self.cpu.sample()
+        depth = self.queue_depth()
+        if self.busy:
+            self.busy = cpu > self.cpu_low or depth > self.queue_low
+        else:
+            self.busy = cpu >= self.cpu_high or depth >= self.queue_high
+
+    def next_segment(self):
+        """
+        The next segment to encode: an urgent one, or the oldest when the host isn't busy.
+        Only ones that fit in the pool, so this thread doesn't hold up capture's submits by waiting in line.
+        """
+        with self.cond:
+            waiting = [
+                s
+                for s in self.spool
+                if not s.submitting and not self.pool.full(s.nbytes, s.owner)
+            ]
+            segment = next((s for s in waiting if s.urgent), None)
+            if segment is None and waiting and not self.busy:
+                segment = waiting[0]
+            if segment is not None:
+                segment.submitting = True
+            return segment
+
+    def run(self):
+        next_sample = 0
+        while True:
+            now = time.monotonic()
+            if now >= next_sample:
+                self.update_load()
+                next_sample = now + self.interval
+            segment = self.next_segment()
+            if segment is not None:
+                self.submit(segment)
+                continue
+            with self.cond:
+                timeout = max(0.0, next_sample - time.monotonic())
+                if any(not s.submitting and (s.urgent or not self.busy) for s in self.spool):
+                    # Waiting for room in the pool, it doesn't tell us when there is.
+                    timeout = min(timeout, 0.1)
+                self.cond.wait(timeout)
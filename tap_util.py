@@ -0,0 +1,209 @@
+import asyncio
+import collections
+import threading
+import time
+
+import metrics_util as metrics
+
+"""
+Live pcm tap: lets in-process consumers (level meters, previews, analysis) follow the audio of a recording
+without a second sink. Every frame is published once as a read-only memoryview of the decoded data
+and the same view is handed to all subscribers, nothing is copied per subscriber.
+Each subscriber has a bounded queue that drops its oldest frames when it falls behind, publishing never waits.
+"""
+
+# Key of the mixed stream (only published with a live mix).
+MIX = "mix"
+
+
+class TapFrame:
+    """
+    A frame of 48kHz 16 bit stereo pcm. pcm is read-only and shared with the other subscribers,
+    copy it (bytes(frame.pcm)) to keep it around longer than a frame.
+    """
+
+    __slots__ = ("user", "pcm", "time")
+
+    def __init__(self, user, pcm: memoryview, t: float):
+        # user_id, or MIX
+        self.user = user
+        self.pcm = pcm
+        # perf_counter() when it was published.
+        self.time = t
+
+
+class TapSubscription:
+    """
+    A subscriber's queue of frames. Iterate it with async for (from the loop it was made on),
+    get frames with get_nowait(), or give PCMTap.subscribe a callback.
+    Iteration ends once the subscription or the tap is closed.
+    """
+
+    def __init__(self, tap, users, maxsize: int, callback=None, loop=None):
+        self.tap = tap
+        # None for every user (not the mix).
+        self.users = users
+        self.callback = callback
+        self.frames = collections.deque(maxlen=max(1, maxsize))
+        self.lock = threading.Lock()
+        self.dropped = 0
+        self.closed = False
+        self.loop = loop
+        # Only wake the loop when someone's waiting, so publishing stays cheap.
+        self.waiting = False
+        self.event = asyncio.Event() if loop is not None else None
+
+    def wants(self, user) -> bool:
+        if self.users is None:
+            return user != MIX
+        return user in self.users
+
+    def offer(self, frame: TapFrame):
+        with self.lock:
+            if len(self.frames) == self.frames.maxlen:
+                # deque drops the oldest one itself.
+                self.dropped += 1
+                metrics.TAP_DROPPED.inc()
+            self.frames.append(frame)
+            wake = self.waiting
+            self.waiting = False
+        if wake:
+            self.loop.call_soon_threadsafe(self.event.set)
+
+    def get_nowait(self):
+        """
+        Oldest queued frame, None if there's none.
+        """
+        with self.lock:
+            return self.frames.popleft() if self.frames else None
+
+    def close(self):
+        self.tap.unsubscribe(self)
+        with self.lock:
+            self.closed = True
+            wake = self.waiting
+            self.waiting = False
+        if wake:
+            self.loop.call_soon_threadsafe(self.event.set)
+
+    def __aiter__(self):
+        if self.loop is None:
+            raise RuntimeError("Subscribe from a running event loop to iterate asynchronously.")
+        return self
+
+    async def __anext__(self) -> TapFrame:
+        while True:
+            with self.lock:
+                if self.frames:
+                    return self.frames.popleft()
+                if self.closed:
+                    raise StopAsyncIteration
+                self.event.clear()
+                self.waiting = True
+            await self.event.wait()
+
+
+class PCMTap:
+    """
+    Fans frames out to the subscribers. publish() is called from the recording thread(s),
+    it only appends to the subscribers' queues, callbacks run on a dispatch thread of the tap.
+    """
+
+    def __init__(self):
+        self.subscriptions = []
+        self.lock = threading.Lock()
+        self.closed = False
+        self.dispatch_cond = threading.Condition()
+        self.dispatch_thread = None
+
+    def subscribe(self, users=None, maxsize=50, callback=None) -> TapSubscription:
+        """
+        users: None for every user's frames, MIX for the mixed stream, or an iterable of user ids (MIX included).
+        maxsize frames are queued (50 is a second of audio for users), older ones are dropped.
+        callback(frame) is called from the tap's dispatch thread, without it the subscription is iterated
+        or polled. Call close() on the subscription when done.
+        """
+        if users is not None:
+            users = {users} if isinstance(users, (int, str)) else set(users)
+        try:
+            loop = asyncio.get_running_loop() if callback is None else None
+        except RuntimeError:
+            loop = None
+        subscription = TapSubscription(self, users, maxsize, callback, loop)
+        with self.lock:
+            if self.closed:
+                subscription.closed = True
+                return subscription
+            # Copy on write, publish() iterates without the lock.
+            self.subscriptions = self.subscriptions + [subscription]
+        if callback is not None:
+            self.start_dispatch()
+        return subscription
+
+    def unsubscribe(self, subscription: TapSubscription):
+        with self.lock:
+            self.subscriptions = [s for s in self.subscriptions if s is not subscription]
+
+    def publish(self, user, data):
+        """
+        Hands a frame of pcm (bytes, bytearray or memoryview) to the subscribers that want it.
+        """
+        subscriptions = self.subscriptions
+        if not subscriptions:
+            return
+        frame = None
+        callbacks = False
+        for subscription in subscriptions:
+            if not subscription.wants(user):
+                continue
+            if frame is None:
+                frame = TapFrame(user, memoryview(data).toreadonly(), time.perf_counter())
+            subscription.offer(frame)
+            callbacks = callbacks or subscription.callback is not None
+        if callbacks:
+            with self.dispatch_cond:
+                self.dispatch_cond.notify()
+
+    def start_dispatch(self):
+        with self.dispatch_cond:
+            if self.dispatch_thread is None:
+                self.dispatch_thread = threading.Thread(
+                    target=self.dispatch, daemon=True, name="PCMTapDispatch"
+                )
+                self.dispatch_thread.start()
+
+    def dispatch(self):
+        """
+        Runs the callbacks of the subscriptions with queued frames, a slow callback only makes its own queue drop.
+        """
+        while True:
+            delivered = False
+            for subscription in self.subscriptions:
+                if subscription.callback is None:
+                    continue
+                frame = subscription.get_nowait()
+                while frame is not None:
+                    delivered = True
+                    try:
+                        subscription.callback(frame)
+                    except Exception as e:
+                        print(f"Tap callback failed: {e}")
+                    frame = subscription.get_nowait()
+            with self.dispatch_cond:
+                if self.closed and not delivered:
+                    self.dispatch_thread = None
+                    return
+                if not delivered:
+                    self.dispatch_cond.wait(0.5)
+
+    def close(self):
+        """
+        Ends all subscriptions, for when the recording stops.
+        """
+        with self.lock:
+            self.closed = True
+            subscriptions = self.subscriptions
+        for subscription in subscriptions:
+            subscription.close()
+        with self.dispatch_cond:
+            self.dispatch_cond.notify()
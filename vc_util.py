@@ -1,13 +1,16 @@
 import asyncio
+import collections
 import gc
 import io
+import math
+import mmap
 import multiprocessing as mp
+import multiprocessing.connection
 import os
 import select
-import struct
-import sys
 import threading
 import time
+import uuid
 from datetime import datetime
 
 import discord
@@ -15,19 +18,35 @@ import discord.opus as opus
 from discord.opus import DecodeManager, OpusError
 from discord.sinks import (AudioData, Filters, MP3Sink, RawData,
                            RecordingException)
-from dotenv import dotenv_values
 
-from ffmpeg_util import write_wav_btyes_to_mp3_file
-
-# globals
-config = dotenv_values(".env")
-
-MAX_MB_BEFORE_FLUSH = int(config["MAX_MB_BEFORE_FLUSH"])
+import metrics_util as metrics
+from capture_util import PacketCaptureWriter
+from codec_util import get_profile
+from ffmpeg_util import FFmpegStreamEncoder, write_wav_btyes_to_mp3_file
+from opus_util import SILENCE_FRAME, OpusPacketWriter, packet_silence
+from pool_util import EncoderPool
+from spool_util import SpooledSegment
+from tap_util import PCMTap
 
 """
 Reimplements some pycord classes to allow flushing audio data to disk when it gets too big.
 """
 
+# 48kHz, 16 bit stereo pcm.
+PCM_BYTES_PER_SECOND = 48000 * 2 * 2
+
+# Most datagrams read from the voice socket per wakeup.
+RECV_BATCH = 256
+# Backoff while the socket is broken, capped so a reconnect is picked up quickly.
+RECV_BACKOFF = 0.05
+RECV_BACKOFF_MAX = 2.0
+# Stop recording when the socket stays broken this long.
+RECV_GIVE_UP_SECONDS = 60
+
+# How much is held per ssrc that isn't mapped to a user yet, older packets are dropped.
+PENDING_MAX_SECONDS = 10
+PENDING_MAX_BYTES = 4 * 1024 * 1024
+
 
 class MemoryConciousAudioData(AudioData):
     """
@@ -37,6 +56,30 @@ class MemoryConciousAudioData(AudioData):
     def __init__(self, file):
         super().__init__(file)
         self.files_on_disk = []
+        # Only used in streaming mode, one encoder per user for the whole recording.
+        self.encoder = None
+        # Only used by OpusPacketSink, the user's packet file.
+        self.packets = None
+        # Silence markers for the current buffer, (byte offset, byte length).
+        # The zeros are only generated when the buffer gets encoded.
+        self.gaps = []
+        # Encode jobs of the flushed files.
+        self.jobs = []
+        # Only used when rotating, bytes into the recording and the part the buffer belongs to.
+        self.position = 0
+        self.part = 0
+        # Bytes (audio + silence) flushed into the user's track so far, for the journal.
+        self.track_bytes = 0
+
+    def add_gap(self, n):
+        """
+        Marks n bytes of silence at the current end of the buffer.
+        """
+        offset = self.file.tell()
+        if self.gaps and self.gaps[-1][0] == offset:
+            self.gaps[-1] = (offset, self.gaps[-1][1] + n)
+        else:
+            self.gaps.append((offset, n))
 
     def get_actual_files(self):
         """
@@ -51,6 +94,105 @@ class MemoryConciousAudioData(AudioData):
         return
 
 
+class MmapPCMBuffer:
+    """
+    Fixed-size pcm buffer backed by a memory-mapped spill file, stands in for the BytesIO of a user.
+    The data lives in the page cache instead of the python heap, so the kernel can write it back
+    to the spill file under memory pressure, and the heap doesn't grow or fragment over long sessions.
+    Encoders read the filled part zero-copy through getbuffer().
+    """
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.pos = 0
+        # Parked for deferred encoding, closed instead of reused once it's encoded.
+        self.spooled = False
+        self.file = open(path, "w+b")
+        # Sparse file, only written pages take up space.
+        self.file.truncate(size)
+        self.mm = mmap.mmap(self.file.fileno(), size)
+
+    def remaining(self):
+        return self.size - self.pos
+
+    def write(self, data):
+        n = len(data)
+        if self.pos + n > self.size:
+            raise ValueError(f"Spill buffer {self.path} is full.")
+        self.mm[self.pos : self.pos + n] = data
+        self.pos += n
+        return n
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, pos, whence=0):
+        if whence != 0:
+            raise ValueError("Only absolute seeks are supported.")
+        self.pos = min(pos, self.size)
+        return self.pos
+
+    def truncate(self, size=None):
+        self.pos = min(self.pos if size is None else size, self.pos)
+        return self.pos
+
+    def getbuffer(self):
+        return memoryview(self.mm)[: self.pos]
+
+    def getvalue(self):
+        return bytes(self.getbuffer())
+
+    def reset(self):
+        """
+        Empties the buffer for reuse, dropping the old pages so they're never written back.
+        """
+        self.pos = 0
+        self.file.truncate(0)
+        self.file.truncate(self.size)
+
+    def close(self):
+        self.mm.close()
+        self.file.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class RecordingPart:
+    """
+    A closed part of a rotating recording, see MemoryConsiousMP3Sink.
+    files has the segments of each user (user_id -> [fn]), they're time-aligned to the start of the part.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.files = {}
+        self.jobs = []
+        # Timeline range of the part in pcm bytes, end is exclusive.
+        self.start = 0
+        self.end = 0
+
+    def wait_encoded(self):
+        """
+        Blocks until all segments of the part are encoded.
+        """
+        for job in self.jobs:
+            job.done.wait()
+
+    def get_actual_files(self):
+        """
+        user_id -> segments that made it to disk.
+        """
+        files = {}
+        for user_id, fns in self.files.items():
+            fns = [fn for fn in fns if os.path.exists(fn) and os.path.getsize(fn) > 0]
+            if fns:
+                files[user_id] = fns
+        return files
+
+
 # override mp3sink, write is in memory...
 class MemoryConsiousMP3Sink(MP3Sink):
     """
@@ -63,6 +205,36 @@ class MemoryConsiousMP3Sink(MP3Sink):
 
     We have a file per user, and we write to the file as we receive audio data.
     During write method, we check how big the bytesIO has gotten, and if it's too big, we flush to a file.
+
+    With streaming=True, each user gets one long-lived ffmpeg process when they first speak.
+    Audio goes straight into it, so there are no flushes, no segments and nothing to concatenate.
+
+    With a mixer (mix_util.LiveMixer), all audio goes into the live mix instead of per-user tracks.
+    The combined track is then ready as soon as the recording stops.
+
+    With buffer_backend="mmap", users' pcm goes into fixed-size MmapPCMBuffers (see there) instead of BytesIO.
+    On flush the filled buffer is handed to the encoder as-is and swapped for an empty one, nothing is copied.
+
+    Flushed buffers are encoded by an EncoderPool (encoder_workers threads), which holds at most max_size_mb.
+    When it's full, flushing blocks until an encoder is done.
+    Segments (and streamed tracks) are encoded with the segment_format codec profile (see codec_util), e.g. mp3,
+    flac so the final mix is the only lossy encode, or opus32 to save cpu and disk.
+    output_profile is the profile of the combined track, the sink only uses it for the live mix.
+
+    tap (tap_util.PCMTap) publishes the decoded audio of every user (and the live mix) to in-process subscribers,
+    e.g. sink.tap.subscribe(user_id). It's made by the sink unless one is passed in (the live mix has to publish
+    to the same one), and closed when the recording stops.
+
+    With a spooler (spool_util.SpoolScheduler, shares its encoder pool), flushed buffers are spooled to disk
+    as raw pcm instead of being encoded while the host is busy or the pool is full, and encoded once load drops.
+    Leftover spooled segments are encoded when their part is closed or the recording is cleaned up.
+
+    With rotate_seconds and/or rotate_mb (segment mode only), the recording is cut into parts while it runs.
+    Every user has a position on the recording's timeline (needs sync_start), a write that crosses the end
+    of a part is split, and the rest goes into the next part. rotate_grace seconds after a part ended it's
+    closed: the leftover buffers are flushed and on_part_closed(RecordingPart) is called, from the recording thread.
+    rotate_mb ends the part at the newest audio once the part has that much decoded audio.
+    Audio that arrives for an already closed part is moved to the start of the open part.
     """
 
     def __init__(
@@ -73,60 +245,102 @@ class MemoryConsiousMP3Sink(MP3Sink):
         max_size_mb=200,
         output_folder="output",
         output_fn=None,
+        streaming=False,
+        mixer=None,
+        buffer_backend="memory",
+        encoder_workers=None,
+        encoder_pool=None,
+        rotate_seconds=0,
+        rotate_mb=0,
+        rotate_grace=10,
+        on_part_closed=None,
+        journal=None,
+        segment_format="mp3",
+        output_profile="mp3",
+        spooler=None,
+        tap=None,
     ):
         super().__init__(filters=filters)
         self.max_mb_before_flush = max_before_flush
         self.max_size_mb = max_size_mb
         self.output_folder = output_folder
-        self.write_threads = []
+        self.streaming = streaming
+        self.mixer = mixer
+        self.buffer_backend = buffer_backend
+        self.segment_format = segment_format
+        # Unknown profiles fail here, not in an encoder thread.
+        self.segment_extension = get_profile(segment_format).extension
+        self.output_profile = output_profile
+        # Running counter, so the flush check per packet doesn't loop over users.
+        self.flush_threshold = max_before_flush * 1024 * 1024
+        self.total_buffered = 0
+        self.spooler = spooler
+        if spooler is not None and encoder_pool is None:
+            encoder_pool = spooler.pool
+        # A pool can be passed in to share it, otherwise we start our own on the first flush.
+        self.owns_encoder_pool = encoder_pool is None
+        self.encoder_workers = encoder_workers
+        self._encoder_pool = encoder_pool
         if output_fn:
             self.output_fn = output_fn
         os.makedirs(output_folder, exist_ok=True)
+        # Emptied mmap buffers, ready for reuse.
+        self.free_buffers = []
+        self.free_buffers_lock = threading.Lock()
+        self.spill_folder = f"{output_folder}/spill"
+        if buffer_backend == "mmap":
+            os.makedirs(self.spill_folder, exist_ok=True)
+        self.started = datetime.now()
+        # Rotation, all positions are in pcm bytes on the recording's timeline.
+        self.rotating = bool(rotate_seconds or rotate_mb) and not streaming and mixer is None
+        self.rotate_bytes = int(rotate_seconds * PCM_BYTES_PER_SECOND) // 4 * 4
+        self.rotate_size = rotate_mb * 1024 * 1024
+        self.grace_bytes = int(rotate_grace * PCM_BYTES_PER_SECOND)
+        self.on_part_closed = on_part_closed
+        # End of each part, time based ones are added as needed.
+        self.boundaries = []
+        # Oldest part that isn't closed yet.
+        self.open_part = 0
+        self.parts = {}
+        # Decoded audio bytes per part, for rotate_mb.
+        self.part_sizes = collections.Counter()
+        self.head = 0
+        self.late_bytes = 0
+        self.timeline_start = None
+        # Writes come from the decoder, rotation checks from the bot as well.
+        self.rotate_lock = threading.RLock()
+        # journal_util.SegmentJournal, segments are logged so a crashed recording can be recovered.
+        self.journal = journal
+        self.tap = tap if tap is not None else PCMTap()
 
-    def get_total_size(self):
-        return sum([audio.file.tell() for audio in self.audio_data.values()])
+    @property
+    def encoder_pool(self) -> EncoderPool:
+        if self._encoder_pool is None:
+            workers = self.encoder_workers or max(1, mp.cpu_count() - 1)
+            self._encoder_pool = EncoderPool(
+                workers=workers, max_bytes=self.max_size_mb * 1024 * 1024
+            )
+        return self._encoder_pool
 
-    def should_flush(self, n=0):
-        """
-        Checks if we should flush the audio data to a file.
-        n is bytessize if we want to check if we will go over the limit.
-        """
-        # print(f"Total size: {self.get_total_size() / (1024 * 1024)}")
-        # print(f"Max size: {self.max_mb_before_flush}")
-        return self.get_total_size() + n > (self.max_mb_before_flush * 1024 * 1024)
+    def get_total_size(self):
+        return self.total_buffered
 
-    def should_wait_for_memory(self, n=0):
+    def buffered_per_user(self):
         """
-        We should await when we have too much memory in threads OR if we have too many threads already running.
+        user_id -> pcm bytes in their buffer, for the metrics.
         """
-        # print(f"Memory in threads: {self.mem_in_threads / (1024 * 1024)}")
-        # print(f"Max thread size: {self.max_size_mb}")
+        return {
+            (str(user_id),): audio.file.tell()
+            for user_id, audio in list(self.audio_data.items())
+            if not getattr(audio.file, "closed", False)
+        }
 
-        # Max threads allowed is at least 1, but at most cpu_count - 1.
-        max_threads_allowed = min(1, mp.cpu_count() - 1)
-        return (self.mem_in_threads() + n > (self.max_size_mb * 1024 * 1024)) or len(
-            self.write_threads
-        ) >= max_threads_allowed
-
-    def mem_in_threads(self):
-        # First reomve dead threads
-        new_write_threads = []
-        for t, size in self.write_threads:
-            if t.is_alive():
-                new_write_threads.append((t, size))
-        self.write_threads = new_write_threads
-        return sum([size for t, size in self.write_threads if t.is_alive()])
-
-    def await_free_mem(self):
+    def should_flush(self, n=0):
         """
-        Waits for the memory to be freed by the threads.
-        Decoder might back up, but we can't do much about that.
+        Checks if we should flush the audio data to a file.
+        n is bytessize if we want to check if we will go over the limit.
         """
-        print("Waiting for memory to be freed... too much memory stuck in threads.")
-        while self.should_wait_for_memory():
-            time.sleep(0.1)
-        gc.collect()
-        print("Memory freed! Resuming...")
+        return self.total_buffered + n > self.flush_threshold
 
     def flushToFiles(self, force_all=False):
         """
@@ -140,7 +354,6 @@ class MemoryConsiousMP3Sink(MP3Sink):
                     f"Wrong AudioData instance for {self.__class__.__name__}, needs to be MemoryConciousAudioData"
                 )
 
-            fn = f"{self.output_folder}/{user_id}_{datetime.now().strftime('%Y%m%d%H%M%S%f')}.mp3"
             audio_size = audio.file.tell()
             # Check if empty, if it is, we don't need to write to a file.
             if audio_size == 0:
@@ -155,25 +368,112 @@ class MemoryConsiousMP3Sink(MP3Sink):
                 and not current_size_too_big
             ):
                 continue
-            audio.files_on_disk.append(fn)
-            if self.should_wait_for_memory(audio_size):
-                self.await_free_mem()
-            t = threading.Thread(
-                target=write_wav_btyes_to_mp3_file,
-                args=(
-                    io.BytesIO(audio.file.getvalue()),
-                    fn,
-                ),
+            self.flush_user(user_id, audio)
+
+    def flush_user(self, user_id, audio: MemoryConciousAudioData):
+        """
+        Hands the user's buffer to an encoder thread and gives them a fresh one.
+        """
+        fn = f"{self.output_folder}/{user_id}_{datetime.now().strftime('%Y%m%d%H%M%S%f')}.{self.segment_extension}"
+        audio_size = audio.file.tell()
+        audio.files_on_disk.append(fn)
+        # The encoder gets the filled buffer itself, so no copy.
+        buffer, gaps = audio.file, audio.gaps
+        audio.file = self.new_buffer()
+        audio.gaps = []
+        self.total_buffered -= audio_size
+        segment_bytes = audio_size + sum(n for _, n in gaps)
+        if self.journal is not None:
+            self.journal.append(
+                "segment_started",
+                user=user_id,
+                fn=fn,
+                part=audio.part,
+                start=audio.track_bytes / PCM_BYTES_PER_SECOND,
+                end=(audio.track_bytes + segment_bytes) / PCM_BYTES_PER_SECOND,
+            )
+        audio.track_bytes += segment_bytes
+        if (
+            self.spooler is not None
+            and audio_size
+            and self.spooler.should_spool(audio_size, self)
+        ):
+            job = self.spool_buffer(buffer, fn, gaps, user_id, audio.part, audio_size)
+        else:
+            # Blocks while the encoders have too much memory queued.
+            # Decoder might back up, but we can't do much about that.
+            job = self.encoder_pool.submit(
+                self.encode_buffer, audio_size, buffer, fn, gaps, user_id, audio.part, owner=self
+            )
+        audio.jobs.append(job)
+        return job
+
+    def spool_buffer(self, buffer, fn, gaps, user_id, part, nbytes) -> SpooledSegment:
+        """
+        Parks a flushed buffer on disk for the spooler instead of encoding it now.
+        mmap buffers already are on disk, BytesIO ones are written to a spill file of their own.
+        """
+        if not isinstance(buffer, MmapPCMBuffer):
+            os.makedirs(self.spill_folder, exist_ok=True)
+            spool = MmapPCMBuffer(f"{self.spill_folder}/{uuid.uuid4().hex}.pcm", nbytes)
+            spool.write(buffer.getbuffer()[:nbytes])
+            self.release_buffer(buffer)
+            buffer = spool
+        buffer.spooled = True
+        if self.journal is not None:
+            self.journal.append(
+                "segment_spooled",
+                user=user_id,
+                fn=fn,
+                part=part,
+                spool=buffer.path,
+                bytes=nbytes,
+                gaps=gaps,
+                format=self.segment_format,
+            )
+        segment = SpooledSegment(
+            lambda: self.encode_buffer(buffer, fn, gaps, user_id, part), buffer, nbytes, self
+        )
+        self.spooler.add(segment)
+        return segment
+
+    def new_buffer(self):
+        if self.buffer_backend != "mmap":
+            return io.BytesIO()
+        with self.free_buffers_lock:
+            if self.free_buffers:
+                return self.free_buffers.pop()
+        return MmapPCMBuffer(
+            f"{self.spill_folder}/{uuid.uuid4().hex}.pcm",
+            self.max_mb_before_flush * 1024 * 1024,
+        )
+
+    def release_buffer(self, buffer):
+        if isinstance(buffer, MmapPCMBuffer) and not buffer.spooled:
+            buffer.reset()
+            with self.free_buffers_lock:
+                self.free_buffers.append(buffer)
+        else:
+            try:
+                buffer.close()
+            except BufferError:
+                # Still referenced by a failed encode, gc will get it.
+                pass
+
+    def encode_buffer(self, buffer, fn, gaps, user_id=None, part=0):
+        nbytes = buffer.tell()
+        start = time.perf_counter()
+        try:
+            success = write_wav_btyes_to_mp3_file(buffer, fn, gaps, self.segment_format)
+        finally:
+            self.release_buffer(buffer)
+        metrics.ENCODED_BYTES.inc(nbytes)
+        metrics.ENCODE_SECONDS.inc(time.perf_counter() - start)
+        # A failed encode stays a segment_started only, it might be cut off or empty.
+        if success and self.journal is not None and os.path.exists(fn):
+            self.journal.append(
+                "segment", user=user_id, fn=fn, part=part, bytes=os.path.getsize(fn)
             )
-            t.start()
-            # keep track of threads, so we can wait for them later.
-            self.write_threads.append((t, audio_size))
-            # Possibly await here too, might be a big one.
-            if self.should_wait_for_memory():
-                self.await_free_mem()
-            # now we can wipe the current BytesIO
-            audio.file.seek(0)
-            audio.file.truncate(0)
 
     def format_audio(self, audio):
         """
@@ -182,22 +482,221 @@ class MemoryConsiousMP3Sink(MP3Sink):
         """
         return
 
+    def get_audio(self, user) -> MemoryConciousAudioData:
+        """
+        Gets the AudioData of a user, creates it on their first write.
+        In streaming mode this also starts their encoder.
+        """
+        if user not in self.audio_data:
+            if not self.streaming:
+                audio = MemoryConciousAudioData(self.new_buffer())
+            else:
+                audio = MemoryConciousAudioData(io.BytesIO())
+                fn = f"{self.output_folder}/{user}_{datetime.now().strftime('%Y%m%d%H%M%S%f')}.{self.segment_extension}"
+                audio.encoder = FFmpegStreamEncoder(fn, output_format=self.segment_format)
+                audio.files_on_disk.append(fn)
+                if self.journal is not None:
+                    self.journal.append("segment_started", user=user, fn=fn, part=0)
+            self.audio_data.update({user: audio})
+        return self.audio_data[user]
+
+    def part_end(self, k):
+        """
+        Timeline position where part k ends, inf if that's not known yet (size based rotation).
+        """
+        while self.rotate_bytes and len(self.boundaries) <= k:
+            self.boundaries.append(
+                (self.boundaries[-1] if self.boundaries else 0) + self.rotate_bytes
+            )
+        return self.boundaries[k] if k < len(self.boundaries) else math.inf
+
+    def part_start(self, k):
+        return 0 if k == 0 else self.part_end(k - 1)
+
+    def get_part(self, k) -> RecordingPart:
+        if k not in self.parts:
+            self.parts[k] = RecordingPart(k)
+        return self.parts[k]
+
+    def cut_part(self, k):
+        """
+        Ends part k at the newest audio, for the size limit.
+        """
+        if k:
+            self.part_end(k - 1)
+        head = (self.head + 3) // 4 * 4
+        if k < len(self.boundaries):
+            if self.boundaries[k] <= head:
+                return
+            self.boundaries[k] = head
+            # Time based ends after this one move along.
+            del self.boundaries[k + 1 :]
+        else:
+            self.boundaries.append(head)
+
+    def end_user_part(self, user_id, audio: MemoryConciousAudioData):
+        """
+        Flushes what the user has in their current part and moves them to the next one.
+        """
+        if audio.file.tell():
+            self.flush_user(user_id, audio)
+        # Trailing silence doesn't need to be encoded.
+        audio.gaps = []
+        part = self.get_part(audio.part)
+        if audio.files_on_disk:
+            part.files[user_id] = audio.files_on_disk
+            part.jobs.extend(audio.jobs)
+        audio.files_on_disk = []
+        audio.jobs = []
+        audio.track_bytes = 0
+        audio.part += 1
+
+    def advance(self, user_id, audio: MemoryConciousAudioData, n, data=None):
+        """
+        Moves a user n bytes forward on the timeline, with data (audio) or without (silence).
+        Whatever goes past the end of the user's part is written into the next part.
+        """
+        if self.timeline_start is None:
+            self.timeline_start = time.perf_counter()
+        if audio.part < self.open_part:
+            audio.part = self.open_part
+        start = self.part_start(audio.part)
+        if audio.position < start:
+            if data is None:
+                # Silence in a closed part is just skipped.
+                n -= start - audio.position
+                if n <= 0:
+                    audio.position = start + n
+                    return
+            else:
+                self.late_bytes += start - audio.position
+            audio.position = start
+
+        while n > 0:
+            k = min(n, self.part_end(audio.part) - audio.position)
+            if k > 0:
+                if data is None:
+                    audio.add_gap(k)
+                else:
+                    chunk = data if k == n else data[:k]
+                    self.buffer_pcm(user_id, audio, chunk)
+                    self.part_sizes[audio.part] += k
+                    data = data[k:] if k < n else None
+                audio.position += k
+                n -= k
+            if n > 0:
+                self.end_user_part(user_id, audio)
+
+        self.head = max(self.head, audio.position)
+        if self.rotate_size and self.part_sizes[audio.part] > self.rotate_size:
+            self.cut_part(audio.part)
+
+    def close_part(self, k):
+        """
+        Closes part k: flushes the users still in it and hands it to on_part_closed.
+        """
+        for user_id, audio in self.audio_data.items():
+            if audio.part == k:
+                self.end_user_part(user_id, audio)
+        part = self.parts.pop(k, None) or RecordingPart(k)
+        part.start, part.end = self.part_start(k), self.part_end(k)
+        self.part_sizes.pop(k, None)
+        self.open_part = k + 1
+        if self.spooler is not None:
+            # The part is finalized next, its spooled segments can't wait for the load to drop.
+            self.spooler.expedite(part.jobs)
+        if self.journal is not None:
+            self.journal.append("part_closed", part=k)
+        if self.late_bytes:
+            print(
+                f"Rotation: {self.late_bytes / PCM_BYTES_PER_SECOND:.2f}s of late audio was moved forward."
+            )
+            self.late_bytes = 0
+        if part.files and self.on_part_closed is not None:
+            self.on_part_closed(part)
+
+    def rotate_if_due(self):
+        """
+        Closes the parts that ended more than rotate_grace ago.
+        Also called from the bot, so parts get closed when nobody's talking.
+        """
+        if not self.rotating or self.finished or self.timeline_start is None:
+            return
+        with self.rotate_lock:
+            now = (time.perf_counter() - self.timeline_start) * PCM_BYTES_PER_SECOND
+            while now >= self.part_end(self.open_part) + self.grace_bytes:
+                self.close_part(self.open_part)
+
+    def close_encoders(self):
+        """
+        Closes all streaming encoders, waits until their files are done.
+        """
+        for user_id, audio in self.audio_data.items():
+            if audio.encoder is None:
+                continue
+            if not audio.encoder.close():
+                print(f"Streaming encoder for {user_id} failed, file might be incomplete.")
+            elif self.journal is not None:
+                self.journal.append(
+                    "segment",
+                    user=user_id,
+                    fn=audio.encoder.fn,
+                    part=0,
+                    bytes=os.path.getsize(audio.encoder.fn),
+                )
+            audio.encoder = None
+
+    @Filters.container
+    def write_silence(self, n, user):
+        """
+        Records n bytes of silence for a user as a gap marker, no zeros are written.
+        """
+        if n <= 0:
+            return
+        if self.mixer is not None:
+            self.mixer.add_silence(user, n)
+            return
+        audio = self.get_audio(user)
+        if self.streaming:
+            audio.encoder.write_silence(n)
+        elif self.rotating:
+            with self.rotate_lock:
+                self.advance(user, audio, n)
+        else:
+            audio.add_gap(n)
+
     @Filters.container
     def write(self, data, user):
+        if self.mixer is not None:
+            self.mixer.add(user, data)
+            return
+        if self.streaming:
+            self.get_audio(user).encoder.write(data)
+            return
+        if self.rotating:
+            with self.rotate_lock:
+                self.advance(user, self.get_audio(user), len(data), data)
+                self.rotate_if_due()
+            return
+        self.buffer_pcm(user, self.get_audio(user), data)
+
+    def buffer_pcm(self, user, file: MemoryConciousAudioData, data):
+        """
+        Adds pcm to the user's buffer, flushing when needed.
+        """
         # Check before and after if we should flush.
-        if self.should_flush(sys.getsizeof(data)):
-            if self.should_wait_for_memory():
-                self.await_free_mem()
+        if self.should_flush(len(data)):
             self.flushToFiles()
-        if user not in self.audio_data:
-            file = io.BytesIO()
-            self.audio_data.update({user: MemoryConciousAudioData(file)})
 
-        file = self.audio_data[user]
+        if (
+            isinstance(file.file, MmapPCMBuffer)
+            and file.file.remaining() < len(data)
+        ):
+            # Fixed size buffer is full, flush just this user.
+            self.flush_user(user, file)
         file.write(data)
+        self.total_buffered += len(data)
         if self.should_flush():
-            if self.should_wait_for_memory():
-                self.await_free_mem()
             self.flushToFiles()
 
     def cleanup(self):
@@ -205,17 +704,62 @@ class MemoryConsiousMP3Sink(MP3Sink):
         Overwrites the cleanup method to flush the audio data.
         """
         self.finished = True
+        # Live consumers are done, their iterators end.
+        self.tap.close()
+        if self.mixer is not None:
+            if not self.mixer.close():
+                print("Live mix encoder failed, file might be incomplete.")
+            return
+        if self.streaming:
+            self.close_encoders()
+            return
+        if self.rotating:
+            with self.rotate_lock:
+                # Everything but the newest part gets closed, that one's finished like a normal recording.
+                last = max((audio.part for audio in self.audio_data.values()), default=0)
+                while self.open_part < last:
+                    self.close_part(self.open_part)
         self.flushToFiles(force_all=True)
-        # Now wait for all the threads to finish.
-        while self.write_threads:
-            t, size = self.write_threads.pop()
-            t.join()
+        if self.spooler is not None:
+            self.spooler.drain(self)
+        pool = self._encoder_pool
+        if pool is None:
+            # Nothing was ever flushed.
+            return
+        # Now wait for all the encoders to finish (only ours, the pool might be shared).
+        pool.join(self)
+        if self.owns_encoder_pool:
+            pool.shutdown()
+        if pool.waits:
+            print(
+                f"Capture was stalled {pool.waits} times, {pool.wait_seconds:.1f}s in total, waiting for encoders."
+            )
         # Done!
 
     def any_threads_alive(self):
-        if not self.write_threads:
-            return False
-        return any([t.is_alive() for t, _ in self.write_threads])
+        if self.spooler is not None and self.spooler.pending(self):
+            return True
+        return self._encoder_pool is not None and self._encoder_pool.busy(self)
+
+    def disk_usage(self):
+        """
+        Bytes of this recording's files that are still on disk (segments, parts, live mix, spill buffers).
+        """
+        fns = [fn for audio in list(self.audio_data.values()) for fn in audio.files_on_disk]
+        for part in list(self.parts.values()):
+            fns.extend(fn for files in list(part.files.values()) for fn in files)
+        if self.mixer is not None:
+            fns.append(self.mixer.fn)
+        if os.path.isdir(self.spill_folder):
+            fns.extend(os.path.join(self.spill_folder, fn) for fn in os.listdir(self.spill_folder))
+        total = 0
+        for fn in set(fns):
+            try:
+                total += os.path.getsize(fn)
+            except OSError:
+                # Removed meanwhile (finalized part).
+                continue
+        return total
 
     def cleanup_no_flush(self):
         """
@@ -228,9 +772,203 @@ class MemoryConsiousMP3Sink(MP3Sink):
             audio_data.file.seek(0)
             audio_data.file.truncate(0)
             audio_data.file.close()
+        self.total_buffered = 0
+        with self.free_buffers_lock:
+            while self.free_buffers:
+                self.free_buffers.pop().close()
+        if os.path.isdir(self.spill_folder) and not os.listdir(self.spill_folder):
+            os.rmdir(self.spill_folder)
+
+
+class OpusPacketSink(MemoryConsiousMP3Sink):
+    """
+    Stores the decrypted opus packets of every user as-is, with their rtp timestamp and receive time.
+    Nothing is decoded or encoded while recording, each user has one append-only packet file.
+    Tracks are built from these files afterwards, see opus_util.build_ogg_track.
+    """
+
+    def get_audio(self, user) -> MemoryConciousAudioData:
+        if user not in self.audio_data:
+            fn = f"{self.output_folder}/{user}_{datetime.now().strftime('%Y%m%d%H%M%S%f')}.opuspk"
+            audio = MemoryConciousAudioData(io.BytesIO())
+            audio.packets = OpusPacketWriter(fn)
+            audio.files_on_disk.append(fn)
+            if self.journal is not None:
+                self.journal.append("segment_started", user=user, fn=fn, part=0)
+            self.audio_data.update({user: audio})
+        return self.audio_data[user]
+
+    @Filters.container
+    def write_packet(self, data, user):
+        self.get_audio(user).packets.write(
+            data.timestamp, data.receive_time, data.decrypted_data
+        )
+
+    def write(self, data, user):
+        raise RecordingException(f"{self.__class__.__name__} only takes opus packets.")
+
+    def write_silence(self, n, user):
+        raise RecordingException(f"{self.__class__.__name__} only takes opus packets.")
+
+    def cleanup(self):
+        self.finished = True
+        # Nothing is ever published (no pcm), but subscribers still wait for the end.
+        self.tap.close()
+        for user_id, audio in self.audio_data.items():
+            audio.packets.close()
+            if self.journal is not None:
+                self.journal.append(
+                    "segment",
+                    user=user_id,
+                    fn=audio.packets.fn,
+                    part=0,
+                    bytes=os.path.getsize(audio.packets.fn),
+                )
+
+
+class DecodeQueue:
+    """
+    Blocking FIFO for the decoder, wakes up as soon as packets arrive instead of polling.
+    Keeps track of its depth and high-water mark, so we can see when the decoder falls behind.
+    Once closed, new packets are dropped, so what's left to drain can't keep growing.
+    """
+
+    def __init__(self):
+        self.items = collections.deque()
+        self.cond = threading.Condition()
+        self.high_water = 0
+        self.closed = False
+
+    def __len__(self):
+        return len(self.items)
+
+    @property
+    def depth(self):
+        return len(self.items)
+
+    def put(self, item):
+        with self.cond:
+            if self.closed:
+                return
+            self.items.append(item)
+            if len(self.items) > self.high_water:
+                self.high_water = len(self.items)
+            self.cond.notify()
+
+    def put_many(self, items):
+        """
+        Puts a batch with a single lock/wakeup.
+        """
+        with self.cond:
+            if self.closed:
+                return
+            self.items.extend(items)
+            if len(self.items) > self.high_water:
+                self.high_water = len(self.items)
+            self.cond.notify()
+
+    def get_batch(self, max_items=64, timeout=None) -> list:
+        """
+        Waits for at least one item and drains up to max_items.
+        Returns an empty list on timeout or wake().
+        """
+        with self.cond:
+            if not self.items:
+                self.cond.wait(timeout)
+            n = min(max_items, len(self.items))
+            return [self.items.popleft() for _ in range(n)]
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class PendingSSRCs:
+    """
+    Holds the packets of ssrcs that aren't mapped to a user yet, the gateway's speaking event can come
+    after their first packets. This way the decoder doesn't have to wait for it, and neither does everyone else.
+
+    Past max_seconds/max_bytes per ssrc the oldest packets are dropped (and counted).
+    For decoded packets their length is added to the next one's silence, so what's left still lines up.
+    """
+
+    def __init__(self, max_seconds=PENDING_MAX_SECONDS, max_bytes=PENDING_MAX_BYTES):
+        self.max_seconds = max_seconds
+        self.max_bytes = max_bytes
+        # ssrc -> deque of [silence in bytes, data]
+        self.packets = {}
+        self.sizes = collections.Counter()
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.packets)
+
+    def __contains__(self, ssrc):
+        return ssrc in self.packets
+
+    def count(self):
+        return sum(len(q) for q in self.packets.values())
+
+    @staticmethod
+    def size(data):
+        return len(data.decoded_data if data.decoded_data is not None else data.decrypted_data)
+
+    def add(self, ssrc, data, silence=0):
+        q = self.packets.get(ssrc)
+        if q is None:
+            q = self.packets[ssrc] = collections.deque()
+            print(f"Holding packets of ssrc {ssrc} until its user is known.")
+        q.append([silence, data])
+        self.sizes[ssrc] += self.size(data)
+        while len(q) > 1 and (
+            self.sizes[ssrc] > self.max_bytes
+            or data.receive_time - q[0][1].receive_time > self.max_seconds
+        ):
+            old_silence, old = q.popleft()
+            self.sizes[ssrc] -= self.size(old)
+            if old.decoded_data is not None:
+                q[0][0] += old_silence + len(old.decoded_data)
+            self.dropped += 1
+            metrics.PENDING_DROPPED.inc()
+
+    def pop_mapped(self, ssrc_map: dict):
+        """
+        Yields (ssrc, user_id, [[silence, data]]) of the held ssrcs that got mapped since.
+        """
+        for ssrc in [ssrc for ssrc in self.packets if ssrc in ssrc_map]:
+            q = self.packets.pop(ssrc)
+            del self.sizes[ssrc]
+            yield ssrc, ssrc_map[ssrc]["user_id"], q
+
+    def drop_all(self) -> int:
+        n = self.count()
+        self.dropped += n
+        metrics.PENDING_DROPPED.inc(n)
+        self.packets = {}
+        self.sizes.clear()
+        return n
 
 
 class MemoryConciousDecodeManager(DecodeManager):
+    def __init__(self, client):
+        super().__init__(client)
+        self.decode_queue = DecodeQueue()
+        # Packets of this recording, the metrics count all of them.
+        self.received = 0
+
+    def decode(self, opus_frame):
+        if not isinstance(opus_frame, RawData):
+            raise TypeError("opus_frame should be a RawData object.")
+        self.decode_queue.put(opus_frame)
+        self.received += 1
+        metrics.PACKETS_RECEIVED.inc()
+
+    def decode_many(self, opus_frames: list):
+        self.decode_queue.put_many(opus_frames)
+        self.received += len(opus_frames)
+        metrics.PACKETS_RECEIVED.inc(len(opus_frames))
+
     def wipe_decoders(self):
         # print("Wiping decoders...")
         for decoder in self.decoder.values():
@@ -238,43 +976,214 @@ class MemoryConciousDecodeManager(DecodeManager):
         self.decoder = {}
 
     def stop(self):
-        while self.decoding:
-            time.sleep(0.1)
-            self.wipe_decoders()
-            gc.collect()
-            # print("Decoder Process Killed")
+        """
+        Tells the decoder to drain what's left in the queue and exit, returns right away
+        (it's called from the event loop, draining can wait on the encoders). wait_stopped waits for the exit.
+        Packets that come in after this are dropped, otherwise the drain never ends while people talk.
+        """
         self._end_thread.set()
+        self.decode_queue.close()
+
+    def wait_stopped(self):
+        """
+        Blocks until the decoder is done after stop(), not on the event loop.
+        """
+        if threading.current_thread() is not self:
+            self.join()
+        self.wipe_decoders()
+        gc.collect()
+
+    def next_batch(self, max_items=64):
+        """
+        Waits for the next batch of packets, None once stopped and the queue is drained.
+        """
+        while True:
+            if self._end_thread.is_set():
+                # Don't wait anymore, just take what's left.
+                return self.decode_queue.get_batch(max_items, timeout=0) or None
+            batch = self.decode_queue.get_batch(max_items, timeout=0.5)
+            if batch:
+                return batch
 
     def run(self):
         n = 0
-        while not self._end_thread.is_set():
+        while (batch := self.next_batch()) is not None:
+
+            for data in batch:
+                n += 1
+                try:
+                    if data.decrypted_data is None:
+                        continue
+                    else:
+                        data.decoded_data = self.get_decoder(data.ssrc).decode(
+                            data.decrypted_data
+                        )
+                except OpusError:
+                    print("Error occurred while decoding opus frame.")
+                    continue
+
+                self.client.recv_decoded_audio(data)
+                if n % 10_000 == 0:
+                    # for every 10000 frames, wipe decoders
+                    self.wipe_decoders()
+        print(
+            f"Decoder stopped, decode queue high-water mark: {self.decode_queue.high_water} packets."
+        )
+
+
+class PassthroughDecodeManager(MemoryConciousDecodeManager):
+    """
+    Doesn't decode at all, passes the opus packets on to recv_opus_audio (for OpusPacketSink).
+    """
+
+    def run(self):
+        while (batch := self.next_batch()) is not None:
+            for data in batch:
+                if data.decrypted_data is None:
+                    continue
+                self.client.recv_opus_audio(data)
+
+
+class DecodedPacket:
+    """
+    The parts of RawData that recv_decoded_audio needs, rebuilt from a decode worker's result.
+    """
+
+    __slots__ = ("ssrc", "sequence", "timestamp", "receive_time", "decoded_data")
+
+    def __init__(self, ssrc, sequence, timestamp, receive_time, decoded_data):
+        self.ssrc = ssrc
+        self.sequence = sequence
+        self.timestamp = timestamp
+        self.receive_time = receive_time
+        self.decoded_data = decoded_data
+
+
+def _decode_worker(packets_conn, results_conn):
+    """
+    Runs in a decode worker process.
+    Receives batches of (ssrc, sequence, timestamp, receive_time, opus) and sends back the pcm.
+    Every ssrc always lands on the same worker, so a single decoder state per ssrc is enough.
+    """
+    decoders = {}
+    n = 0
+    while True:
+        try:
+            batch = packets_conn.recv()
+        except EOFError:
+            break
+        if batch is None:
+            break
+
+        results = []
+        for ssrc, sequence, timestamp, receive_time, payload in batch:
             n += 1
+            if ssrc not in decoders:
+                decoders[ssrc] = opus.Decoder()
             try:
-                data = self.decode_queue.pop(0)
-            except IndexError:
-                time.sleep(0.001)
+                pcm = decoders[ssrc].decode(payload)
+            except OpusError:
+                print("Error occurred while decoding opus frame.")
                 continue
+            results.append((ssrc, sequence, timestamp, receive_time, pcm))
+            if n % 10_000 == 0:
+                # same as the in-thread decoder, c lib doesn't release memory otherwise.
+                decoders = {}
+        results_conn.send(results)
+    results_conn.close()
 
-            try:
+
+class MultiprocessDecodeManager(MemoryConciousDecodeManager):
+    """
+    Spreads opus decoding over a pool of worker processes, sharded by ssrc.
+
+    This thread only dispatches batches from the decode queue to the workers.
+    A collector thread gets the pcm back and calls recv_decoded_audio, so the sink still has a single writer.
+    Per-speaker ordering is kept: one ssrc always goes to the same worker, and each worker answers in order.
+    """
+
+    def __init__(self, client, workers=2):
+        super().__init__(client)
+        self.workers = []
+        self.packet_conns = []
+        self.result_conns = []
+        ctx = mp.get_context()
+        for _ in range(workers):
+            packets_recv, packets_send = ctx.Pipe(duplex=False)
+            results_recv, results_send = ctx.Pipe(duplex=False)
+            p = ctx.Process(
+                target=_decode_worker,
+                args=(packets_recv, results_send),
+                daemon=True,
+            )
+            p.start()
+            # Close our copies of the worker's ends, so EOF is seen when it exits.
+            packets_recv.close()
+            results_send.close()
+            self.workers.append(p)
+            self.packet_conns.append(packets_send)
+            self.result_conns.append(results_recv)
+        self.collector = threading.Thread(
+            target=self.collect, daemon=True, name="DecodeCollector"
+        )
+
+    def start(self):
+        self.collector.start()
+        super().start()
+
+    def wait_stopped(self):
+        super().wait_stopped()
+        self.collector.join()
+        for p in self.workers:
+            p.join(timeout=5)
+
+    def run(self):
+        n_workers = len(self.packet_conns)
+        while (batch := self.next_batch(max_items=256)) is not None:
+            shards = [[] for _ in range(n_workers)]
+            for data in batch:
                 if data.decrypted_data is None:
                     continue
-                else:
-                    data.decoded_data = self.get_decoder(data.ssrc).decode(
-                        data.decrypted_data
+                shards[data.ssrc % n_workers].append(
+                    (
+                        data.ssrc,
+                        data.sequence,
+                        data.timestamp,
+                        data.receive_time,
+                        bytes(data.decrypted_data),
                     )
-            except OpusError:
-                print("Error occurred while decoding opus frame.")
-                continue
+                )
+            for conn, shard in zip(self.packet_conns, shards):
+                if shard:
+                    conn.send(shard)
 
-            self.client.recv_decoded_audio(data)
-            if n % 10_000 == 0:
-                # for every 10000 frames, wipe decoders
-                self.wipe_decoders()
+        for conn in self.packet_conns:
+            conn.send(None)
+            conn.close()
+
+    def collect(self):
+        conns = list(self.result_conns)
+        while conns:
+            for conn in mp.connection.wait(conns):
+                try:
+                    results = conn.recv()
+                except EOFError:
+                    conns.remove(conn)
+                    continue
+                for result in results:
+                    self.client.recv_decoded_audio(DecodedPacket(*result))
 
 
 class MemoryConciousVoiceClient(discord.VoiceClient):
     def start_recording(
-        self, sink, txtchannel, callback, *args, sync_start: bool = False
+        self,
+        sink,
+        txtchannel,
+        callback,
+        *args,
+        sync_start: bool = False,
+        decode_workers: int = 0,
+        capture_fn: str = None,
     ):
         """The bot will begin recording audio from the current voice channel it is in.
         This function uses a thread so the current code line will not be stopped.
@@ -294,6 +1203,12 @@ class MemoryConciousVoiceClient(discord.VoiceClient):
         sync_start: :class:`bool`
             If True, the recordings of subsequent users will start with silence.
             This is useful for recording audio just as it was heard.
+        decode_workers: :class:`int`
+            If > 0, opus decoding is spread over this many worker processes (by ssrc).
+            0 decodes on a single thread. Ignored for OpusPacketSink, which doesn't decode.
+        capture_fn: :class:`str`
+            If set, every decrypted packet is also written to this capture file (see capture_util),
+            so the session can be replayed offline with bench.py.
 
         Raises
         ------
@@ -311,27 +1226,52 @@ class MemoryConciousVoiceClient(discord.VoiceClient):
         if not isinstance(sink, MemoryConsiousMP3Sink):
             raise RecordingException("Must provide the MemoryConsiousMP3Sink object.")
 
+        # Opened first, so a bad path fails before anything is started.
+        capture = PacketCaptureWriter(capture_fn, time.perf_counter()) if capture_fn else None
         self.empty_socket()
 
         # Swap out for our own.
         # self.decoder = opus.DecodeManager(self)
-        self.decoder = MemoryConciousDecodeManager(self)
+        if isinstance(sink, OpusPacketSink):
+            self.decoder = PassthroughDecodeManager(self)
+        elif decode_workers > 0:
+            self.decoder = MultiprocessDecodeManager(self, workers=decode_workers)
+        else:
+            self.decoder = MemoryConciousDecodeManager(self)
         self.decoder.start()
         self.recording = True
-        self.sync_start = sync_start
-        self.sink: MemoryConsiousMP3Sink = sink
-        self.txtchannel = txtchannel
-        sink.init(self)
-
-        t = threading.Thread(
-            target=self.recv_audio,
-            args=(
-                sink,
-                callback,
-                *args,
-            ),
-        )
-        t.start()
+        try:
+            self.sync_start = sync_start
+            self.sink: MemoryConsiousMP3Sink = sink
+            self.txtchannel = txtchannel
+            self.capture = capture
+            # Set on stop, so the receive thread doesn't sit out its backoff.
+            self.recv_stopped = threading.Event()
+            self.pending = PendingSSRCs()
+            # Delivered packets of this recording and their total decode latency, for !status.
+            self.delivered = 0
+            self.latency_total = 0.0
+            sink.init(self)
+
+            t = threading.Thread(
+                target=self.recv_audio,
+                args=(
+                    sink,
+                    callback,
+                    *args,
+                ),
+            )
+            t.start()
+        except Exception:
+            # Nothing was received yet, so the decoder exits right away.
+            self.recording = False
+            self.decoder.stop()
+            self.decoder.wait_stopped()
+            if capture is not None:
+                capture.close()
+                os.remove(capture.fn)
+            self.capture = None
+            raise
 
     def send_msg_to_txtchannel(self, msg):
         """
@@ -346,6 +1286,78 @@ class MemoryConciousVoiceClient(discord.VoiceClient):
         except Exception as e:
             print(f"Failed to send message to text channel: {e}")
 
+    def stop_recording(self):
+        super().stop_recording()
+        stopped = getattr(self, "recv_stopped", None)
+        if stopped is not None:
+            stopped.set()
+
+    def unpack_packet(self, data):
+        """
+        Same as pycord's unpack_audio, but returns the RawData (None if it's dropped),
+        and writes the decrypted packets to the capture file when capturing.
+        Silence frames are captured too, so a replay goes through the same filtering.
+        """
+        if 200 <= data[1] <= 204:
+            # RTCP received.
+            return None
+        if self.paused:
+            return None
+
+        data = RawData(data, self)
+        capture = getattr(self, "capture", None)
+        if capture is not None:
+            capture.write_packet(data, self.ws.ssrc_map)
+
+        if data.decrypted_data == SILENCE_FRAME:
+            return None
+        return data
+
+    def unpack_audio(self, data):
+        data = self.unpack_packet(data)
+        if data is not None:
+            self.decoder.decode(data)
+
+    def unpack_batch(self, batch: list):
+        """
+        unpack_audio for a batch of datagrams, handed to the decoder in one go.
+        """
+        frames = []
+        for packet in batch:
+            data = self.unpack_packet(packet)
+            if data is not None:
+                frames.append(data)
+        if frames:
+            self.decoder.decode_many(frames)
+
+    def recv_batch(self, timeout=0.1) -> list:
+        """
+        Waits up to timeout for the socket, then drains every datagram that's waiting (up to RECV_BATCH).
+        Returns an empty list when nothing arrived.
+        Raises OSError/ValueError when the socket is broken or closed. When that happens partway through a drain,
+        the datagrams read so far are returned instead, the next call runs into the error again.
+        """
+        # pycord swaps the socket when it reconnects, so don't hold on to it.
+        sock = self.socket
+        ready, _, err = select.select([sock], [], [sock], timeout)
+        if err:
+            raise OSError("Socket reported an error.")
+        batch = []
+        if not ready:
+            return batch
+        metrics.RECV_WAKEUPS.inc()
+        # pycord's voice socket is non-blocking, recv raises once it's drained.
+        while len(batch) < RECV_BATCH:
+            try:
+                batch.append(sock.recv(4096))
+            except (BlockingIOError, InterruptedError):
+                break
+            except (OSError, ValueError):
+                if not batch:
+                    raise
+                break
+        return batch
+
     def recv_audio(self, sink, callback, *args):
         """
         Overriding this, to make sure socket stays alive, instead of stopping recording.
@@ -360,65 +1372,55 @@ class MemoryConciousVoiceClient(discord.VoiceClient):
         self.starting_time = time.perf_counter()
         self.first_packet_timestamp: float
 
-        sleep_time = 0.05
+        sleep_time = RECV_BACKOFF
+        # When the socket started failing, None while it's fine.
+        failing_since = None
 
         sent_reconnect_msg = False
         reconnect_msg = "Connection error occurred! Trying to reconnect..."
         fail_msg = "Failed to reconnect, stopping recording."
         while self.recording:
-            for _ in range(0, 10):
-                try:
-                    ready, _, err = select.select(
-                        [self.socket], [], [self.socket], 0.01
-                    )
-                    if not ready:
-                        if err:
-                            print(f"Socket error: {err}")
-                            if not sent_reconnect_msg:
-                                self.send_msg_to_txtchannel(reconnect_msg)
-                                sent_reconnect_msg = True
-
-                        time.sleep(sleep_time)
-                        sleep_time = sleep_time * 2
-                    else:
-                        sleep_time = 0.05
-                        sent_reconnect_msg = False
-                        break
-                except ValueError:
-                    # Socket has been closed.
-                    print("Socket has been closed.")
-                    if not sent_reconnect_msg:
-                        self.send_msg_to_txtchannel(reconnect_msg)
-                        sent_reconnect_msg = True
-                    time.sleep(sleep_time)
-                    sleep_time = sleep_time * 2
+            try:
+                batch = self.recv_batch()
+            except ValueError:
+                # Socket has been closed.
+                error = "Socket has been closed."
+            except OSError as e:
+                error = f"Socket had an error, retrying... {e}"
             else:
-                # Didn't break, so we couldnt get a ready socket.
+                if failing_since is not None:
+                    print("Socket is back.")
+                    failing_since = None
+                    sleep_time = RECV_BACKOFF
+                    sent_reconnect_msg = False
+                if batch:
+                    self.unpack_batch(batch)
+                continue
+
+            print(error)
+            if not sent_reconnect_msg:
+                self.send_msg_to_txtchannel(reconnect_msg)
+                sent_reconnect_msg = True
+            now = time.perf_counter()
+            if failing_since is None:
+                failing_since = now
+            elif now - failing_since > RECV_GIVE_UP_SECONDS:
                 print(fail_msg)
                 self.send_msg_to_txtchannel(fail_msg)
                 self.stop_recording()
-                continue
-
-            for _ in range(0, 10):
-                try:
-                    data = self.socket.recv(4096)
-                    sleep_time = 0.05
-                    sent_reconnect_msg = False
-                    break
-                except OSError as e:
-                    print(f"Socket had an error, retrying... {e}")
-                    if not sent_reconnect_msg:
-                        self.send_msg_to_txtchannel(reconnect_msg)
-                        sent_reconnect_msg = True
-                    time.sleep(sleep_time)
-                    sleep_time = sleep_time * 2
-                    continue
-            else:
-                # Retry to get a ready socket?
-                continue
-            self.unpack_audio(data)
+                break
+            # Wakes up right away when the recording is stopped meanwhile.
+            self.recv_stopped.wait(sleep_time)
+            sleep_time = min(sleep_time * 2, RECV_BACKOFF_MAX)
 
         self.stopping_time = time.perf_counter()
+        # stop_recording only told the decoder to stop, wait for the drain here instead of on the event loop.
+        self.decoder.wait_stopped()
+        self.finish_pending()
+        if self.capture is not None:
+            self.capture.close()
+            print(f"Captured {self.capture.packets} packets to {self.capture.fn}.")
+            self.capture = None
         self.sink.cleanup()
         callback = asyncio.run_coroutine_threadsafe(callback(sink, *args), self.loop)
         result = callback.result()
@@ -441,38 +1443,76 @@ class MemoryConciousVoiceClient(discord.VoiceClient):
                 ) - 960
 
         else:  # Previously received a packet from user
-            dRT = (
-                data.receive_time - self.user_timestamps[data.ssrc][1]
-            ) * 48000  # delta receive time
-            dT = data.timestamp - self.user_timestamps[data.ssrc][0]  # delta timestamp
-            diff = abs(100 - dT * 100 / dRT)
-            if (
-                diff > 60 and dT != 960
-            ):  # If the difference in change is more than 60% threshold
-                silence = dRT - 960
-            else:
-                silence = dT - 960
+            silence = packet_silence(
+                self.user_timestamps[data.ssrc], data.timestamp, data.receive_time
+            )
 
         self.user_timestamps.update({data.ssrc: (data.timestamp, data.receive_time)})
 
-        # await user_id
-        while data.ssrc not in self.ws.ssrc_map:
-            time.sleep(0.05)
-        user_id = self.ws.ssrc_map[data.ssrc]["user_id"]
-
-        # Check if the silence is larger than the MAX_MB_BEFORE_FLUSH
-        # (add debug 'x' to accelerate this issue triggering), this used to be a memleak here.
-        # x = 10_000
-
-        silence_length = max(0, int(silence)) * opus._OpusStruct.CHANNELS  # * x
-        if silence_length > (MAX_MB_BEFORE_FLUSH * 1024 * 1024):
-            # write silence in chunks of 10mb
-            while silence_length != 0:
-                chunk = min(silence_length, 10 * 1024 * 1024)
-                self.sink.write(struct.pack("<h", 0) * chunk, user_id)
-                silence_length -= chunk
-        else:
-            data.decoded_data = (
-                struct.pack("<h", 0) * silence_length + data.decoded_data
-            )
+        # Silence is only recorded as a gap marker (in bytes, 16 bit samples).
+        # It used to be written out as zeros, which was a memleak for long gaps.
+        silence_length = max(0, int(silence)) * opus._OpusStruct.CHANNELS * 2
+
+        if self.pending:
+            self.flush_pending(self.deliver_decoded)
+        user = self.ws.ssrc_map.get(data.ssrc)
+        if user is None:
+            # No user yet, hold it until the speaking event comes in.
+            self.pending.add(data.ssrc, data, silence_length)
+            return
+        self.deliver_decoded(user["user_id"], silence_length, data)
+
+    def deliver_decoded(self, user_id, silence_length, data):
+        self.sink.write_silence(silence_length, user_id)
         self.sink.write(data.decoded_data, user_id)
+        self.sink.tap.publish(user_id, data.decoded_data)
+        self.count_delivered(data)
+
+    def count_delivered(self, data):
+        latency = time.perf_counter() - data.receive_time
+        self.delivered += 1
+        self.latency_total += latency
+        metrics.PACKETS_DECODED.inc()
+        metrics.DECODE_LATENCY.observe(latency)
+
+    def recv_opus_audio(self, data: RawData):
+        """
+        Passthrough capture: hands the decrypted opus packet to the sink, nothing is decoded.
+        Silence is worked out from the stored timestamps when the track is built.
+        """
+        if self.pending:
+            self.flush_pending(self.deliver_opus)
+        user = self.ws.ssrc_map.get(data.ssrc)
+        if user is None:
+            self.pending.add(data.ssrc, data)
+            return
+        self.deliver_opus(user["user_id"], 0, data)
+
+    def deliver_opus(self, user_id, silence_length, data):
+        self.sink.write_packet(data, user_id)
+        self.count_delivered(data)
+
+    def flush_pending(self, deliver):
+        """
+        Writes the held packets of ssrcs that got their user since, in the order they came in.
+        """
+        for ssrc, user_id, packets in self.pending.pop_mapped(self.ws.ssrc_map):
+            print(f"ssrc {ssrc} is user {user_id}, writing {len(packets)} held packets.")
+            for silence_length, data in packets:
+                deliver(user_id, silence_length, data)
+
+    def finish_pending(self):
+        """
+        After the decoder stopped: writes what got mapped in the meantime, drops the rest.
+        """
+        if not self.pending:
+            return
+        if isinstance(self.sink, OpusPacketSink):
+            self.flush_pending(self.deliver_opus)
+        else:
+            self.flush_pending(self.deliver_decoded)
+        dropped = self.pending.drop_all()
+        if dropped:
+            print(f"Dropped {dropped} packets of ssrcs that never got a user.")
+        if self.pending.dropped:
+            print(f"{self.pending.dropped} packets of unknown ssrcs were dropped in total.")